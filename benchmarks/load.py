@@ -0,0 +1,121 @@
+"""Small load generator for the predict route that reports latency percentiles and throughput.
+
+Runs against a running Galahad server, or starts one in-process with a synthetic classifier when no URL is given:
+
+    python -m benchmarks.load --tokens 10000 --concurrency 8 --requests 200
+    python -m benchmarks.load --url http://localhost:8000 --classifier spacy_ner --model model1
+"""
+
+import argparse
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List
+
+import requests
+import uvicorn
+
+from benchmarks.synthetic import SyntheticSpanClassifier, generate_document
+from galahad.server import GalahadServer
+from galahad.server.dataclasses import Document
+
+
+class _ThreadedServer(uvicorn.Server):
+    def install_signal_handlers(self):
+        pass
+
+
+@contextmanager
+def run_in_process_server(port: int) -> Iterator[str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        server = GalahadServer(data_dir=Path(tmp))
+        server.add_classifier("synthetic", SyntheticSpanClassifier())
+
+        uvicorn_server = _ThreadedServer(uvicorn.Config(server, host="127.0.0.1", port=port, log_level="warning"))
+        thread = threading.Thread(target=uvicorn_server.run, daemon=True)
+        thread.start()
+        while not uvicorn_server.started:
+            time.sleep(0.1)
+
+        try:
+            yield f"http://127.0.0.1:{port}"
+        finally:
+            uvicorn_server.should_exit = True
+            thread.join()
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    idx = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+def build_bodies(document: Document, num_requests: int, identical: bool = False) -> List[str]:
+    """Serializes `document` once per request.
+
+    Identical concurrent requests share one prediction on the server, so each request gets its own version unless
+    `identical` is set to measure exactly that.
+    """
+    if identical:
+        return [document.json()] * (num_requests + 1)
+
+    return [document.copy(update={"version": document.version + i}).json() for i in range(num_requests + 1)]
+
+
+def run_load(url: str, classifier: str, model: str, bodies: List[str], concurrency: int):
+    session = requests.Session()
+    endpoint = f"{url}/classifier/{classifier}/{model}/predict"
+    headers = {"Content-Type": "application/json"}
+    num_requests = len(bodies) - 1
+
+    def send(body: str) -> float:
+        start = time.perf_counter()
+        response = session.post(endpoint, data=body, headers=headers)
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    # Warm up caches and the model before measuring
+    send(bodies[0])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(send, bodies[1:]))
+    elapsed = time.perf_counter() - start
+
+    print(f"requests:    {num_requests} with concurrency {concurrency}")
+    print(f"throughput:  {num_requests / elapsed:.1f} requests/s")
+    print(f"mean:        {statistics.mean(latencies) * 1000:.1f} ms")
+    print(f"p50:         {percentile(latencies, 0.50) * 1000:.1f} ms")
+    print(f"p99:         {percentile(latencies, 0.99) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="URL of a running server, starts an in-process server if not given")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the in-process server")
+    parser.add_argument("--classifier", default="synthetic")
+    parser.add_argument("--model", default="model")
+    parser.add_argument("--tokens", type=int, default=10_000, help="Number of tokens per synthetic document")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--identical",
+        action="store_true",
+        help="Send the same document with every request, concurrent requests then share one prediction",
+    )
+    args = parser.parse_args()
+
+    bodies = build_bodies(generate_document(args.tokens, entity_every=None), args.requests, args.identical)
+
+    if args.url:
+        run_load(args.url, args.classifier, args.model, bodies, args.concurrency)
+    else:
+        with run_in_process_server(args.port) as url:
+            run_load(url, args.classifier, args.model, bodies, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Synthetic documents and classifiers for benchmarking.
+
+All documents are generated deterministically from a seed so that runs are comparable.
+"""
+
+import os
+import random
+from typing import Iterable, List, Optional
+
+from galahad.formats import Span, build_span_classification_response
+from galahad.server.classifier import (AnnotationFeatures, AnnotationTypes,
+                                       Classifier)
+from galahad.server.dataclasses import Annotation, Document
+
+# Documents of 1M tokens take long to generate and process, they are only benchmarked when asked for
+MAX_TOKENS = int(os.environ.get("GALAHAD_BENCHMARK_MAX_TOKENS", 100_000))
+SIZES = [n for n in (1_000, 10_000, 100_000, 1_000_000) if n <= MAX_TOKENS]
+
+WORDS = ["the", "train", "was", "late", "Joe", "waited", "for", "Berlin", "in", "a", "station", ",", "."]
+LABELS = ["PER", "LOC", "ORG", "MISC"]
+
+
+def generate_sentences(num_tokens: int, sentence_length: int = 20, seed: int = 42) -> List[List[str]]:
+    rng = random.Random(seed)
+
+    sentences = []
+    for begin in range(0, num_tokens, sentence_length):
+        length = min(sentence_length, num_tokens - begin)
+        sentences.append([rng.choice(WORDS) for _ in range(length)])
+
+    return sentences
+
+
+def generate_document(
+    num_tokens: int, sentence_length: int = 20, entity_every: Optional[int] = 10, seed: int = 42
+) -> Document:
+    """Generates a document with `num_tokens` tokens, sentences and optionally a labeled span every few tokens."""
+    rng = random.Random(seed)
+    sentences = generate_sentences(num_tokens, sentence_length, seed)
+
+    tokens = []
+    sentence_annotations = []
+    entities = []
+
+    begin = 0
+    for sentence in sentences:
+        sentence_begin = begin
+        for token_text in sentence:
+            end = begin + len(token_text)
+            tokens.append(Annotation(begin=begin, end=end))
+
+            if entity_every and len(tokens) % entity_every == 0:
+                entities.append(
+                    Annotation(begin=begin, end=end, features={AnnotationFeatures.VALUE.value: rng.choice(LABELS)})
+                )
+
+            begin = end + 1
+        sentence_annotations.append(Annotation(begin=sentence_begin, end=begin - 1))
+
+    text = " ".join(token for sentence in sentences for token in sentence)
+    annotations = {
+        AnnotationTypes.TOKEN.value: tokens,
+        AnnotationTypes.SENTENCE.value: sentence_annotations,
+    }
+    if entity_every:
+        annotations[AnnotationTypes.ANNOTATION.value] = entities
+
+    return Document(text=text, annotations=annotations, version=1)
+
+
+class SyntheticSpanClassifier(Classifier):
+    """Labels every tenth token without a model so that benchmarks only measure the Galahad overhead."""
+
+    def train(self, model_id: str, documents: Iterable[Document]):
+        self._save_model(model_id, sum(1 for _ in documents))
+
+    def predict(self, model_id: str, document: Document) -> Optional[Document]:
+        num_tokens = len(document.annotations[AnnotationTypes.TOKEN.value])
+        spans = [Span(i, i + 1, LABELS[i % len(LABELS)]) for i in range(0, num_tokens, 10)]
+        return build_span_classification_response(document, spans)
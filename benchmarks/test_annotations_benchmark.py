@@ -0,0 +1,70 @@
+import pytest
+
+from benchmarks.synthetic import SIZES, generate_document, generate_sentences
+from galahad.formats import (Span, build_doc_from_tokens_and_text,
+                             build_span_classification_response)
+from galahad.server.annotations import Annotations
+from galahad.server.classifier import AnnotationTypes
+
+
+@pytest.mark.parametrize("num_tokens", SIZES)
+def test_annotations_from_dict(benchmark, num_tokens: int):
+    document = generate_document(num_tokens)
+
+    benchmark(Annotations.from_dict, document.text, document.annotations)
+
+
+@pytest.mark.parametrize("num_tokens", SIZES)
+def test_annotations_from_document(benchmark, num_tokens: int):
+    document = generate_document(num_tokens)
+
+    benchmark(Annotations.from_document, document)
+
+
+@pytest.mark.parametrize("num_tokens", SIZES)
+def test_select_covered_tokens_per_sentence(benchmark, num_tokens: int):
+    document = generate_document(num_tokens)
+    annotations = Annotations.from_dict(document.text, document.annotations)
+    sentences = annotations.select(AnnotationTypes.SENTENCE.value)
+
+    def select_all_tokens():
+        for sentence in sentences:
+            annotations.select_covered(AnnotationTypes.TOKEN.value, sentence)
+
+    benchmark(select_all_tokens)
+
+
+@pytest.mark.parametrize("num_tokens", SIZES)
+def test_select_covering_sentence_per_token(benchmark, num_tokens: int):
+    document = generate_document(num_tokens)
+    annotations = Annotations.from_dict(document.text, document.annotations)
+    tokens = annotations.select(AnnotationTypes.TOKEN.value)
+
+    benchmark(annotations.select_covering_many, AnnotationTypes.SENTENCE.value, tokens)
+
+
+@pytest.mark.parametrize("num_tokens", SIZES)
+def test_select_covering_token_with_long_early_annotation(benchmark, num_tokens: int):
+    # A document spanning annotation in front of all tokens must not make every query scan the whole layer
+    document = generate_document(num_tokens)
+    annotations = Annotations.from_dict(document.text, document.annotations)
+    tokens = annotations.select(AnnotationTypes.TOKEN.value)
+    annotations.create_annotation(AnnotationTypes.TOKEN.value, 0, len(document.text))
+
+    benchmark(annotations.select_covering_many, AnnotationTypes.TOKEN.value, tokens)
+
+
+@pytest.mark.parametrize("num_tokens", SIZES)
+def test_build_span_classification_response(benchmark, num_tokens: int):
+    document = generate_document(num_tokens, entity_every=None)
+    spans = [Span(i, i + 2, "PER") for i in range(0, num_tokens - 2, 10)]
+
+    benchmark(build_span_classification_response, document, spans)
+
+
+@pytest.mark.parametrize("num_tokens", SIZES)
+def test_build_doc_from_tokens_and_text(benchmark, num_tokens: int):
+    sentences = generate_sentences(num_tokens)
+    text = " ".join(token for sentence in sentences for token in sentence)
+
+    benchmark(build_doc_from_tokens_and_text, text, sentences)
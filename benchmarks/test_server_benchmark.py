@@ -0,0 +1,58 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pytest
+from fastapi.testclient import TestClient
+
+from benchmarks.synthetic import (SIZES, SyntheticSpanClassifier,
+                                  generate_document)
+from galahad.server import GalahadServer
+
+
+@pytest.fixture
+def client():
+    with TemporaryDirectory() as tmp:
+        server = GalahadServer(data_dir=Path(tmp))
+        server.add_classifier("synthetic", SyntheticSpanClassifier())
+
+        with TestClient(server) as client:
+            yield client
+
+
+@pytest.mark.parametrize("num_tokens", SIZES)
+def test_upload_document(benchmark, client: TestClient, num_tokens: int):
+    client.put("/dataset/benchmark")
+    body = generate_document(num_tokens).json()
+    headers = {"Content-Type": "application/json"}
+
+    def upload():
+        response = client.put("/dataset/benchmark/document", data=body, headers=headers)
+        assert response.status_code == 204
+
+    benchmark(upload)
+
+
+@pytest.mark.parametrize("num_documents", [10, 100])
+def test_list_documents(benchmark, client: TestClient, num_documents: int):
+    client.put("/dataset/benchmark")
+    body = generate_document(1_000).json()
+    for i in range(num_documents):
+        client.put(f"/dataset/benchmark/document{i}", data=body, headers={"Content-Type": "application/json"})
+
+    def list_documents():
+        response = client.get("/dataset/benchmark")
+        assert response.status_code == 200
+
+    benchmark(list_documents)
+
+
+@pytest.mark.parametrize("num_tokens", SIZES)
+def test_predict_round_trip(benchmark, client: TestClient, num_tokens: int):
+    body = generate_document(num_tokens, entity_every=None).json()
+    headers = {"Content-Type": "application/json"}
+
+    def predict():
+        response = client.post("/classifier/synthetic/model/predict", data=body, headers=headers)
+        assert response.status_code == 200
+
+    benchmark(predict)
@@ -1,11 +1,14 @@
 import logging
-from typing import Dict, List
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
 from requests_toolbelt import sessions
 
 from galahad.server import server
-from galahad.server.dataclasses import ClassifierInfo, Document
+from galahad.server.dataclasses import (Annotation, ClassifierInfo, Document,
+                                        DocumentPatch, ModelInfo)
+from galahad.server.util import annotation_key, select_layers
 
 logger = logging.getLogger("galahad.client")
 
@@ -76,10 +79,55 @@ def check_naming_is_ok(given_status: int, **kwargs):
         )
 
 
+def compute_document_patch(old: Document, new: Document) -> DocumentPatch:
+    """Returns the patch that turns the annotations of `old` into the ones of `new`.
+
+    Annotations are compared by offsets and features, their order within a layer does not matter.
+
+    Raises:
+        ValueError: If the texts of the documents differ, which cannot be patched, or if the version of `new` is not
+            greater than the one of `old`.
+    """
+    if old.text != new.text:
+        raise ValueError("The texts of the documents differ, only annotations can be patched!")
+    if new.version <= old.version:
+        raise ValueError("The version of the new document needs to be greater than the one of the old document!")
+
+    patch = DocumentPatch(base_version=old.version, version=new.version)
+    for type_name in sorted(old.annotations.keys() | new.annotations.keys()):
+        old_layer = old.annotations.get(type_name, [])
+        new_layer = new.annotations.get(type_name, [])
+
+        added = _subtract_layer(new_layer, old_layer)
+        removed = _subtract_layer(old_layer, new_layer)
+        if added:
+            patch.add[type_name] = added
+        if removed:
+            patch.remove[type_name] = removed
+
+    return patch
+
+
+def _subtract_layer(layer: List[Annotation], other: List[Annotation]) -> List[Annotation]:
+    # Annotations of `layer` that have no equal annotation in `other`, each annotation of `other` is matched once
+    counts = Counter(annotation_key(a.begin, a.end, a.features) for a in other)
+
+    result = []
+    for annotation in layer:
+        key = annotation_key(annotation.begin, annotation.end, annotation.features)
+        if counts[key] > 0:
+            counts[key] -= 1
+        else:
+            result.append(annotation)
+    return result
+
+
 class GalahadClient:
     def __init__(self, endpoint_url: str):
         self.endpoint_url = endpoint_url.rstrip("/")
         self._session = self._build_session()
+        # Last ETag and parsed response per URL, to poll with conditional requests
+        self._conditional_cache: Dict[str, Tuple[str, Any]] = {}
 
     def start_session(self) -> requests.Session:
         self._session = self._build_session()
@@ -153,6 +201,38 @@ class GalahadClient:
 
         check_response(response)
 
+    def patch_document_in_dataset(self, dataset_id: str, document_id: str, patch: DocumentPatch) -> bool:
+        """Applies `patch` to a stored document, see `compute_document_patch`.
+
+        Returns:
+            `True` if the patch was applied, `False` if the stored document changed since the patch was computed
+            or does not exist.
+        """
+        response = self._session.patch(f"/dataset/{dataset_id}/{document_id}", json=patch.dict())
+        check_naming_is_ok(response.status_code, dataset_id=dataset_id, document_id=document_id)
+
+        if response.status_code in (404, 409):
+            logger.info(f'Could not patch document with id "{document_id}": {response.json()["detail"]}')
+            return False
+
+        check_response(response)
+        return True
+
+    def update_document_in_dataset(self, dataset_id: str, document_id: str, old: Document, new: Document):
+        """Updates a stored document from `old` to `new`, sending only the changed annotations if possible.
+
+        The whole document is uploaded instead if its text changed, if its version did not increase or if the stored
+        document is not `old` anymore or does not exist.
+        """
+        if (
+            old.text == new.text
+            and new.version > old.version
+            and self.patch_document_in_dataset(dataset_id, document_id, compute_document_patch(old, new))
+        ):
+            return
+
+        self.create_document_in_dataset(dataset_id, document_id, new)
+
     # result is sorted by doc id
     def list_documents_in_dataset(self, dataset_id) -> Dict[str, int]:
         response = self._session.get(f"/dataset/{dataset_id}")
@@ -161,6 +241,25 @@ class GalahadClient:
 
         return dict(zip(response.json()["names"], response.json()["versions"]))
 
+    def get_document_in_dataset(
+        self,
+        dataset_id: str,
+        document_id: str,
+        layers: Optional[List[str]] = None,
+        begin: Optional[int] = None,
+        end: Optional[int] = None,
+    ) -> Document:
+        """Reads a stored document, optionally only the given layers and the part of its text in `[begin, end)`.
+
+        Only annotations that lie completely inside of the range are returned, with offsets relative to `begin`.
+        """
+        params = {"layers": layers or [], "begin": begin, "end": end}
+        response = self._session.get(f"/dataset/{dataset_id}/{document_id}", params=params)
+        check_naming_is_ok(response.status_code, dataset_id=dataset_id, document_id=document_id)
+        check_response(response)
+
+        return Document.parse_raw(response.content)
+
     def dataset_contains_document(self, dataset_id: str, document_id: str) -> bool:
         server.check_naming_is_ok_regex(document_id)
         return document_id in list(self.list_documents_in_dataset(dataset_id).keys())
@@ -192,11 +291,39 @@ class GalahadClient:
         return info_list
 
     def get_classifier_info(self, classifier_id: str) -> ClassifierInfo:
-        response = self._session.get(f"/classifier/{classifier_id}")
+        response = self._get_conditionally(f"/classifier/{classifier_id}")
         check_naming_is_ok(response.status_code, classifier_id=classifier_id)
         check_response(response)
 
-        return ClassifierInfo.parse_obj(response.json())
+        return self._parse_conditionally(f"/classifier/{classifier_id}", response, ClassifierInfo)
+
+    # None: model was not trained yet
+    def get_model_info(self, classifier_id: str, model_id: str) -> Optional[ModelInfo]:
+        response = self._get_conditionally(f"/classifier/{classifier_id}/{model_id}")
+        check_naming_is_ok(response.status_code, classifier_id=classifier_id, model_id=model_id)
+        if response.status_code == 404 and self.get_classifier_info(classifier_id) is not None:
+            return None
+
+        check_response(response)
+
+        return self._parse_conditionally(f"/classifier/{classifier_id}/{model_id}", response, ModelInfo)
+
+    def _get_conditionally(self, url: str) -> requests.Response:
+        # Sends the ETag of the last response so that the server can answer with 304 if nothing changed
+        cached = self._conditional_cache.get(url)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        return self._session.get(url, headers=headers)
+
+    def _parse_conditionally(self, url: str, response: requests.Response, model_type: Any) -> Any:
+        if response.status_code == 304:
+            return self._conditional_cache[url][1]
+
+        result = model_type.parse_obj(response.json())
+        etag = response.headers.get("ETag")
+        if etag:
+            self._conditional_cache[url] = (etag, result)
+
+        return result
 
     # True: training has started. False: training has started already and function call had no effect
     def train_on_dataset(self, classifier_id: str, model_id: str, dataset_id: str) -> bool:
@@ -210,7 +337,22 @@ class GalahadClient:
 
         return True
 
-    def predict_on_document(self, classifier_id: str, model_id: str, document: Document) -> Document:
+    def predict_on_document(
+        self, classifier_id: str, model_id: str, document: Document, only_consumed_layers: bool = False
+    ) -> Document:
+        """Predicts annotations for `document` with the model `model_id` of the classifier `classifier_id`.
+
+        If `only_consumed_layers` is set, layers that the classifier does not consume are not sent, see
+        `ClassifierInfo.consumes`. The server drops them anyway, this only saves uploading them.
+        """
+        if only_consumed_layers:
+            consumed_layers = self.get_classifier_info(classifier_id).consumes
+            document = Document.construct(
+                text=document.text,
+                annotations=select_layers(document.annotations, consumed_layers),
+                version=document.version,
+            )
+
         response = self._session.post(
             f"{self.endpoint_url}/classifier/{classifier_id}/{model_id}/predict", json=document.dict()
         )
@@ -1,10 +1,10 @@
-import copy
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, List, Optional
 
-from galahad.server.annotations import Annotations
+from galahad.server.annotations import AnnotationRecord, Annotations
 from galahad.server.classifier import AnnotationFeatures, AnnotationTypes
 from galahad.server.dataclasses import Annotation, Document
+from galahad.server.metrics import timed
 
 
 @dataclass
@@ -14,6 +14,7 @@ class Span:
     value: str
 
 
+@timed("response")
 def build_sentence_classification_document(sentences: List[str], labels: List[str], version: int = 0) -> Document:
     assert len(sentences) == len(labels), "Sentences and labels need to have the same length!"
 
@@ -79,19 +80,18 @@ def build_span_classification_request(
     return document
 
 
+@timed("response")
 def build_span_classification_response(original_doc: Document, spans: List[Span] = None, version: int = 0) -> Document:
-    annotated_doc = copy.deepcopy(original_doc)
-    annotated_doc.version = version
-
     assert AnnotationTypes.TOKEN.value in original_doc.annotations
     assert AnnotationTypes.SENTENCE.value in original_doc.annotations
 
-    annotations = Annotations.from_dict(annotated_doc.text, annotated_doc.annotations)
+    annotations = Annotations.from_dict(original_doc.text, original_doc.annotations)
 
     sentences = annotations.select(AnnotationTypes.SENTENCE.value)
 
-    dummy_text_annotation = {"begin": sentences[0].begin, "end": sentences[-1].end}
-    all_tokens = annotations.select_covered(AnnotationTypes.TOKEN.value, Annotation(**dummy_text_annotation))
+    all_tokens = annotations.select_covered(
+        AnnotationTypes.TOKEN.value, AnnotationRecord(sentences[0].begin, sentences[-1].end)
+    )
     for span in spans:
         first_token = all_tokens[span.begin]
         last_token = all_tokens[span.end - 1]
@@ -103,41 +103,99 @@ def build_span_classification_response(original_doc: Document, spans: List[Span]
             {AnnotationFeatures.VALUE.value: span.value},
         )
 
-    annotated_doc.annotations = annotations.get_annotations()
-    return annotated_doc
+    return _build_response(original_doc, annotations, version)
 
 
-def build_doc_from_tokens_and_text(text: str, sentences: List[List[str]]) -> Document:
-    sentence_list = []
+def build_doc_from_tokens_and_text(
+    text: str,
+    sentences: List[List[str]],
+    version: int = 0,
+    allow_gaps: bool = True,
+    token_normalizer: Optional[Callable[[str], str]] = None,
+) -> Document:
+    """Builds a document with token and sentence annotations from `text` and its tokenization.
+
+    Tokens are aligned to `text` from left to right, each one is searched for after the end of the previous one.
+    Sentences span from the begin of their first to the end of their last token.
+
+    Args:
+        text: The text that was tokenized.
+        sentences: The tokens of `text`, grouped by sentence.
+        version: The version of the resulting document.
+        allow_gaps: Whether text that is not whitespace may be skipped between tokens, e.g. characters
+            that the tokenizer dropped. If `False`, only whitespace may be skipped.
+        token_normalizer: Maps a token to the form in which it appears in `text`, e.g. to undo
+            quote escaping of Penn Treebank tokenizers.
+
+    Returns:
+        The document containing `text` and the aligned token and sentence annotations.
+
+    Raises:
+        ValueError: If a token could not be found in `text`.
+    """
     token_list = []
+    sentence_list = []
+
+    find = text.find
     position = 0
-    subtext = text
-    sentence_start = 0
-    for sentence in sentences:
+    for sentence_idx, sentence in enumerate(sentences):
+        sentence_begin = None
 
-        for token in sentence:
-            start = subtext.find(token)
-            position = position + start
-            token_list.append(Annotation(**{"begin": position, "end": position + len(token), "features": {}}))
-            subtext = subtext[start + len(token) :]
-            position = position + len(token)
+        for token_idx, token in enumerate(sentence):
+            if token_normalizer is not None:
+                token = token_normalizer(token)
 
-        sentence_list.append(Annotation(**{"begin": sentence_start, "end": position, "features": {}}))
-        sentence_start = position + 1
+            begin = find(token, position)
+            if begin < 0:
+                raise ValueError(
+                    f"Token [{token}] (sentence {sentence_idx}, token {token_idx}) "
+                    f"not found in text after offset {position}: [{text[position : position + 50]}]"
+                )
 
-    doc = Document(text=text, annotations={"t.token": token_list, "t.sentence": sentence_list}, version=0)
-    return doc
+            if not allow_gaps and begin > position and not text[position:begin].isspace():
+                raise ValueError(
+                    f"Token [{token}] (sentence {sentence_idx}, token {token_idx}) "
+                    f"does not directly follow offset {position}, skipped [{text[position:begin]}]"
+                )
 
+            end = begin + len(token)
+            token_list.append(Annotation.construct(begin=begin, end=end, features={}))
 
-def build_token_labeling_response(original_doc: Document, labels: List[str] = None, version: int = 0) -> Document:
-    annotated_doc = copy.deepcopy(original_doc)
-    annotated_doc.version = version
+            if sentence_begin is None:
+                sentence_begin = begin
+            position = end
+
+        if sentence_begin is None:
+            sentence_begin = position
+        sentence_list.append(Annotation.construct(begin=sentence_begin, end=position, features={}))
+
+    annotations = {AnnotationTypes.TOKEN.value: token_list, AnnotationTypes.SENTENCE.value: sentence_list}
+    return Document.construct(text=text, annotations=annotations, version=version)
 
+
+def build_docs_from_tokens_and_texts(
+    texts: List[str],
+    tokenized_texts: List[List[List[str]]],
+    version: int = 0,
+    allow_gaps: bool = True,
+    token_normalizer: Optional[Callable[[str], str]] = None,
+) -> List[Document]:
+    """Builds documents for many texts and their tokenization at once, see `build_doc_from_tokens_and_text`."""
+    assert len(texts) == len(tokenized_texts), "Texts and tokenized texts need to have the same length!"
+
+    return [
+        build_doc_from_tokens_and_text(text, sentences, version, allow_gaps, token_normalizer)
+        for text, sentences in zip(texts, tokenized_texts)
+    ]
+
+
+@timed("response")
+def build_token_labeling_response(original_doc: Document, labels: List[str] = None, version: int = 0) -> Document:
     assert AnnotationTypes.TOKEN.value in original_doc.annotations
     assert AnnotationTypes.SENTENCE.value in original_doc.annotations
     assert len(original_doc.annotations["t.token"]) == len(labels)
 
-    annotations = Annotations.from_dict(annotated_doc.text, annotated_doc.annotations)
+    annotations = Annotations.from_dict(original_doc.text, original_doc.annotations)
 
     for token, label in zip(original_doc.annotations["t.token"], labels):
         annotations.create_annotation(
@@ -147,20 +205,17 @@ def build_token_labeling_response(original_doc: Document, labels: List[str] = No
             {AnnotationFeatures.VALUE.value: label},
         )
 
-    annotated_doc.annotations = annotations.get_annotations()
-    return annotated_doc
+    return _build_response(original_doc, annotations, version)
 
 
+@timed("response")
 def build_span_classification_response_per_sentence(
     original_doc: Document, spans: List[List[Span]] = None, version: int = 0
 ) -> Document:
-    annotated_doc = copy.deepcopy(original_doc)
-    annotated_doc.version = version
-
     assert AnnotationTypes.TOKEN.value in original_doc.annotations
     assert AnnotationTypes.SENTENCE.value in original_doc.annotations
 
-    annotations = Annotations.from_dict(annotated_doc.text, annotated_doc.annotations)
+    annotations = Annotations.from_dict(original_doc.text, original_doc.annotations)
 
     sentences = annotations.select(AnnotationTypes.SENTENCE.value)
     assert len(sentences) == len(spans)
@@ -179,5 +234,10 @@ def build_span_classification_response_per_sentence(
                 {AnnotationFeatures.VALUE.value: span.value},
             )
 
-    annotated_doc.annotations = annotations.get_annotations()
-    return annotated_doc
+    return _build_response(original_doc, annotations, version)
+
+
+def _build_response(original_doc: Document, annotations: Annotations, version: int) -> Document:
+    # The annotations of `original_doc` are only read, so the response can share them instead of deep copying the
+    # document. The new annotations are records and are converted to models here, where they leave the index.
+    return Document.construct(text=original_doc.text, annotations=annotations.get_annotations(), version=version)
@@ -1,34 +1,119 @@
+import bisect
+import sys
 from collections import defaultdict
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 from sortedcontainers import SortedKeyList
 
 from galahad.server.dataclasses import Annotation, Document
+from galahad.server.metrics import timed
+
+
+class FrozenFeatures(dict):
+    """Feature dict that cannot be changed, so that one instance can be shared by many annotations.
+
+    It is a real `dict`, so it is serialized and validated like the features of an `Annotation`.
+    """
+
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("The features of an annotation record cannot be changed")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _immutable
+
+    def __copy__(self) -> "FrozenFeatures":
+        return self
+
+    def __deepcopy__(self, memo) -> "FrozenFeatures":
+        return self
+
+    def __reduce__(self):
+        return FrozenFeatures, (dict(self),)
+
+
+# Shared by all annotations without features, which are the vast majority, e.g. tokens and sentences
+EMPTY_FEATURES = FrozenFeatures()
+
+
+class AnnotationRecord:
+    """Lightweight annotation as created by `Annotations`, converted to an `Annotation` only when returned via the API.
+
+    Records have no per-instance `__dict__` and share their features with other records that have the same ones.
+    """
+
+    __slots__ = ("begin", "end", "features")
+
+    def __init__(self, begin: int, end: int, features: FrozenFeatures = EMPTY_FEATURES):
+        self.begin = begin
+        self.end = end
+        self.features = features
+
+    def to_annotation(self) -> Annotation:
+        # Offsets and features were checked when the record was created, so the model does not need to be validated
+        return Annotation.construct(begin=self.begin, end=self.end, features=self.features)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (AnnotationRecord, Annotation)):
+            return self.begin == other.begin and self.end == other.end and self.features == other.features
+        if isinstance(other, dict):
+            return {"begin": self.begin, "end": self.end, "features": self.features} == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"AnnotationRecord(begin={self.begin}, end={self.end}, features={dict(self.features)})"
+
+
+AnyAnnotation = Union[Annotation, AnnotationRecord]
 
 
 class Annotations:
     def __init__(self, text: str):
         self._text = text
+        # Only read via `get` so that queries for types without annotations do not add empty layers
         self._index: Dict[str, SortedKeyList] = defaultdict(lambda: SortedKeyList(key=_sort_func))
+        # Built lazily on the first interval query for a type and dropped when an annotation of that type is added
+        self._interval_indices: Dict[str, _IntervalIndex] = {}
+        # Annotations by feature value for each indexed (type name, feature name), kept up to date on creation
+        self._feature_indices: Dict[Tuple[str, str], Dict[Any, SortedKeyList]] = {}
+        # Features of created annotations by their items, so that equal features are stored only once
+        self._interned_features: Dict[Tuple[Tuple[str, Any], ...], FrozenFeatures] = {}
 
     @staticmethod
-    def from_dict(text: str, annotations: Dict[str, List[Annotation]]) -> "Annotations":
+    def from_dict(
+        text: str,
+        annotations: Dict[str, List[Annotation]],
+        indexed_features: Optional[Dict[str, List[str]]] = None,
+    ) -> "Annotations":
+        """Creates annotations from layers of annotations by type name.
+
+        Args:
+            text: The text that is annotated.
+            annotations: The annotations by type name.
+            indexed_features: Feature names by type name for which to build a feature value index right away,
+                see `select_by_feature`.
+        """
         result = Annotations(text)
 
-        for type_name, annotations_for_type in annotations.items():
-            result._index[type_name].update(annotations_for_type)
+        with timed("index"):
+            for type_name, annotations_for_type in annotations.items():
+                # Sorting is linear for layers that are sorted already, like the ones INCEpTION sends
+                result._index[type_name] = SortedKeyList(annotations_for_type, key=_sort_func)
+
+            for type_name, feature_names in (indexed_features or {}).items():
+                for feature_name in feature_names:
+                    result.index_feature(type_name, feature_name)
 
         return result
 
     @staticmethod
     def from_document(document: Document) -> "Annotations":
-        result = Annotations(document.text)
-
-        for type_name, annotations in document.annotations.items():
-            for annotation in annotations:
-                result.create_annotation(type_name, annotation.begin, annotation.end, annotation.features)
+        """Creates annotations from the layers of `document`.
 
-        return result
+        Like `from_dict`, the index refers to the annotations of the document instead of copying them, they were
+        validated already when the document was parsed. Creating annotations does not change the document.
+        """
+        return Annotations.from_dict(document.text, document.annotations)
 
     def to_dict(self) -> Dict[str, List[Dict[str, Any]]]:
         result = defaultdict(list)
@@ -41,23 +126,33 @@ class Annotations:
         return result
 
     def get_annotations(self) -> Dict[str, List[Annotation]]:
-        return {type_name: list(annos) for type_name, annos in self._index.items()}
+        """Returns the annotations by type name as `Annotation` models, e.g. to put them into a `Document`."""
+        return {type_name: [_to_annotation(a) for a in annos] for type_name, annos in self._index.items()}
 
-    def create_annotation(self, type_name, begin: int, end: int, features: Dict[str, Any] = None) -> Annotation:
-        if features is None:
-            features = {}
+    def create_annotation(self, type_name, begin: int, end: int, features: Dict[str, Any] = None) -> AnnotationRecord:
+        """Creates an annotation of type `type_name` and adds it to the index.
 
-        annotation = Annotation(begin=begin, end=end, features=features)
+        The features are copied into an immutable dict that is shared with all annotations created with the same
+        features, their string keys and values are interned.
+        """
+        annotation = AnnotationRecord(int(begin), int(end), self._intern_features(features))
         self._index[type_name].add(annotation)
+        self._interval_indices.pop(type_name, None)
+
+        for (indexed_type_name, feature_name), feature_index in self._feature_indices.items():
+            value = annotation.features.get(feature_name)
+            if indexed_type_name == type_name and _is_indexable(value):
+                feature_index.setdefault(value, SortedKeyList(key=_sort_func)).add(annotation)
+
         return annotation
 
-    def get_covered_text(self, annotation: Annotation) -> str:
+    def get_covered_text(self, annotation: AnyAnnotation) -> str:
         return self._text[annotation.begin : annotation.end]
 
-    def select(self, type_name: str) -> List[Annotation]:
-        return list(self._index[type_name])
+    def select(self, type_name: str) -> List[AnyAnnotation]:
+        return list(self._index.get(type_name, ()))
 
-    def select_covered(self, type_name: str, covering_annotation: Annotation) -> List[Annotation]:
+    def select_covered(self, type_name: str, covering_annotation: AnyAnnotation) -> List[AnyAnnotation]:
         """Returns a list of covered annotations.
 
         Return all annotations that are covered
@@ -80,14 +175,150 @@ class Annotations:
                 result.append(annotation)
         return result
 
-    def _get_feature_structures_in_range(self, type_name: str, begin: int, end: int) -> List[Annotation]:
+    def select_covering(self, type_name: str, covered_annotation: AnyAnnotation) -> List[AnyAnnotation]:
+        """Returns all annotations of type `type_name` that fully cover `covered_annotation`, e.g. the sentence
+        of a token.
+
+        An annotation covers another one if it begins at or before and ends at or after it.
+        """
+        return self._get_interval_index(type_name).covering(covered_annotation.begin, covered_annotation.end)
+
+    def select_covering_many(
+        self, type_name: str, covered_annotations: Iterable[AnyAnnotation]
+    ) -> List[List[AnyAnnotation]]:
+        """Bulk version of `select_covering`, returns the covering annotations for each annotation in order."""
+        index = self._get_interval_index(type_name)
+        return [index.covering(a.begin, a.end) for a in covered_annotations]
+
+    def select_overlapping(self, type_name: str, annotation: AnyAnnotation) -> List[AnyAnnotation]:
+        """Returns all annotations of type `type_name` that share at least one character with `annotation`.
+
+        Annotations that only touch, e.g. one ends where the other begins, do not overlap. Empty annotations
+        therefore never overlap anything.
+        """
+        return self._get_interval_index(type_name).overlapping(annotation.begin, annotation.end)
+
+    def select_overlapping_many(
+        self, type_name: str, annotations: Iterable[AnyAnnotation]
+    ) -> List[List[AnyAnnotation]]:
+        """Bulk version of `select_overlapping`, returns the overlapping annotations for each annotation in order."""
+        index = self._get_interval_index(type_name)
+        return [index.overlapping(a.begin, a.end) for a in annotations]
+
+    def select_preceding(
+        self, type_name: str, annotation: AnyAnnotation, count: Optional[int] = None
+    ) -> List[AnyAnnotation]:
+        """Returns annotations of type `type_name` that end at or before the begin of `annotation`.
+
+        Args:
+            type_name: The type name of the annotations to be returned.
+            annotation: The annotation before which to look.
+            count: If given, only the `count` annotations that end closest to `annotation` are returned.
+
+        Returns:
+            The preceding annotations, sorted by offsets.
+        """
+        return self._get_interval_index(type_name).preceding(annotation.begin, count)
+
+    def select_preceding_many(
+        self, type_name: str, annotations: Iterable[AnyAnnotation], count: Optional[int] = None
+    ) -> List[List[AnyAnnotation]]:
+        """Bulk version of `select_preceding`, returns the preceding annotations for each annotation in order."""
+        index = self._get_interval_index(type_name)
+        return [index.preceding(a.begin, count) for a in annotations]
+
+    def select_following(
+        self, type_name: str, annotation: AnyAnnotation, count: Optional[int] = None
+    ) -> List[AnyAnnotation]:
+        """Returns annotations of type `type_name` that begin at or after the end of `annotation`.
+
+        Args:
+            type_name: The type name of the annotations to be returned.
+            annotation: The annotation after which to look.
+            count: If given, only the `count` annotations that begin closest to `annotation` are returned.
+
+        Returns:
+            The following annotations, sorted by offsets.
+        """
+        return self._get_interval_index(type_name).following(annotation.end, count)
+
+    def select_following_many(
+        self, type_name: str, annotations: Iterable[AnyAnnotation], count: Optional[int] = None
+    ) -> List[List[AnyAnnotation]]:
+        """Bulk version of `select_following`, returns the following annotations for each annotation in order."""
+        index = self._get_interval_index(type_name)
+        return [index.following(a.end, count) for a in annotations]
+
+    def index_feature(self, type_name: str, feature_name: str):
+        """Builds an index from the values of feature `feature_name` to the annotations of type `type_name`.
+
+        The index is kept up to date when creating annotations. Annotations without the feature or with a value
+        that is not hashable, e.g. a list, are not indexed. Indexing a feature twice does nothing.
+        """
+        key = (type_name, feature_name)
+        if key in self._feature_indices:
+            return
+
+        annotations_by_value = defaultdict(list)
+        for annotation in self._index.get(type_name, ()):
+            value = annotation.features.get(feature_name)
+            if _is_indexable(value):
+                annotations_by_value[value].append(annotation)
+
+        # The layer is sorted already, so sorting the annotations of each value again only takes linear time
+        self._feature_indices[key] = {
+            value: SortedKeyList(annotations, key=_sort_func) for value, annotations in annotations_by_value.items()
+        }
+
+    def select_by_feature(self, type_name: str, feature_name: str, value: Any) -> List[AnyAnnotation]:
+        """Returns all annotations of type `type_name` whose feature `feature_name` has `value`, sorted by offsets.
+
+        The feature is indexed on first use, see `index_feature`, later queries take time linear in the number
+        of results.
+        """
+        self.index_feature(type_name, feature_name)
+        return list(self._feature_indices[type_name, feature_name].get(value, []))
+
+    def count_feature_values(self, type_name: str, feature_name: str) -> Dict[Any, int]:
+        """Returns how many annotations of type `type_name` have each value of feature `feature_name`."""
+        self.index_feature(type_name, feature_name)
+        return {
+            value: len(annotations) for value, annotations in self._feature_indices[type_name, feature_name].items()
+        }
+
+    def _intern_features(self, features: Optional[Dict[str, Any]]) -> FrozenFeatures:
+        if not features:
+            return EMPTY_FEATURES
+
+        items = tuple((_intern(key), _intern(value)) for key, value in features.items())
+        try:
+            interned = self._interned_features.get(items)
+        except TypeError:
+            # Unhashable values like lists cannot be looked up, such features are not shared
+            return FrozenFeatures(items)
+
+        if interned is None:
+            interned = FrozenFeatures(items)
+            self._interned_features[items] = interned
+        return interned
+
+    def _get_interval_index(self, type_name: str) -> "_IntervalIndex":
+        index = self._interval_indices.get(type_name)
+        if index is None:
+            index = _IntervalIndex(self._index.get(type_name, []))
+            self._interval_indices[type_name] = index
+        return index
+
+    def _get_feature_structures_in_range(self, type_name: str, begin: int, end: int) -> List[AnyAnnotation]:
         """Returns a list of all feature structures of type `type_name`.
 
         Only features are returned that are in [begin, end] or close to it. If you use this function,
         you should always check bound in the calling method.
         """
 
-        annotations = self._index[type_name]
+        annotations = self._index.get(type_name)
+        if annotations is None:
+            return []
 
         # We use binary search to find indices for the first and last annotations that are inside
         # the window of [begin, end].
@@ -101,5 +332,100 @@ class Annotations:
         return self._text
 
 
-def _sort_func(a: Annotation) -> Tuple[int, int]:
+def _sort_func(a: AnyAnnotation) -> Tuple[int, int]:
     return a.begin, a.end
+
+
+def _to_annotation(annotation: AnyAnnotation) -> Annotation:
+    if isinstance(annotation, AnnotationRecord):
+        return annotation.to_annotation()
+    return annotation
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+
+def _is_indexable(value: Any) -> bool:
+    if value is None:
+        return False
+
+    try:
+        hash(value)
+    except TypeError:
+        return False
+
+    return True
+
+
+class _IntervalIndex:
+    """Static index over the annotations of one type for interval queries.
+
+    Annotations are kept sorted by (begin, end). A binary search on the begins cuts off the annotations that begin
+    after the query, and a segment tree holding the maximum end of each range of annotations prunes the ranges in
+    which no annotation reaches far enough. Queries for covering and overlapping annotations therefore take
+    `O((k + 1) log n)` time for `k` results, also for nested and overlapping layers, e.g. a long annotation that
+    covers all others. A second order by end answers queries for preceding annotations.
+    """
+
+    def __init__(self, annotations: Iterable[AnyAnnotation]):
+        self._annotations = list(annotations)
+        self._begins = [a.begin for a in self._annotations]
+
+        # Implicit binary tree over the positions, node `i` has the children `2i` and `2i + 1`, the leaves start at
+        # `self._size`. Leaves without an annotation have an end of -1 so that they are never reached.
+        self._size = 1
+        while self._size < len(self._annotations):
+            self._size *= 2
+        self._max_ends = [-1] * (2 * self._size)
+        self._max_ends[self._size : self._size + len(self._annotations)] = [a.end for a in self._annotations]
+        for node in range(self._size - 1, 0, -1):
+            self._max_ends[node] = max(self._max_ends[2 * node], self._max_ends[2 * node + 1])
+
+        self._by_end = sorted(range(len(self._annotations)), key=lambda i: self._annotations[i].end)
+        self._ends = [self._annotations[i].end for i in self._by_end]
+
+    def covering(self, begin: int, end: int) -> List[AnyAnnotation]:
+        hi = bisect.bisect_right(self._begins, begin)
+        return [self._annotations[i] for i in self._reaching(hi, end)]
+
+    def overlapping(self, begin: int, end: int) -> List[AnyAnnotation]:
+        if begin >= end:
+            return []
+
+        hi = bisect.bisect_left(self._begins, end)
+        return [a for a in (self._annotations[i] for i in self._reaching(hi, begin + 1)) if a.begin < a.end]
+
+    def _reaching(self, hi: int, min_end: int) -> List[int]:
+        """Returns the positions before `hi` whose annotations end at or after `min_end`, in ascending order."""
+        max_ends = self._max_ends
+        size = self._size
+
+        result = []
+        # Nodes as (node, first position, position after the last one), the left child is visited first
+        stack = [(1, 0, size)]
+        while stack:
+            node, lo, node_hi = stack.pop()
+            if lo >= hi or max_ends[node] < min_end:
+                continue
+
+            if node >= size:
+                result.append(node - size)
+                continue
+
+            mid = (lo + node_hi) // 2
+            stack.append((2 * node + 1, mid, node_hi))
+            stack.append((2 * node, lo, mid))
+
+        return result
+
+    def preceding(self, begin: int, count: Optional[int] = None) -> List[AnyAnnotation]:
+        hi = bisect.bisect_right(self._ends, begin)
+        lo = 0 if count is None else max(hi - count, 0)
+        # Positions in offset order are the positions in the index, so sorting them restores the offset order
+        return [self._annotations[i] for i in sorted(self._by_end[lo:hi])]
+
+    def following(self, end: int, count: Optional[int] = None) -> List[AnyAnnotation]:
+        lo = bisect.bisect_left(self._begins, end)
+        hi = len(self._annotations) if count is None else lo + count
+        return self._annotations[lo:hi]
@@ -1,13 +1,27 @@
+import copy
+import itertools
+import json
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
 from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from time import perf_counter
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, Tuple)
 
 import joblib
 from filelock import FileLock
 
-from galahad.server.dataclasses import ClassifierInfo, Document
+from galahad.server.dataclasses import (ClassifierInfo, Document, ModelInfo,
+                                        ResidentModel, ResidentModelList)
+from galahad.server.util import SingleFlight
 
 logger = logging.getLogger(__file__)
 
@@ -22,6 +36,17 @@ class AnnotationFeatures(Enum):
     VALUE = "f.value"
 
 
+class ModelPersistence(Enum):
+    """How models are written to and read from disk."""
+
+    # Plain joblib pickle, every process that loads the model gets its own copy
+    DEFAULT = "default"
+    # Uncompressed, NumPy arrays are memory mapped read-only when loading so that processes share pages
+    MMAP = "mmap"
+    # Compressed, smallest on disk but slowest to load, meant for rarely used models
+    COMPRESSED = "compressed"
+
+
 class Remapper:
     def __init__(self, remaps: Dict[str, str] = None):
         if remaps is None:
@@ -34,16 +59,51 @@ class Remapper:
 
 
 class Classifier:
-    def __init__(self):
+    def __init__(self, persistence: ModelPersistence = ModelPersistence.DEFAULT, compression_level: int = 3):
+        """Creates a classifier.
+
+        Args:
+            persistence: How models of this classifier are saved and loaded.
+            compression_level: The zlib compression level used with `ModelPersistence.COMPRESSED`.
+        """
+        self._persistence = persistence
+        self._compression_level = compression_level
+        # Set when adding the classifier to a store, models and locks are namespaced by it
+        self._name: Optional[str] = None
         self._model_directory: Optional[Path] = None
+        self._model_cache: Optional["ModelCache"] = None
+        # Set while training, a folder for data derived from the training dataset that can be reused by retraining
+        self._dataset_cache_directory: Optional[Path] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Classifiers are sent to worker processes for training, the model cache stays in the server process
+        state = self.__dict__.copy()
+        state["_model_cache"] = None
+        return state
+
+    def train(self, model_id: str, documents: Iterable[Document]):
+        """Trains the model `model_id` on `documents`.
 
-    def train(self, model_id: str, documents: List[Document]):
+        `documents` can be a lazy iterator that parses documents while they are consumed, so it can only be
+        iterated once. Classifiers that need several passes have to materialize it first, e.g. via `list`.
+        """
         pass
 
     def predict(self, model_id: str, document: Document) -> Optional[Document]:
         raise NotImplementedError()
 
+    def predict_batch(self, model_id: str, documents: List[Document]) -> List[Optional[Document]]:
+        """Predicts many documents at once, e.g. to precompute predictions after training.
+
+        Classifiers that can run inference on batches more efficiently than document by document should override this.
+        """
+        return [self.predict(model_id, document) for document in documents]
+
     def consumes(self) -> List[str]:
+        """Returns the type names of the layers that `predict` reads, other layers are dropped from requests.
+
+        An empty list means that the classifier reads all layers.
+        """
         return []
 
     def produces(self) -> List[str]:
@@ -56,37 +116,325 @@ class Classifier:
         model_path.parent.mkdir(parents=True, exist_ok=True)
 
         tmp_model_path = model_path.with_suffix(".joblib.tmp")
-        joblib.dump(model, tmp_model_path)
+        if self._persistence == ModelPersistence.COMPRESSED:
+            joblib.dump(model, tmp_model_path, compress=("zlib", self._compression_level))
+        else:
+            # Arrays need to be stored uncompressed to be memory mapped later on
+            joblib.dump(model, tmp_model_path, compress=0)
+
+        previous_metadata = self._get_model_metadata(model_id)
+        metadata = ModelMetadata(
+            generation=previous_metadata.generation + 1 if previous_metadata else 1,
+            trained_at=time.time(),
+            size=tmp_model_path.stat().st_size,
+        )
 
         os.replace(tmp_model_path, model_path)
+        self._write_model_metadata(model_id, metadata)
 
     def _load_model(self, model_id: str) -> Optional[Any]:
         model_path = self._get_model_path(model_id)
-        if model_path.is_file():
-            logger.debug("Model found for [%s]", model_path)
-            return joblib.load(model_path)
-        else:
+
+        try:
+            stat = model_path.stat()
+        except FileNotFoundError:
             logger.debug("No model found for [%s]", model_path)
             return None
 
+        # The modification time and size identify the model file version, a retrained model invalidates the cache
+        # unless the store is still preloading it, then the resident version is served until the new one is swapped in
+        key = (self.name, model_id)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        if self._model_cache is not None:
+            return self._model_cache.get_or_load(key, stamp, lambda: self._read_model(model_id, stat))
+
+        return self._read_model(model_id, stat)
+
+    def _preload_model(self, model_id: str) -> bool:
+        """Loads the current version of a model from disk and swaps it into the model cache in one step.
+
+        Requests that still use the previous version keep their reference to it, it is released once they finished.
+
+        Returns:
+            Whether a model was found and loaded.
+        """
+        try:
+            stat = self._get_model_path(model_id).stat()
+        except FileNotFoundError:
+            return False
+
+        self._read_model(model_id, stat)
+        return True
+
+    def _read_model(self, model_id: str, stat: os.stat_result) -> Any:
+        model_path = self._get_model_path(model_id)
+
+        logger.debug("Model found for [%s]", model_path)
+        mmap_mode = "r" if self._persistence == ModelPersistence.MMAP else None
+        model = joblib.load(model_path, mmap_mode=mmap_mode)
+
+        if self._model_cache is not None:
+            metadata = self._get_model_metadata(model_id)
+            generation = metadata.generation if metadata else 0
+            self._model_cache.put(
+                (self.name, model_id), model, stat.st_size, (stat.st_mtime_ns, stat.st_size), generation
+            )
+
+        return model
+
+    def _get_model_metadata(self, model_id: str) -> Optional["ModelMetadata"]:
+        """Returns the metadata saved with a model, or `None` if there is no model or it predates metadata."""
+        try:
+            data = json.loads(self._get_model_metadata_path(model_id).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+
+        return ModelMetadata(**data)
+
+    def _write_model_metadata(self, model_id: str, metadata: "ModelMetadata"):
+        metadata_path = self._get_model_metadata_path(model_id)
+        tmp_metadata_path = metadata_path.with_suffix(".json.tmp")
+        tmp_metadata_path.write_text(json.dumps(asdict(metadata)), encoding="utf-8")
+        os.replace(tmp_metadata_path, metadata_path)
+
+    def _get_model_ids(self) -> List[str]:
+        """Returns the ids of all models of this classifier that were saved with metadata, sorted."""
+        prefix, suffix = "model_", ".meta.json"
+        model_folder = self._model_directory / self.name
+
+        if not model_folder.is_dir():
+            return []
+
+        return sorted(p.name[len(prefix) : -len(suffix)] for p in model_folder.glob(f"{prefix}*{suffix}"))
+
     def _get_model_path(self, model_id: str) -> Path:
         return self._model_directory / self.name / f"model_{model_id}.joblib"
 
+    def _get_model_metadata_path(self, model_id: str) -> Path:
+        return self._model_directory / self.name / f"model_{model_id}.meta.json"
+
     @property
     def name(self) -> str:
-        return type(self).__name__
+        """The name under which this classifier was registered, or its class name if it was not registered yet."""
+        return self._name or type(self).__name__
+
+
+@dataclass
+class ModelMetadata:
+    """Saved next to every model. The model file is replaced before its metadata, so a reader that races a save
+    may see the new model with the previous metadata, but never metadata of a model that is not there yet."""
+
+    generation: int  # Incremented every time the model is saved
+    trained_at: float  # Unix timestamp of when the model was saved
+    size: int = 0  # Size of the model file in bytes
+    # Only known when training through `train_classifier`
+    training_duration: Optional[float] = None
+    document_count: Optional[int] = None
+
+
+@dataclass
+class _CachedModel:
+    model: Any
+    size: int
+    stamp: Tuple[int, int]
+    generation: int
+    last_used: float
+
+
+class ModelCache:
+    """Keeps loaded models resident in memory, bounded by a memory budget and an idle timeout.
+
+    Models are keyed by classifier name and model id. The size of a model is accounted as the size of its
+    serialized file, which is a cheap estimate of the memory it occupies once loaded. When the budget is
+    exceeded, the least recently used models are evicted first. Evicted models are loaded again from disk
+    the next time they are requested.
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None, idle_timeout: Optional[float] = None):
+        """Creates a model cache.
+
+        Args:
+            memory_budget: Maximum total size in bytes of resident models, `None` for no limit.
+            idle_timeout: Seconds after which a model that was not used is evicted, `None` to keep models forever.
+        """
+        self._memory_budget = memory_budget
+        self._idle_timeout = idle_timeout
+        self._entries: "OrderedDict[Tuple[str, str], _CachedModel]" = OrderedDict()
+        self._total_size = 0
+        # Number of hits, misses and evictions per (classifier name, event)
+        self._statistics: Dict[Tuple[str, str], int] = defaultdict(int)
+        # Number of running updates per key, see `begin_update`
+        self._updating: Dict[Tuple[str, str], int] = defaultdict(int)
+        # Loads of models that are not resident, by key and model file stamp
+        self._loads = SingleFlight()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str], stamp: Tuple[int, int]) -> Optional[Any]:
+        """Returns the cached model for `key` if it is resident and still matches the model file `stamp`.
+
+        While `key` is being updated, the resident model is returned even if the model file changed already.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.stamp != stamp and self._updating.get(key):
+                self._statistics[key[0], "stale_hit"] += 1
+                entry.last_used = time.monotonic()
+                self._entries.move_to_end(key)
+                return entry.model
+
+            if entry is None or entry.stamp != stamp:
+                self._remove(key)
+                self._statistics[key[0], "miss"] += 1
+                return None
+
+            self._statistics[key[0], "hit"] += 1
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry.model
+
+    def get_or_load(self, key: Tuple[str, str], stamp: Tuple[int, int], load: Callable[[], Any]) -> Any:
+        """Returns the cached model for `key` like `get`, or the model returned by `load` if it is not resident.
+
+        Concurrent calls for the same model file share one call to `load`, so that a model is never read several
+        times at once. `load` is expected to make the model resident via `put`.
+        """
+        model = self.get(key, stamp)
+        if model is not None:
+            return model
+
+        model, shared = self._loads.do((key, stamp), load)
+        if shared:
+            with self._lock:
+                self._statistics[key[0], "shared_load"] += 1
+
+        return model
+
+    def put(self, key: Tuple[str, str], model: Any, size: int, stamp: Tuple[int, int], generation: int = 0):
+        """Makes `model` resident under `key`, replacing the previous version in one step, and evicts other models
+        until the memory budget is met again."""
+        with self._lock:
+            self._remove(key)
+
+            if self._memory_budget is not None and size > self._memory_budget:
+                logger.info("Model [%s] with size [%d] exceeds the memory budget, not caching it", key, size)
+                return
+
+            self._entries[key] = _CachedModel(
+                model=model, size=size, stamp=stamp, generation=generation, last_used=time.monotonic()
+            )
+            self._total_size += size
+
+            while self._memory_budget is not None and self._total_size > self._memory_budget:
+                oldest_key = next(iter(self._entries))
+                logger.debug("Evicting model [%s] to stay within memory budget", oldest_key)
+                self._remove(oldest_key, evicted=True)
+
+    def evict(self, key: Tuple[str, str]):
+        with self._lock:
+            self._remove(key, evicted=True)
+
+    def begin_update(self, key: Tuple[str, str]):
+        """Marks `key` as being updated, e.g. retrained, until `end_update` is called.
+
+        Meanwhile, `get` keeps returning the resident version so that requests do not wait for the new one to load.
+        """
+        with self._lock:
+            self._updating[key] += 1
+
+    def end_update(self, key: Tuple[str, str]):
+        with self._lock:
+            self._updating[key] -= 1
+            if self._updating[key] <= 0:
+                del self._updating[key]
+
+    def get_generation(self, key: Tuple[str, str]) -> Optional[int]:
+        """Returns the generation of the resident model for `key`, or `None` if it is not resident."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.generation if entry is not None else None
+
+    def evict_idle(self) -> int:
+        """Evicts all models that were not used for longer than the idle timeout.
+
+        Returns:
+            The number of evicted models.
+        """
+        if self._idle_timeout is None:
+            return 0
+
+        deadline = time.monotonic() - self._idle_timeout
+        with self._lock:
+            idle_keys = [key for key, entry in self._entries.items() if entry.last_used < deadline]
+            for key in idle_keys:
+                logger.debug("Evicting idle model [%s]", key)
+                self._remove(key, evicted=True)
+
+        return len(idle_keys)
+
+    def get_resident_models(self) -> List[ResidentModel]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                ResidentModel(
+                    classifier_name=name,
+                    model_id=model_id,
+                    generation=entry.generation,
+                    size=entry.size,
+                    idle=now - entry.last_used,
+                )
+                for (name, model_id), entry in self._entries.items()
+            ]
+
+    def get_statistics(self) -> Dict[Tuple[str, str], int]:
+        """Returns the number of hits, stale hits, misses, shared loads and evictions keyed by (classifier name, event)."""
+        with self._lock:
+            return dict(self._statistics)
+
+    def _remove(self, key: Tuple[str, str], evicted: bool = False):
+        # Only removals to free memory count as evictions, not replacing a model by a newer version of it
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_size -= entry.size
+            if evicted:
+                self._statistics[key[0], "eviction"] += 1
+
+    @property
+    def memory_budget(self) -> Optional[int]:
+        return self._memory_budget
+
+    @property
+    def idle_timeout(self) -> Optional[float]:
+        return self._idle_timeout
+
+    @property
+    def total_size(self) -> int:
+        return self._total_size
 
 
 class ClassifierStore:
-    def __init__(self, model_directory: Path):
+    def __init__(
+        self, model_directory: Path, memory_budget: Optional[int] = None, idle_timeout: Optional[float] = None
+    ):
         self._model_directory = model_directory
+        self._model_cache = ModelCache(memory_budget, idle_timeout)
         self._classifiers: Dict[str, Classifier] = {}
+        # Model infos by metadata path together with the stamp of the metadata file they were read from
+        self._model_infos: Dict[Path, Tuple[Tuple[int, int], ModelInfo]] = {}
+        self._model_infos_lock = threading.Lock()
 
     def add_classifier(self, name: str, classifier: Classifier):
         if name in self._classifiers:
             raise ValueError(f"Model [{name}] already in classifier store!")
 
+        # Every registered name gets its own model namespace. If the same instance is registered twice,
+        # the second registration gets a shallow copy that shares the loaded resources but not the name.
+        if classifier._name is not None:
+            classifier = copy.copy(classifier)
+
+        classifier._name = name
         classifier._model_directory = self._model_directory
+        classifier._model_cache = self._model_cache
         self._classifiers[name] = classifier
 
     def get_classifier(self, name: str) -> Optional[Classifier]:
@@ -105,7 +453,10 @@ class ClassifierStore:
         if not classifier:
             return None
 
-        return ClassifierInfo(name=name)
+        models = [self._get_model_info(classifier, model_id) for model_id in classifier._get_model_ids()]
+        return ClassifierInfo(
+            name=name, consumes=classifier.consumes(), models=[info for info in models if info is not None]
+        )
 
     def get_classifier_infos(self) -> List[ClassifierInfo]:
         """Builds classifier infos for all classifiers in this store and returns it.
@@ -115,21 +466,191 @@ class ClassifierStore:
         """
         return [self.get_classifier_info(name) for name in sorted(self._classifiers.keys())]
 
+    def get_model_info(self, name: str, model_id: str) -> Optional[ModelInfo]:
+        """Returns the info of a trained model, or `None` if the classifier or model was not found.
+
+        Infos are cached and only read again from disk when the model metadata changed.
+        """
+        classifier = self._classifiers.get(name)
+        if not classifier:
+            return None
+
+        return self._get_model_info(classifier, model_id)
+
+    def _get_model_info(self, classifier: Classifier, model_id: str) -> Optional[ModelInfo]:
+        metadata_path = classifier._get_model_metadata_path(model_id)
+
+        try:
+            stat = metadata_path.stat()
+        except FileNotFoundError:
+            return None
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._model_infos_lock:
+            cached = self._model_infos.get(metadata_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        metadata = classifier._get_model_metadata(model_id)
+        if metadata is None:
+            return None
+
+        info = ModelInfo(model_id=model_id, **asdict(metadata))
+        with self._model_infos_lock:
+            self._model_infos[metadata_path] = (stamp, info)
+
+        return info
+
+    def get_resident_models(self) -> ResidentModelList:
+        """Lists the models that are currently loaded in memory, least recently used first."""
+        return ResidentModelList(
+            models=self._model_cache.get_resident_models(),
+            total_size=self._model_cache.total_size,
+            memory_budget=self._model_cache.memory_budget,
+        )
+
+    def evict_idle_models(self) -> int:
+        return self._model_cache.evict_idle()
+
+    @contextmanager
+    def updating_model(self, name: str, model_id: str):
+        """Keeps serving the resident version of a model while a new version is trained and preloaded."""
+        key = (name, model_id)
+        self._model_cache.begin_update(key)
+        try:
+            yield
+        finally:
+            self._model_cache.end_update(key)
+
+    def preload_model(self, name: str, model_id: str) -> bool:
+        """Loads the latest version of a model and swaps it in for the resident version.
+
+        Returns:
+            Whether the classifier and model were found.
+        """
+        classifier = self._classifiers.get(name)
+        if classifier is None:
+            return False
+
+        return classifier._preload_model(model_id)
+
+    @property
+    def model_cache(self) -> ModelCache:
+        return self._model_cache
+
+
+@dataclass
+class TrainingResult:
+    model_id: str
+    duration: float  # Seconds spent loading the dataset and training
+    document_count: int
 
-def train_classifier(classifier: Classifier, dataset_folder: Path, model_id: str, lock_directory: Path):
-    lock = get_lock(lock_directory, model_id)
+
+def train_classifier(
+    classifier: Classifier,
+    dataset_folder: Path,
+    model_id: str,
+    lock_directory: Path,
+    loader_workers: int = 0,
+    loader_processes: bool = False,
+    cache_directory: Optional[Path] = None,
+) -> Optional[TrainingResult]:
+    """Trains `classifier` on all documents in `dataset_folder`.
+
+    Documents are streamed to the classifier while they are parsed, see `iter_documents`. If `cache_directory` is
+    given, the classifier can keep data derived from the dataset in `cache_directory/{dataset id}/{classifier name}`.
+
+    Returns:
+        Statistics about the training run, or `None` if the model was already being trained or the dataset is gone.
+    """
+    # Different classifiers can train models for the same model id at the same time
+    lock = get_lock(lock_directory / classifier.name, model_id)
 
     try:
         lock.acquire()
-
-        documents = [Document.parse_file(p) for p in sorted(dataset_folder.iterdir())]
-        classifier.train(model_id, documents)
     except TimeoutError:
         logger.info("Already training [%s] with model id [%s], skipping!", classifier.name, model_id)
+        return None
+
+    try:
+        start = perf_counter()
+        if cache_directory is not None:
+            classifier._dataset_cache_directory = cache_directory / dataset_folder.name / classifier.name
+
+        try:
+            paths = sorted(dataset_folder.iterdir())
+        except FileNotFoundError:
+            logger.info("Dataset [%s] was deleted before training [%s], skipping!", dataset_folder.name, model_id)
+            return None
+
+        document_count = 0
+
+        def count(documents: Iterator[Document]) -> Iterator[Document]:
+            nonlocal document_count
+            for document in documents:
+                document_count += 1
+                yield document
+
+        previous_metadata = classifier._get_model_metadata(model_id)
+        classifier.train(model_id, count(iter_documents(paths, loader_workers, loader_processes)))
+        result = TrainingResult(model_id=model_id, duration=perf_counter() - start, document_count=document_count)
+
+        # Only annotate the metadata if the classifier actually saved a new model
+        metadata = classifier._get_model_metadata(model_id)
+        if metadata is not None and metadata != previous_metadata:
+            metadata.training_duration = result.duration
+            metadata.document_count = result.document_count
+            classifier._write_model_metadata(model_id, metadata)
+
+        return result
     finally:
         lock.release()
 
 
+def iter_documents(
+    paths: Sequence[Path], workers: int = 0, processes: bool = False, prefetch: Optional[int] = None
+) -> Iterator[Document]:
+    """Parses the documents at `paths` lazily and yields them in order.
+
+    Args:
+        paths: The paths of the documents to parse.
+        workers: How many threads or processes parse documents ahead of the consumer, `0` to parse them one by one
+            when they are requested.
+        processes: Whether to parse in processes instead of threads. Parsing is CPU bound, so processes scale
+            better, but every document is pickled once more to send it back.
+        prefetch: How many documents are parsed ahead at most, defaults to twice the number of workers.
+            This bounds the number of parsed documents that are held in memory at the same time.
+    """
+    if workers <= 0 or len(paths) <= 1:
+        for path in paths:
+            yield Document.parse_file(path)
+        return
+
+    prefetch = max(prefetch or 2 * workers, 1)
+    executor_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+    with executor_type(max_workers=workers) as executor:
+        yield from _iter_parsed(executor, paths, prefetch)
+
+
+def _iter_parsed(executor: Executor, paths: Sequence[Path], prefetch: int) -> Iterator[Document]:
+    remaining = iter(paths)
+    pending = deque(executor.submit(Document.parse_file, path) for path in itertools.islice(remaining, prefetch))
+
+    try:
+        while pending:
+            document = pending.popleft().result()
+
+            # Only parse the next document once one was handed out to keep at most `prefetch` in memory
+            for path in itertools.islice(remaining, 1):
+                pending.append(executor.submit(Document.parse_file, path))
+
+            yield document
+    finally:
+        for future in pending:
+            future.cancel()
+
+
 def get_lock(lock_directory: Path, lock_id: str) -> FileLock:
     lock_directory.mkdir(parents=True, exist_ok=True)
     lock_path = lock_directory / f"{lock_id}.lock"
@@ -0,0 +1,110 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import scipy.sparse as sp
+    from sklearn.feature_extraction.text import HashingVectorizer
+except ImportError as error:
+    print("Could not import 'sklearn', please install it manually via 'pip install scikit-learn'")
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 16
+
+
+class HashedFeatureCache:
+    """Caches hashed term counts of texts on disk so that retraining only featurizes new texts.
+
+    Rows are keyed by a hash of their text and stored as one sparse matrix in `directory`. As the hashing
+    vectorizer has no vocabulary, rows stay valid no matter which other texts are in the corpus. The cache only
+    keeps the rows of the texts it was last asked for, so it does not grow beyond the size of its dataset.
+    """
+
+    FILE_NAME = "features.npz"
+
+    def __init__(self, directory: Optional[Path], n_features: int = 2**18):
+        """Creates a feature cache.
+
+        Args:
+            directory: The folder in which the features are stored, `None` to featurize without caching.
+            n_features: The number of hashed features, cached rows are discarded if this changes.
+        """
+        self._directory = directory
+        self._n_features = n_features
+
+    def create_vectorizer(self) -> "HashingVectorizer":
+        """Returns the vectorizer whose output is cached, e.g. to featurize texts at prediction time."""
+        return HashingVectorizer(n_features=self._n_features, alternate_sign=False, norm=None)
+
+    def transform(self, texts: List[str]) -> "sp.csr_matrix":
+        """Returns the hashed term counts of `texts` as rows of a sparse matrix, featurizing only uncached texts."""
+        if self._directory is None:
+            return self.create_vectorizer().transform(texts)
+
+        keys = [hashlib.blake2b(text.encode("utf-8"), digest_size=DIGEST_SIZE).digest() for text in texts]
+        cached_keys, cached_features = self._load()
+        cached_rows = {key: row for row, key in enumerate(cached_keys)}
+
+        # Each distinct text is featurized at most once, even if it occurs many times
+        new_texts: Dict[bytes, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in cached_rows and key not in new_texts:
+                new_texts[key] = text
+
+        if new_texts:
+            new_features = self.create_vectorizer().transform(list(new_texts.values()))
+            for row, key in enumerate(new_texts, start=len(cached_keys)):
+                cached_rows[key] = row
+            all_features = sp.vstack([cached_features, new_features], format="csr")
+        else:
+            all_features = cached_features
+
+        logger.debug("Featurized [%d] of [%d] texts, the rest was cached", len(new_texts), len(texts))
+
+        # Only the rows used now are kept, the rows of texts that were changed or deleted are dropped
+        used_keys = list(dict.fromkeys(keys))
+        used_features = all_features[[cached_rows[key] for key in used_keys]]
+        self._save(used_keys, used_features)
+
+        used_rows = {key: row for row, key in enumerate(used_keys)}
+        return used_features[[used_rows[key] for key in keys]]
+
+    def _load(self):
+        path = self._directory / self.FILE_NAME
+        empty = ([], sp.csr_matrix((0, self._n_features), dtype=np.float64))
+
+        if not path.is_file():
+            return empty
+
+        with np.load(path) as data:
+            shape = tuple(data["shape"])
+            if shape[1] != self._n_features:
+                logger.info("Discarding feature cache [%s] with [%d] features", path, shape[1])
+                return empty
+
+            features = sp.csr_matrix((data["data"], data["indices"], data["indptr"]), shape=shape)
+            keys = [key.tobytes() for key in data["keys"]]
+
+        return keys, features
+
+    def _save(self, keys: List[bytes], features: "sp.csr_matrix"):
+        self._directory.mkdir(parents=True, exist_ok=True)
+        path = self._directory / self.FILE_NAME
+
+        # Written to a temporary file first so that concurrent trainings never read a partially written cache
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp_path.open("wb") as f:
+            np.savez(
+                f,
+                data=features.data,
+                indices=features.indices,
+                indptr=features.indptr,
+                shape=np.array(features.shape),
+                keys=np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(-1, DIGEST_SIZE),
+            )
+        os.replace(tmp_path, path)
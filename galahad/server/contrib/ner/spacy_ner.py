@@ -1,33 +1,124 @@
-from typing import Optional
+from typing import Iterator, List, Optional
 
 try:
     import spacy as spacy
-    from spacy.tokens import Doc
 except ImportError as error:
     print("Could not import 'spacy', please install it manually via 'pip install spacy'")
 
 from galahad.formats import Span, build_span_classification_response
-from galahad.server.annotations import Annotations
 from galahad.server.classifier import (AnnotationFeatures, AnnotationTypes,
                                        Classifier)
+from galahad.server.contrib.spacy_utils import (SentenceCache, TokenWindow,
+                                                document_to_spacy_doc,
+                                                get_prediction_cache_prefix,
+                                                get_window_key,
+                                                iter_sentence_windows,
+                                                tokens_to_spacy_doc)
+from galahad.server.contrib.utils import sort_by_offsets
 from galahad.server.dataclasses import Document
 
 
 class SpacyNerTagger(Classifier):
-    def __init__(self, model_name: str):
+    def __init__(
+        self,
+        model_name: str,
+        chunk_size: Optional[int] = None,
+        chunk_overlap: int = 0,
+        batch_size: int = 16,
+        incremental: bool = False,
+        cache_size: int = 100_000,
+    ):
+        """Creates a named entity tagger using a pre-trained spaCy model.
+
+        Args:
+            model_name: The name of the spaCy model to load.
+            chunk_size: If set, documents are tagged in windows of this many sentences instead of as a whole,
+                which bounds the memory needed for very long documents.
+            chunk_overlap: How many sentences of context are added on both sides of each window.
+            batch_size: How many windows are tagged at once.
+            incremental: Whether to cache the entities of each window, so that only windows that changed since
+                an earlier request are tagged again. Windows are single sentences unless `chunk_size` is set.
+            cache_size: How many windows are cached in incremental mode.
+        """
         super().__init__()
 
         self._token_type = AnnotationTypes.TOKEN.value
+        self._sentence_type = AnnotationTypes.SENTENCE.value
         self._target_feature = AnnotationFeatures.VALUE.value
 
+        self._chunk_size = chunk_size
+        self._chunk_overlap = chunk_overlap
+        self._batch_size = batch_size
+        self._sentence_cache = SentenceCache(cache_size) if incremental else None
+
         self._model = spacy.load(model_name, disable=["parser"])
 
     def predict(self, model_id: str, document: Document) -> Optional[Document]:
-        # Extract the tokens from the document and create a spacy doc from it
-        annotations = Annotations.from_dict(document.text, document.annotations)
-        words = [annotations.get_covered_text(token) for token in annotations.select(self._token_type)]
+        spans = [span for chunk in self.predict_chunks(model_id, document) for span in chunk]
+        return build_span_classification_response(document, spans)
+
+    def predict_chunks(self, model_id: str, document: Document) -> Iterator[List[Span]]:
+        """Tags `document` window by window and yields the entities found in each, as soon as it is tagged.
+
+        Spans are given as token indices into the whole document. Entities are only kept from the core of their
+        window, an entity starting in the overlap is found by the window whose core it starts in. Without a chunk
+        size, the whole document is tagged as a single chunk, or sentence by sentence in incremental mode.
+        """
+        if self._chunk_size is None and self._sentence_cache is None:
+            yield self._predict_document(document)
+            return
+
+        tokens = sort_by_offsets(document.annotations.get(self._token_type, []))
+        windows = list(iter_sentence_windows(document, tokens, self._chunk_size or 1, self._chunk_overlap))
+
+        # Entities are cached relative to their window, so they can be moved to wherever the window is now
+        if self._sentence_cache is None:
+            keys = list(range(len(windows)))
+            cached_spans = [None] * len(windows)
+        else:
+            prefix = get_prediction_cache_prefix(self, model_id, self._model)
+            keys = [(prefix, get_window_key(document.text, tokens, window)) for window in windows]
+            cached_spans = [self._sentence_cache.get(key) for key in keys]
+
+        # Windows that occur several times, e.g. repeated headlines, are only tagged once
+        missing_windows = {}
+        for window, key, spans in zip(windows, keys, cached_spans):
+            if spans is None:
+                missing_windows.setdefault(key, window)
 
-        doc = Doc(self._model.vocab, words=words)
+        docs = (
+            tokens_to_spacy_doc(self._model.vocab, document.text, tokens[w.begin : w.end])
+            for w in missing_windows.values()
+        )
+        tagged_docs = self._model.get_pipe("ner").pipe(docs, batch_size=self._batch_size)
+
+        tagged_spans = {}
+        for window, key, spans in zip(windows, keys, cached_spans):
+            if spans is None:
+                spans = tagged_spans.get(key)
+            if spans is None:
+                spans = self._get_core_spans(window, next(tagged_docs))
+                if self._sentence_cache is not None:
+                    tagged_spans[key] = spans
+                    self._sentence_cache.put(key, spans)
+
+            yield [Span(window.begin + span.begin, window.begin + span.end, span.value) for span in spans]
+
+    def _get_core_spans(self, window: TokenWindow, doc: "spacy.tokens.Doc") -> List[Span]:
+        # Entities starting in the core of the window, as token indices relative to the window
+        spans = []
+        for named_entity in doc.ents:
+            if window.core_begin <= window.begin + named_entity.start < window.core_end:
+                spans.append(Span(named_entity.start, named_entity.end, named_entity.label_))
+        return spans
+
+    def consumes(self) -> List[str]:
+        # Sentences are needed for chunking and by the response builder
+        return [self._token_type, self._sentence_type]
+
+    def _predict_document(self, document: Document) -> List[Span]:
+        # Create a spacy doc directly from the token offsets of the document
+        doc = document_to_spacy_doc(self._model.vocab, document, self._token_type)
 
         # Find the named entities
         self._model.get_pipe("ner")(doc)
@@ -37,4 +128,4 @@ class SpacyNerTagger(Classifier):
         for named_entity in doc.ents:
             spans.append(Span(named_entity.start, named_entity.end, named_entity.label_))
 
-        return build_span_classification_response(document, spans)
+        return spans
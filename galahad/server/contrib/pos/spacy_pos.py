@@ -1,33 +1,52 @@
-from typing import Optional
+from typing import List, Optional
 
 try:
     import spacy as spacy
-    from spacy.tokens import Doc
 except ImportError as error:
     print("Could not import 'spacy', please install it manually via 'pip install spacy'")
 
 from galahad.formats import build_token_labeling_response
-from galahad.server.annotations import Annotations
 from galahad.server.classifier import (AnnotationFeatures, AnnotationTypes,
                                        Classifier)
+from galahad.server.contrib.spacy_utils import (SentenceCache,
+                                                document_to_spacy_doc,
+                                                get_prediction_cache_prefix,
+                                                get_window_key,
+                                                iter_sentence_windows,
+                                                tokens_to_spacy_doc)
+from galahad.server.contrib.utils import sort_by_offsets
 from galahad.server.dataclasses import Document
 
 
 class SpacyPosTagger(Classifier):
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, incremental: bool = False, cache_size: int = 100_000, batch_size: int = 16):
+        """Creates a part-of-speech tagger using a pre-trained spaCy model.
+
+        Args:
+            model_name: The name of the spaCy model to load.
+            incremental: Whether to tag documents sentence by sentence and cache the tags of each sentence, so that
+                only sentences that changed since an earlier request are tagged again. Sentences are then tagged
+                without the context of their neighbours.
+            cache_size: How many sentences are cached in incremental mode.
+            batch_size: How many sentences are tagged at once in incremental mode.
+        """
         super().__init__()
 
         self._token_type = AnnotationTypes.TOKEN.value
+        self._sentence_type = AnnotationTypes.SENTENCE.value
         self._target_feature = AnnotationFeatures.VALUE.value
 
+        self._batch_size = batch_size
+        self._sentence_cache = SentenceCache(cache_size) if incremental else None
+
         self._model = spacy.load(model_name, disable=["parser"])
 
     def predict(self, model_id: str, document: Document) -> Optional[Document]:
-        # Extract the tokens from the document and create a spacy doc from it
-        annotations = Annotations.from_dict(document.text, document.annotations)
-        words = [annotations.get_covered_text(token) for token in annotations.select(self._token_type)]
+        if self._sentence_cache is not None:
+            return build_token_labeling_response(document, self._predict_incrementally(model_id, document))
 
-        spacy_doc = Doc(self._model.vocab, words=words)
+        # Create a spacy doc directly from the token offsets of the document
+        spacy_doc = document_to_spacy_doc(self._model.vocab, document, self._token_type)
 
         self._model.get_pipe("tok2vec")(spacy_doc)
         self._model.get_pipe("tagger")(spacy_doc)
@@ -37,3 +56,41 @@ class SpacyPosTagger(Classifier):
             list_of_pos_tags.append(spacy_doc[i].tag_)
 
         return build_token_labeling_response(document, list_of_pos_tags)
+
+    def consumes(self) -> List[str]:
+        # Sentences are not tagged, but the response builder needs them
+        return [self._token_type, self._sentence_type]
+
+    def _predict_incrementally(self, model_id: str, document: Document) -> List[str]:
+        tokens = sort_by_offsets(document.annotations.get(self._token_type, []))
+        sentences = list(iter_sentence_windows(document, tokens, 1))
+
+        prefix = get_prediction_cache_prefix(self, model_id, self._model)
+        keys = [(prefix, get_window_key(document.text, tokens, sentence)) for sentence in sentences]
+        cached_tags = [self._sentence_cache.get(key) for key in keys]
+
+        # Sentences that occur several times are only tagged once
+        missing_sentences = {}
+        for sentence, key, tags in zip(sentences, keys, cached_tags):
+            if tags is None:
+                missing_sentences.setdefault(key, sentence)
+
+        docs = (
+            tokens_to_spacy_doc(self._model.vocab, document.text, tokens[s.begin : s.end])
+            for s in missing_sentences.values()
+        )
+        docs = self._model.get_pipe("tok2vec").pipe(docs, batch_size=self._batch_size)
+        tagged_docs = self._model.get_pipe("tagger").pipe(docs, batch_size=self._batch_size)
+
+        tagged_tags = {}
+        list_of_pos_tags = []
+        for key, tags in zip(keys, cached_tags):
+            if tags is None:
+                tags = tagged_tags.get(key)
+            if tags is None:
+                tags = [token.tag_ for token in next(tagged_docs)]
+                tagged_tags[key] = tags
+                self._sentence_cache.put(key, tags)
+            list_of_pos_tags.extend(tags)
+
+        return list_of_pos_tags
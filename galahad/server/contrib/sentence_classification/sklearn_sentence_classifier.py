@@ -1,5 +1,5 @@
 import logging
-from typing import List, Optional
+from typing import Iterable, List, Optional
 
 try:
     from sklearn.feature_extraction.text import (CountVectorizer,
@@ -12,44 +12,58 @@ except ImportError as error:
 from galahad.formats import build_sentence_classification_document
 from galahad.server.annotations import Annotations
 from galahad.server.classifier import (AnnotationFeatures, AnnotationTypes,
-                                       Classifier)
+                                       Classifier, ModelPersistence)
+from galahad.server.contrib.feature_cache import HashedFeatureCache
+from galahad.server.contrib.utils import extract_covered_labels
 from galahad.server.dataclasses import Document
 
 logger = logging.getLogger(__name__)
 
 
 class SklearnSentenceClassifier(Classifier):
-    def __init__(self):
-        super().__init__()
+    def __init__(
+        self,
+        persistence: ModelPersistence = ModelPersistence.DEFAULT,
+        feature_cache: bool = False,
+        n_features: int = 2**18,
+    ):
+        """Creates a sentence classifier using a naive Bayes classifier on tf-idf features.
+
+        Args:
+            persistence: How models of this classifier are saved and loaded.
+            feature_cache: Whether to use hashed instead of counted terms as features. These are cached per
+                dataset so that retraining only featurizes new or changed sentences.
+            n_features: The number of hashed features when using the feature cache.
+        """
+        super().__init__(persistence=persistence)
+
+        self._feature_cache = feature_cache
+        self._n_features = n_features
 
         self._sentence_type = AnnotationTypes.SENTENCE.value
         self._sentence_annotation_type = AnnotationTypes.ANNOTATION.value
         self._target_feature = AnnotationFeatures.VALUE.value
 
-    def train(self, model_id: str, documents: List[Document]):
-        texts = []
-        labels = []
-
-        for document in documents:
-            annotations = Annotations.from_dict(document.text, document.annotations)
-
-            for sentence in annotations.select(self._sentence_type):
-                for sentence_label in annotations.select_covered(self._sentence_annotation_type, sentence):
-                    text = annotations.get_covered_text(sentence_label)
-                    label = sentence_label.features.get(self._target_feature)
-
-                    if label is None:
-                        continue
-
-                    texts.append(text)
-                    labels.append(label)
+    def train(self, model_id: str, documents: Iterable[Document]):
+        texts, labels = extract_covered_labels(
+            documents, self._sentence_type, self._sentence_annotation_type, self._target_feature
+        )
 
         assert len(texts) == len(labels), "Unequal number of sentences and labels"
         if not len(texts):
             logger.debug(f"Empty training set, skipping!")
 
-        model = Pipeline([("vect", CountVectorizer()), ("tfidf", TfidfTransformer()), ("clf", MultinomialNB())])
-        model.fit(texts, labels)
+        if self._feature_cache:
+            feature_cache = HashedFeatureCache(self._dataset_cache_directory, self._n_features)
+            model = Pipeline(
+                [("vect", feature_cache.create_vectorizer()), ("tfidf", TfidfTransformer()), ("clf", MultinomialNB())]
+            )
+
+            # The hashing vectorizer is stateless, only the steps after it need to be fit on the cached counts
+            model[1:].fit(feature_cache.transform(texts), labels)
+        else:
+            model = Pipeline([("vect", CountVectorizer()), ("tfidf", TfidfTransformer()), ("clf", MultinomialNB())])
+            model.fit(texts, labels)
 
         logger.debug(f"Training finished for model with id [%s]", model_id)
 
@@ -68,6 +82,31 @@ class SklearnSentenceClassifier(Classifier):
 
         return build_sentence_classification_document(texts, predicted_labels)
 
+    def predict_batch(self, model_id: str, documents: List[Document]) -> List[Optional[Document]]:
+        model: Optional[Pipeline] = self._load_model(model_id)
+
+        if model is None:
+            logger.debug("No trained model ready yet!")
+            return [None] * len(documents)
+
+        # The sentences of all documents are classified in a single call to the model
+        texts_per_document = []
+        for document in documents:
+            annotations = Annotations.from_dict(document.text, document.annotations)
+            texts = [annotations.get_covered_text(sentence) for sentence in annotations.select(self._sentence_type)]
+            texts_per_document.append(texts)
+
+        all_texts = [text for texts in texts_per_document for text in texts]
+        all_labels = list(model.predict(all_texts)) if all_texts else []
+
+        results = []
+        offset = 0
+        for texts in texts_per_document:
+            results.append(build_sentence_classification_document(texts, all_labels[offset : offset + len(texts)]))
+            offset += len(texts)
+
+        return results
+
     def consumes(self) -> List[str]:
         return [self._sentence_type, self._sentence_annotation_type]
 
@@ -0,0 +1,194 @@
+import bisect
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import (Any, Dict, Hashable, Iterable, Iterator, List, Optional,
+                    Tuple)
+
+try:
+    from spacy.language import Language
+    from spacy.tokens import Doc
+    from spacy.vocab import Vocab
+except ImportError as error:
+    print("Could not import 'spacy', please install it manually via 'pip install spacy'")
+
+from galahad.server.classifier import AnnotationTypes, Classifier
+from galahad.server.contrib.utils import sort_by_offsets
+from galahad.server.dataclasses import Annotation, Document
+
+
+def tokens_to_spacy_doc(vocab: "Vocab", text: str, tokens: List[Annotation]) -> "Doc":
+    """Creates a spaCy doc from sorted token offsets into `text`.
+
+    A token is followed by a space if the next character is whitespace and the next token does not start right
+    after it, so that the text of the doc matches `text` up to runs of whitespace.
+    """
+    words = []
+    spaces = []
+
+    num_tokens = len(tokens)
+    for i, token in enumerate(tokens):
+        end = token.end
+        words.append(text[token.begin : end])
+
+        followed_by_token = i + 1 < num_tokens and tokens[i + 1].begin <= end
+        spaces.append(not followed_by_token and text[end : end + 1].isspace())
+
+    return Doc(vocab, words=words, spaces=spaces)
+
+
+def document_to_spacy_doc(vocab: "Vocab", document: Document, token_type: str = AnnotationTypes.TOKEN.value) -> "Doc":
+    """Creates a spaCy doc from the token layer `token_type` of `document`."""
+    return tokens_to_spacy_doc(vocab, document.text, sort_by_offsets(document.annotations.get(token_type, [])))
+
+
+def documents_to_spacy_docs(
+    vocab: "Vocab", documents: Iterable[Document], token_type: str = AnnotationTypes.TOKEN.value
+) -> Iterator["Doc"]:
+    """Lazily creates spaCy docs for many documents, e.g. to feed them to `nlp.pipe`."""
+    for document in documents:
+        yield document_to_spacy_doc(vocab, document, token_type)
+
+
+@dataclass
+class TokenWindow:
+    """A window of sorted tokens given as token indices, `[begin, end)` including the overlap and
+    `[core_begin, core_end)` without it."""
+
+    begin: int
+    end: int
+    core_begin: int
+    core_end: int
+
+
+def iter_sentence_windows(
+    document: Document,
+    tokens: List[Annotation],
+    chunk_size: int,
+    chunk_overlap: int = 0,
+    sentence_type: str = AnnotationTypes.SENTENCE.value,
+) -> Iterator[TokenWindow]:
+    """Splits the sorted `tokens` of `document` into windows of `chunk_size` sentences.
+
+    Each window is extended by up to `chunk_overlap` sentences on both sides so that predictions near the chunk
+    borders still see context. The cores of all windows are disjoint and together cover all tokens. Documents without
+    sentences are returned as a single window.
+    """
+    assert chunk_size > 0, "The chunk size needs to be positive!"
+    assert chunk_overlap >= 0, "The chunk overlap must not be negative!"
+
+    sentences = sorted(document.annotations.get(sentence_type, []), key=lambda s: (s.begin, s.end))
+    if not sentences:
+        yield TokenWindow(0, len(tokens), 0, len(tokens))
+        return
+
+    # Token index at which each sentence starts, the first and last boundary are moved to the edges of the
+    # token list so that tokens outside of any sentence still end up in a window
+    begins = [token.begin for token in tokens]
+    boundaries = [bisect.bisect_left(begins, sentence.begin) for sentence in sentences]
+    boundaries[0] = 0
+    boundaries.append(len(tokens))
+
+    num_sentences = len(sentences)
+    for first in range(0, num_sentences, chunk_size):
+        last = min(first + chunk_size, num_sentences)
+        yield TokenWindow(
+            begin=boundaries[max(first - chunk_overlap, 0)],
+            end=boundaries[min(last + chunk_overlap, num_sentences)],
+            core_begin=boundaries[first],
+            core_end=boundaries[last],
+        )
+
+
+def get_window_key(text: str, tokens: List[Annotation], window: TokenWindow) -> bytes:
+    """Returns a hash of the text and tokens of `window` that does not depend on where the window is in the document.
+
+    Windows with the same key are tagged the same way, so their predictions can be reused after the text around
+    them was edited.
+    """
+    window_tokens = tokens[window.begin : window.end]
+    offset = window_tokens[0].begin if window_tokens else 0
+    end = window_tokens[-1].end if window_tokens else 0
+
+    # Token offsets relative to the window, followed by the core of the window relative to its begin
+    offsets = array("q", (value - offset for token in window_tokens for value in (token.begin, token.end)))
+    offsets.extend((window.core_begin - window.begin, window.core_end - window.begin))
+
+    key = hashlib.blake2b(text[offset:end].encode("utf-8"), digest_size=16)
+    key.update(offsets.tobytes())
+    return key.digest()
+
+
+def get_prediction_cache_prefix(classifier: Classifier, model_id: str, nlp: "Language") -> Tuple[Hashable, ...]:
+    """Returns the part of a prediction cache key that changes when the model making the predictions changes.
+
+    Pretrained pipelines are identified by their name and version, trained models by their generation.
+    """
+    # Classifiers that were not added to a store have no model folder and therefore no trained models
+    generation = _get_model_generation(classifier, model_id) if classifier._model_directory is not None else 0
+    return classifier.name, model_id, generation, nlp.meta.get("name"), nlp.meta.get("version")
+
+
+# Generations by model metadata file, together with the stamp of the file they were read from
+_generations: Dict[Path, Tuple[Tuple[int, int], int]] = {}
+_generations_lock = threading.Lock()
+
+
+def _get_model_generation(classifier: Classifier, model_id: str) -> int:
+    # This is called for every prediction, the metadata is only read again once its file was replaced
+    metadata_path = classifier._get_model_metadata_path(model_id)
+    try:
+        stat = metadata_path.stat()
+    except FileNotFoundError:
+        return 0
+
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with _generations_lock:
+        cached = _generations.get(metadata_path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    metadata = classifier._get_model_metadata(model_id)
+    generation = metadata.generation if metadata is not None else 0
+    with _generations_lock:
+        _generations[metadata_path] = (stamp, generation)
+
+    return generation
+
+
+class SentenceCache:
+    """Keeps the predictions for the most recently tagged windows of sentences, see `get_window_key`.
+
+    Safe to use from several threads. When full, the least recently used predictions are dropped first.
+    """
+
+    def __init__(self, max_entries: int = 100_000):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,74 @@
+import bisect
+from typing import Any, Iterable, List, Tuple
+
+from galahad.server.classifier import AnnotationFeatures, AnnotationTypes
+from galahad.server.dataclasses import Annotation, Document
+
+
+def extract_covered_labels(
+    documents: Iterable[Document],
+    covering_type: str = AnnotationTypes.SENTENCE.value,
+    label_type: str = AnnotationTypes.ANNOTATION.value,
+    feature: str = AnnotationFeatures.VALUE.value,
+) -> Tuple[List[str], List[Any]]:
+    """Extracts the texts and labels of all `label_type` annotations covered by a `covering_type` annotation.
+
+    This is the bulk version of calling `Annotations.select_covered` for every covering annotation of every document
+    and yields the same results in the same order, but joins both layers by sorted offsets without building an index.
+    Labels without `feature` are skipped.
+
+    Args:
+        documents: The documents to extract from.
+        covering_type: The type of the covering annotations, e.g. sentences.
+        label_type: The type of the annotations that carry the label.
+        feature: The name of the feature that holds the label.
+
+    Returns:
+        The covered texts of the labels and the labels, as parallel lists.
+    """
+    texts = []
+    labels = []
+
+    for document in documents:
+        covering = sort_by_offsets(document.annotations.get(covering_type, []))
+        covered = sort_by_offsets(document.annotations.get(label_type, []))
+        if not covering or not covered:
+            continue
+
+        text = document.text
+        begins = [annotation.begin for annotation in covered]
+        num_covered = len(covered)
+
+        for c in covering:
+            c_begin, c_end = c.begin, c.end
+            i = bisect.bisect_left(begins, c_begin)
+            while i < num_covered and begins[i] <= c_end:
+                annotation = covered[i]
+                i += 1
+
+                if annotation.end > c_end:
+                    continue
+
+                label = annotation.features.get(feature)
+                if label is None:
+                    continue
+
+                texts.append(text[annotation.begin : annotation.end])
+                labels.append(label)
+
+    return texts, labels
+
+
+def sort_by_offsets(annotations: List[Annotation]) -> List[Annotation]:
+    """Returns `annotations` sorted by begin and end.
+
+    Layers sent by INCEpTION are already sorted, they are then returned as is without copying them.
+    """
+    previous = (-1, -1)
+    for annotation in annotations:
+        current = (annotation.begin, annotation.end)
+        if current < previous:
+            return sorted(annotations, key=lambda a: (a.begin, a.end))
+        previous = current
+
+    return annotations
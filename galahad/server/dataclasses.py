@@ -1,4 +1,4 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -71,14 +71,117 @@ class DocumentList(BaseModel):
         }
 
 
+class DocumentPatch(BaseModel):
+    base_version: int  # Version of the stored document that the patch was computed against
+    version: int  # Version of the document after applying the patch
+    add: Dict[str, Layer] = Field(default_factory=dict)  # Annotations to add, by type name
+    remove: Dict[str, Layer] = Field(default_factory=dict)  # Annotations to remove, by type name
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "base_version": 23,
+                "version": 24,
+                "add": {"t.named_entity": [{"begin": 19, "end": 24, "features": {"f.value": "OBJ"}}]},
+                "remove": {"t.named_entity": [{"begin": 0, "end": 3, "features": {"f.value": "PER"}}]},
+            }
+        }
+
+
 # Classifier
 
 
+class ModelInfo(BaseModel):
+    model_id: str
+    generation: int  # Incremented every time the model is retrained
+    trained_at: float  # Unix timestamp of when the model was saved
+    training_duration: Optional[float]  # Seconds spent loading the dataset and training
+    document_count: Optional[int]  # Number of documents the model was trained on
+    size: int  # Size of the serialized model in bytes
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "model_id": "project1",
+                "generation": 3,
+                "trained_at": 1650000000.0,
+                "training_duration": 4.2,
+                "document_count": 120,
+                "size": 52817,
+            }
+        }
+
+
 class ClassifierInfo(BaseModel):
     name: str
+    consumes: List[str] = Field(default_factory=list)  # Layers used for prediction, empty if all of them are used
+    models: List[ModelInfo] = Field(default_factory=list)  # Trained models, sorted by model id
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "name": "ExampleClassifier",
+                "consumes": ["t.token", "t.sentence"],
+                "models": [ModelInfo.Config.schema_extra["example"]],
+            }
+        }
+
+
+class ResidentModel(BaseModel):
+    classifier_name: str
+    model_id: str
+    generation: int  # Incremented every time the model is retrained
+    size: int  # Size of the serialized model in bytes
+    idle: float  # Seconds since the model was last used
+
+
+class ResidentModelList(BaseModel):
+    models: List[ResidentModel]  # Resident models, least recently used first
+    total_size: int
+    memory_budget: Optional[int]
 
     class Config:
-        schema_extra = {"example": {"name": "ExampleClassifier"}}
+        schema_extra = {
+            "example": {
+                "models": [
+                    {"classifier_name": "sklearn", "model_id": "project1", "generation": 3, "size": 52817, "idle": 12.5}
+                ],
+                "total_size": 52817,
+                "memory_budget": 1073741824,
+            }
+        }
+
+
+# Profiling
+
+
+class ProfileCapture(BaseModel):
+    id: str
+    method: str
+    path: str
+    classifier: str
+    model_id: str
+    timestamp: float  # Unix time at which the request finished
+    duration: float  # Seconds spent handling the request
+    stages: Dict[str, float]  # Seconds spent per stage, see `galahad.server.metrics`
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "id": "4f7c3f0e9a2b4c7d8e1f2a3b4c5d6e7f",
+                "method": "POST",
+                "path": "/classifier/spacy_ner/project1/predict",
+                "classifier": "spacy_ner",
+                "model_id": "project1",
+                "timestamp": 1650000000.0,
+                "duration": 2.5,
+                "stages": {"parse": 0.3, "index": 0.4, "inference": 1.2, "response": 0.5, "serialize": 0.1},
+            }
+        }
+
+
+class ProfileCaptureList(BaseModel):
+    captures: List[ProfileCapture]  # Slowest first
 
 
 # Training
@@ -0,0 +1,401 @@
+"""Self-contained metrics in the Prometheus text exposition format.
+
+Metrics are kept in memory by the server process and rendered on `/metrics`, no external service is needed.
+Work inside a request can be attributed to stages with `timed`, the stage durations of a request are collected
+in a `RequestContext` and observed once the request finished.
+"""
+
+import bisect
+import math
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Iterator, List,
+                    Optional, Sequence, Tuple)
+
+from starlette.routing import BaseRoute
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+if TYPE_CHECKING:
+    from galahad.server.classifier import ModelCache, TrainingResult
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, math.inf)
+
+LabelValues = Tuple[str, ...]
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"Metric [{self.name}] expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, Tuple[Tuple[str, str], ...], float]]:
+        """Yields (suffix, label values, extra labels, value) for every sample of this metric."""
+        raise NotImplementedError()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, label_values, extra_labels, value in self.samples():
+            labels = list(zip(self.label_names, label_values)) + list(extra_labels)
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield "_total", label_values, (), value
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._label_values(labels), 0.0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield "", label_values, (), value
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, label_names)
+        buckets = sorted(buckets)
+        if buckets[-1] != math.inf:
+            buckets.append(math.inf)
+        self._buckets = tuple(buckets)
+        # Per label values: non-cumulative bucket counts, sum and count
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._label_values(labels)
+        idx = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * len(self._buckets), [0.0]))
+            counts[idx] += 1
+            total[0] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for upper_bound, count in zip(self._buckets, counts):
+                cumulative += count
+                yield "_bucket", label_values, (("le", _format_value(upper_bound)),), cumulative
+            yield "_sum", label_values, (), total
+            yield "_count", label_values, (), cumulative
+
+
+class CallbackMetric(_Metric):
+    """A metric whose values are read from `callback` when rendering, for state that is tracked elsewhere."""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        type_name: str,
+        label_names: Sequence[str],
+        callback: Callable[[], Dict[LabelValues, float]],
+    ):
+        super().__init__(name, documentation, label_names)
+        self.type_name = type_name
+        self._callback = callback
+
+    def samples(self):
+        suffix = "_total" if self.type_name == "counter" else ""
+        for label_values, value in sorted(self._callback().items()):
+            yield suffix, label_values, (), value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric [{metric.name}] already registered!")
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(
+        self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Request context
+
+
+@dataclass
+class RequestContext:
+    """Collects what is known about the request currently being handled."""
+
+    route: str = "none"
+    classifier: str = ""
+    model_id: str = ""
+    # Exclusive time in seconds spent per stage, time spent in nested stages is only counted for the inner stage
+    stages: Dict[str, float] = field(default_factory=dict)
+    # Set when the request should be profiled, the endpoint then stores its `cProfile.Profile` in `profile`
+    profile_requested: bool = False
+    profile: Optional[Any] = None
+    _stack: List[List[float]] = field(default_factory=list)
+
+
+_current_request: ContextVar[Optional[RequestContext]] = ContextVar("galahad_request_context", default=None)
+
+
+def get_request_context() -> Optional[RequestContext]:
+    return _current_request.get()
+
+
+def set_request_labels(classifier: str = "", model_id: str = ""):
+    """Attributes the current request to a classifier and model, if there is a current request."""
+    context = _current_request.get()
+    if context is not None:
+        context.classifier = classifier
+        context.model_id = model_id
+
+
+@contextmanager
+def timed(stage: str):
+    """Measures the time spent in the wrapped block as `stage` of the current request.
+
+    Does nothing when called outside of a request, e.g. when classifiers are used directly.
+    """
+    context = _current_request.get()
+    if context is None:
+        yield
+        return
+
+    # Each frame holds the start time and the time spent in nested stages
+    frame = [perf_counter(), 0.0]
+    context._stack.append(frame)
+    try:
+        yield
+    finally:
+        context._stack.pop()
+        elapsed = perf_counter() - frame[0]
+        context.stages[stage] = context.stages.get(stage, 0.0) + elapsed - frame[1]
+        if context._stack:
+            context._stack[-1][1] += elapsed
+
+
+# Server metrics
+
+
+class ServerMetrics:
+    """The metrics a Galahad server exposes on `/metrics`."""
+
+    def __init__(self):
+        self.registry = MetricsRegistry()
+
+        self.request_duration = self.registry.histogram(
+            "galahad_request_duration_seconds",
+            "Time spent handling a request.",
+            ["route", "method", "status"],
+        )
+        self.stage_duration = self.registry.histogram(
+            "galahad_stage_duration_seconds",
+            "Time spent in a stage of a request: parse, index, cache, inference, response or serialize.",
+            ["route", "classifier", "model_id", "stage"],
+        )
+        self.training_duration = self.registry.histogram(
+            "galahad_training_duration_seconds",
+            "Time spent training a model, including loading the dataset.",
+            ["classifier", "model_id"],
+            buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+        )
+        self.training_documents = self.registry.histogram(
+            "galahad_training_documents",
+            "Number of documents a model was trained on.",
+            ["classifier", "model_id"],
+            buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000),
+        )
+        self.training_queue_depth = self.registry.gauge(
+            "galahad_training_queue_depth",
+            "Number of training runs that are scheduled or running.",
+        )
+        self.prediction_cache_events = self.registry.counter(
+            "galahad_prediction_cache_events",
+            "Number of predictions that were served from precomputed predictions or had to be computed.",
+            ["classifier", "event"],
+        )
+        self.coalesced_predictions = self.registry.counter(
+            "galahad_coalesced_predictions",
+            "Number of predict requests that shared the prediction of an identical request that was running.",
+            ["classifier"],
+        )
+
+    def register_model_cache(self, model_cache: "ModelCache"):
+        self.registry.register(
+            CallbackMetric(
+                "galahad_model_cache_events",
+                "Number of model cache hits, stale hits, misses, shared loads and evictions.",
+                "counter",
+                ["classifier", "event"],
+                model_cache.get_statistics,
+            )
+        )
+        self.registry.register(
+            CallbackMetric(
+                "galahad_model_cache_resident_bytes",
+                "Total size of the models that are loaded in memory.",
+                "gauge",
+                [],
+                lambda: {(): model_cache.total_size},
+            )
+        )
+
+    def observe_training(self, classifier: str, result: "TrainingResult"):
+        self.training_duration.observe(result.duration, classifier=classifier, model_id=result.model_id)
+        self.training_documents.observe(result.document_count, classifier=classifier, model_id=result.model_id)
+
+    def observe_request(self, context: RequestContext, method: str, status: int, duration: float):
+        self.request_duration.observe(duration, route=context.route, method=method, status=str(status))
+        for stage, stage_duration in context.stages.items():
+            self.stage_duration.observe(
+                stage_duration,
+                route=context.route,
+                classifier=context.classifier,
+                model_id=context.model_id,
+                stage=stage,
+            )
+
+    def render(self) -> str:
+        return self.registry.render()
+
+
+class MetricsMiddleware:
+    """ASGI middleware that sets up the request context and observes request and stage durations."""
+
+    def __init__(self, app: ASGIApp, metrics: ServerMetrics, routes: Sequence[BaseRoute]):
+        self.app = app
+        self._metrics = metrics
+        # The live route list of the application, routes can still be added after the middleware was created
+        self._routes = routes
+        self._route_paths: Dict[Callable, str] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        context = RequestContext()
+        token = _current_request.set(context)
+        status_code = 500
+        end: Optional[float] = None
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code, end
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+            # Background tasks run after the response was sent, they are not part of the request duration
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                end = perf_counter()
+
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = (end if end is not None else perf_counter()) - start
+            _current_request.reset(token)
+
+            # The router stores the matched endpoint in the scope, we label by its path template
+            endpoint = scope.get("endpoint")
+            if endpoint is not None:
+                context.route = self._get_route_path(endpoint)
+
+            self._metrics.observe_request(context, scope["method"], status_code, duration)
+
+    def _get_route_path(self, endpoint: Callable) -> str:
+        if endpoint not in self._route_paths:
+            self._route_paths = {route.endpoint: route.path for route in self._routes if hasattr(route, "endpoint")}
+        return self._route_paths.get(endpoint, "none")
+
+
+def _format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+
+    escaped = []
+    for name, value in labels:
+        value = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -0,0 +1,182 @@
+"""Predictions that were computed ahead of time, e.g. for all documents of a dataset right after training.
+
+Predictions are stored as sidecar files per classifier, model and model generation, keyed by a hash of the document
+text and the layers the classifier consumes, and by the document version. A generation only becomes active once all of
+its predictions were written, until then the predictions of the previous generation are served.
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from galahad.server.classifier import Classifier, iter_documents
+from galahad.server.dataclasses import Document
+from galahad.server.util import select_layers
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionCache:
+    """Stores precomputed predictions on disk under `directory/{classifier}/{model id}/{generation}`."""
+
+    ACTIVE_FILE_NAME = "active"
+
+    def __init__(self, directory: Path):
+        self._directory = directory
+        # Active generation by (classifier name, model id), read from disk on first use
+        self._active: Dict[Tuple[str, str], Optional[int]] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Sent to a worker process to precompute predictions there, the server process then calls `reload`
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_active"] = {}
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, name: str, model_id: str, document: Document) -> Optional[bytes]:
+        """Returns the serialized prediction for `document` if it was precomputed by the active generation."""
+        generation = self.get_active_generation(name, model_id)
+        if generation is None:
+            return None
+
+        try:
+            return (self._get_generation_folder(name, model_id, generation) / get_document_key(document)).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, name: str, model_id: str, generation: int, document: Document, prediction: str):
+        """Stores the serialized `prediction` for `document`, it is served once `generation` is activated."""
+        folder = self._get_generation_folder(name, model_id, generation)
+        folder.mkdir(parents=True, exist_ok=True)
+
+        path = folder / get_document_key(document)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(prediction, encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def activate(self, name: str, model_id: str, generation: int):
+        """Serves the predictions of `generation` from now on and deletes the ones of older generations.
+
+        Does nothing if a newer generation is active already.
+        """
+        model_folder = self._directory / name / model_id
+        model_folder.mkdir(parents=True, exist_ok=True)
+
+        with self._lock:
+            active = self._read_active_generation(name, model_id)
+            if active is not None and active >= generation:
+                return
+
+            tmp_path = model_folder / f"{self.ACTIVE_FILE_NAME}.tmp"
+            tmp_path.write_text(str(generation), encoding="utf-8")
+            os.replace(tmp_path, model_folder / self.ACTIVE_FILE_NAME)
+            self._active[name, model_id] = generation
+
+        for folder in model_folder.iterdir():
+            if folder.is_dir() and folder.name.isdigit() and int(folder.name) < generation:
+                shutil.rmtree(folder, ignore_errors=True)
+
+    def reload(self, name: str, model_id: str):
+        """Reads the active generation from disk again, e.g. after it was activated by another process."""
+        with self._lock:
+            self._active[name, model_id] = self._read_active_generation(name, model_id)
+
+    def get_active_generation(self, name: str, model_id: str) -> Optional[int]:
+        key = (name, model_id)
+        with self._lock:
+            if key not in self._active:
+                self._active[key] = self._read_active_generation(name, model_id)
+            return self._active[key]
+
+    def _read_active_generation(self, name: str, model_id: str) -> Optional[int]:
+        try:
+            return int((self._directory / name / model_id / self.ACTIVE_FILE_NAME).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+
+    def _get_generation_folder(self, name: str, model_id: str, generation: int) -> Path:
+        return self._directory / name / model_id / str(generation)
+
+
+def get_document_key(document: Document) -> str:
+    """Returns the file name under which the prediction for `document` is stored.
+
+    `document` is expected to only contain the layers the classifier consumes, the key changes if the text or any
+    of these layers changes, even if the version does not.
+    """
+    key = hashlib.blake2b(document.text.encode("utf-8"), digest_size=16)
+    for type_name in sorted(document.annotations):
+        layer = [[a.begin, a.end, a.features] for a in document.annotations[type_name]]
+        key.update(json.dumps([type_name, layer], sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    return f"{key.hexdigest()}_{document.version}.json"
+
+
+def precompute_predictions(
+    classifier: Classifier,
+    model_id: str,
+    dataset_folder: Path,
+    cache: PredictionCache,
+    batch_size: int = 32,
+) -> int:
+    """Predicts all documents in `dataset_folder` with the current model and stores the predictions in `cache`.
+
+    Documents are predicted in batches of `batch_size`, see `Classifier.predict_batch`. Like predict requests,
+    they only keep the layers the classifier consumes. The predictions are activated once all are written.
+
+    Returns:
+        The number of stored predictions.
+    """
+    metadata = classifier._get_model_metadata(model_id)
+    if metadata is None:
+        logger.info("No model [%s] of [%s] to precompute predictions with", model_id, classifier.name)
+        return 0
+
+    try:
+        paths = sorted(dataset_folder.iterdir())
+    except FileNotFoundError:
+        logger.info("Dataset [%s] was deleted before precomputing predictions", dataset_folder.name)
+        return 0
+
+    consumed_layers = classifier.consumes()
+    count = 0
+    try:
+        for batch in _batched(iter_documents(paths), batch_size):
+            requests = [
+                Document.construct(
+                    text=d.text, annotations=select_layers(d.annotations, consumed_layers), version=d.version
+                )
+                for d in batch
+            ]
+
+            for request, prediction in zip(requests, classifier.predict_batch(model_id, requests)):
+                if prediction is not None:
+                    cache.put(classifier.name, model_id, metadata.generation, request, prediction.json())
+                    count += 1
+    except FileNotFoundError:
+        # The previous predictions stay active, they are complete unlike the ones computed so far
+        logger.info("Dataset [%s] was deleted while precomputing predictions", dataset_folder.name)
+        return count
+
+    cache.activate(classifier.name, model_id, metadata.generation)
+    logger.info("Precomputed [%d] predictions of [%s] with model [%s]", count, classifier.name, model_id)
+    return count
+
+
+def _batched(documents: Iterable[Document], batch_size: int) -> Iterator[List[Document]]:
+    documents = iter(documents)
+    while True:
+        batch = list(itertools.islice(documents, batch_size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,236 @@
+"""Opt-in profiling of single requests.
+
+A request is profiled when it carries the `X-Galahad-Profile` header or when it is sampled. Its endpoint then runs
+under cProfile, and the slowest profiled requests are kept under the profile folder, each with its stage breakdown
+and a profile file that can be inspected with `pstats` or tools like snakeviz.
+"""
+
+import asyncio
+import cProfile
+import functools
+import heapq
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple
+
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from galahad.server.dataclasses import ProfileCapture
+from galahad.server.metrics import get_request_context
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-galahad-profile"
+
+
+class RequestProfiler:
+    """Decides which requests to profile and keeps the `max_captures` slowest of them."""
+
+    def __init__(self, profile_directory: Path, sample_rate: float = 0.0, max_captures: int = 20):
+        """Creates a request profiler.
+
+        Args:
+            profile_directory: The folder in which captured profiles are stored.
+            sample_rate: Fraction of requests that are profiled without being asked to via header.
+            max_captures: How many of the slowest profiled requests to keep.
+        """
+        self._profile_directory = profile_directory
+        self._sample_rate = sample_rate
+        self._max_captures = max_captures
+        # Min-heap of (duration, capture id) so that the fastest kept capture is replaced first
+        self._captures: List[Tuple[float, str]] = []
+        self._lock = threading.Lock()
+
+        self._profile_directory.mkdir(parents=True, exist_ok=True)
+        self._load_captures()
+
+    def should_profile(self, scope: Scope) -> bool:
+        for name, value in scope.get("headers", []):
+            if name == PROFILE_HEADER:
+                return value.lower() in (b"1", b"true", b"yes")
+
+        return self._sample_rate > 0 and random.random() < self._sample_rate
+
+    def add_capture(self, scope: Scope, duration: float, profile: cProfile.Profile) -> Optional[ProfileCapture]:
+        """Stores the profile of a finished request if it is among the slowest ones.
+
+        This writes to disk and should not be called on the event loop. The lock only guards the bookkeeping of the
+        kept captures, the files are written and deleted outside of it.
+
+        Returns:
+            The capture if it was kept, else `None`.
+        """
+        context = get_request_context()
+
+        with self._lock:
+            if len(self._captures) >= self._max_captures and duration <= self._captures[0][0]:
+                return None
+
+        capture = ProfileCapture(
+            id=uuid.uuid4().hex,
+            method=scope["method"],
+            path=scope["path"],
+            classifier=context.classifier if context else "",
+            model_id=context.model_id if context else "",
+            timestamp=time.time(),
+            duration=duration,
+            stages=dict(context.stages) if context else {},
+        )
+
+        # The files are written before the capture becomes visible so that readers never see a missing file
+        profile.dump_stats(str(self.get_profile_path(capture.id)))
+        self._get_capture_path(capture.id).write_text(capture.json(), encoding="utf-8")
+
+        evicted_id = None
+        with self._lock:
+            if len(self._captures) >= self._max_captures:
+                # Slower captures might have been added in the meantime, then the new one is evicted right away
+                _, evicted_id = heapq.heappushpop(self._captures, (duration, capture.id))
+            else:
+                heapq.heappush(self._captures, (duration, capture.id))
+
+        if evicted_id is not None:
+            self._delete_capture(evicted_id)
+
+        return None if evicted_id == capture.id else capture
+
+    def get_captures(self) -> List[ProfileCapture]:
+        """Returns the kept captures, slowest first."""
+        with self._lock:
+            capture_ids = [capture_id for _, capture_id in sorted(self._captures, reverse=True)]
+
+        return [ProfileCapture.parse_file(self._get_capture_path(capture_id)) for capture_id in capture_ids]
+
+    def get_capture(self, capture_id: str) -> Optional[ProfileCapture]:
+        with self._lock:
+            if capture_id not in {c for _, c in self._captures}:
+                return None
+
+        return ProfileCapture.parse_file(self._get_capture_path(capture_id))
+
+    def get_profile_path(self, capture_id: str) -> Path:
+        return self._profile_directory / f"{capture_id}.prof"
+
+    def format_profile(self, capture_id: str, limit: int = 50) -> str:
+        """Renders the `limit` most expensive functions of a capture by cumulative time as text."""
+        stream = io.StringIO()
+        stats = pstats.Stats(str(self.get_profile_path(capture_id)), stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        return stream.getvalue()
+
+    def _get_capture_path(self, capture_id: str) -> Path:
+        return self._profile_directory / f"{capture_id}.json"
+
+    def _delete_capture(self, capture_id: str):
+        self.get_profile_path(capture_id).unlink(missing_ok=True)
+        self._get_capture_path(capture_id).unlink(missing_ok=True)
+
+    def _load_captures(self):
+        captures = []
+        for p in self._profile_directory.glob("*.json"):
+            capture = ProfileCapture.parse_file(p)
+            if self.get_profile_path(capture.id).is_file():
+                captures.append((capture.duration, capture.id))
+
+        captures.sort(reverse=True)
+        for _, capture_id in captures[self._max_captures :]:
+            self._delete_capture(capture_id)
+
+        self._captures = captures[: self._max_captures]
+        heapq.heapify(self._captures)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that marks requests for profiling and captures them once they finished.
+
+    It needs to run inside of the `MetricsMiddleware` which sets up the request context.
+    """
+
+    def __init__(self, app: ASGIApp, profiler: RequestProfiler):
+        self.app = app
+        self._profiler = profiler
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        context = get_request_context()
+        if scope["type"] != "http" or context is None or not self._profiler.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        context.profile_requested = True
+        end: Optional[float] = None
+
+        async def send_wrapper(message: Message):
+            nonlocal end
+            await send(message)
+
+            # Background tasks run after the response was sent, they do not make a request slow
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                end = time.perf_counter()
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = (end if end is not None else time.perf_counter()) - start
+            if context.profile is not None:
+                # Writing the profile blocks, so it must not run on the event loop
+                await run_in_threadpool(self._profiler.add_capture, scope, duration, context.profile)
+
+
+class ProfilingRoute(APIRoute):
+    """Route that runs its endpoint under cProfile when the current request asks for it."""
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any):
+        super().__init__(path, _profiled(endpoint), **kwargs)
+
+
+def _profiled(endpoint: Callable[..., Any]) -> Callable[..., Any]:
+    # Sync endpoints run in a worker thread and cProfile only profiles the thread it is enabled in,
+    # so the profiler needs to be enabled inside of the endpoint call itself.
+    if asyncio.iscoroutinefunction(endpoint):
+
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            with _profile_current_request():
+                return await endpoint(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        with _profile_current_request():
+            return endpoint(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def _profile_current_request():
+    context = get_request_context()
+    if context is None or not context.profile_requested:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another profiler is already active, e.g. for a concurrent request on Python 3.12+
+        logger.info("Could not profile request, another profiler is active")
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        profile.disable()
+        context.profile = profile
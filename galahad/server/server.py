@@ -1,63 +1,147 @@
 import asyncio
+import hashlib
+import json
+import logging
+import os
 import pathlib
-import re
 import shutil
 from concurrent.futures import ProcessPoolExecutor
-from typing import Callable
-
-from fastapi import FastAPI, HTTPException, Path, Response, status
+from contextlib import contextmanager
+from typing import Callable, Optional, Set, Tuple
+
+from fastapi import (Depends, FastAPI, HTTPException, Path, Query, Request,
+                     Response, status)
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, PlainTextResponse
+from pydantic import BaseModel
+from pydantic.error_wrappers import ErrorWrapper
 from starlette.background import BackgroundTasks
 
-from galahad.server.classifier import (Classifier, ClassifierStore,
+from galahad.server.classifier import (Classifier, ClassifierStore, get_lock,
                                        train_classifier)
 from galahad.server.dataclasses import *
-from galahad.server.util import (get_dataset_folder, get_datasets_folder,
-                                 get_document_path)
+from galahad.server.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from galahad.server.metrics import (MetricsMiddleware, ServerMetrics,
+                                    set_request_labels, timed)
+from galahad.server.prediction_cache import (PredictionCache,
+                                             precompute_predictions)
+from galahad.server.profiling import (ProfilingMiddleware, ProfilingRoute,
+                                      RequestProfiler)
+from galahad.server.util import (PATH_REGEX, DataDirectory, SingleFlight,
+                                 apply_document_patch, check_id,
+                                 project_document, select_layers)
+
+logger = logging.getLogger(__name__)
+
+# Routes that parse the request document themselves declare its schema explicitly
+DOCUMENT_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": {"$ref": "#/components/schemas/Document"}}},
+    }
+}
+
+
+def respond_with_etag(request: Request, content: BaseModel) -> Response:
+    """Returns `content` as JSON with an ETag, or an empty `304` if the client already has this version of it."""
+    body = content.json()
+    etag = f'"{hashlib.blake2b(body.encode("utf-8"), digest_size=8).hexdigest()}"'
 
-# This regex forbids two consecutive dots so that ../foo does not work
-# to discovery files outside of the document folder
-PATH_REGEX = r"^[a-zA-Z0-9_]+(?:\.[a-zA-Z0-9_]+)*$"
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 
 def check_naming_is_ok_regex(name: str):
-    if not re.match(PATH_REGEX, name):
-        raise ValueError(f'The name "{name}" is invalid. ' "Please look at the documentation for correct naming.")
+    """Raises a `ValueError` if `name` cannot be used as an identifier, see `check_id`."""
+    check_id(name)
 
 
 class GalahadServer(FastAPI):
     """Creates a Galahad server instance."""
 
-    def __init__(self, title: str = "Galahad Server", data_dir: pathlib.Path = None) -> None:
-        """Creates a Galahad server instance."""
+    def __init__(
+        self,
+        title: str = "Galahad Server",
+        data_dir: pathlib.Path = None,
+        model_memory_budget: Optional[int] = None,
+        model_idle_timeout: Optional[float] = None,
+        profiling: bool = False,
+        profile_sample_rate: float = 0.0,
+        profile_max_captures: int = 20,
+        training_loader_workers: int = 0,
+        training_loader_processes: bool = False,
+        precompute_predictions: bool = False,
+        precompute_batch_size: int = 32,
+    ) -> None:
+        """Creates a Galahad server instance.
+
+        Args:
+            title: The title of the server shown in the API documentation.
+            data_dir: The folder in which datasets and models are stored.
+            model_memory_budget: Maximum total size in bytes of models kept loaded in memory, `None` for no limit.
+            model_idle_timeout: Seconds after which an unused model is evicted from memory, `None` to keep it.
+            profiling: Whether requests can be profiled, either by sending the `X-Galahad-Profile: 1` header
+                or by sampling them with `profile_sample_rate`.
+            profile_sample_rate: Fraction of all requests that are profiled when profiling is enabled.
+            profile_max_captures: How many of the slowest profiled requests are kept under `data_dir/profiles`.
+            training_loader_workers: How many threads or processes parse the documents of a dataset ahead of
+                training, `0` to parse them one by one as the classifier consumes them.
+            training_loader_processes: Whether documents are parsed in processes instead of threads.
+            precompute_predictions: Whether all documents of the training dataset are predicted with the new model
+                after training, so that predictions for unchanged documents are served from `data_dir/predictions`.
+            precompute_batch_size: How many documents are predicted at once when precomputing predictions.
+        """
         super().__init__(title=title)
 
         if data_dir is None:
             data_dir = pathlib.Path.cwd() / "galahad_data"
 
         data_dir.mkdir(exist_ok=True, parents=True)
-        get_datasets_folder(data_dir).mkdir(exist_ok=True, parents=True)
-        get_datasets_folder(data_dir).mkdir(exist_ok=True, parents=True)
 
-        self._classifier_store = ClassifierStore(data_dir / "models")
+        # Resolved once here so that routes can build paths without touching the file system
+        data_directory = DataDirectory(data_dir)
+        data_directory.datasets_folder.mkdir(exist_ok=True, parents=True)
+        data_dir = data_directory.root
+
+        self._classifier_store = ClassifierStore(data_dir / "models", model_memory_budget, model_idle_timeout)
 
         self.state.data_dir = data_dir
+        self.state.data_directory = data_directory
         self.state.lock_dir = data_dir / "locks"
+        self.state.training_loader_workers = training_loader_workers
+        self.state.training_loader_processes = training_loader_processes
         self.state.classifier_store = self._classifier_store
 
+        self.state.prediction_cache = PredictionCache(data_dir / "predictions") if precompute_predictions else None
+        self.state.precompute_batch_size = precompute_batch_size
+
+        self.state.profiler = None
+        if profiling:
+            self.state.profiler = RequestProfiler(data_dir / "profiles", profile_sample_rate, profile_max_captures)
+            self.router.route_class = ProfilingRoute
+            self.add_middleware(ProfilingMiddleware, profiler=self.state.profiler)
+
+        # Added last so that it wraps the profiling middleware which needs the request context
+        self.state.metrics = ServerMetrics()
+        self.state.metrics.register_model_cache(self._classifier_store.model_cache)
+        self.add_middleware(MetricsMiddleware, metrics=self.state.metrics, routes=self.router.routes)
+
         _register_routes(self)
 
     def add_classifier(self, name: str, classifier: Classifier):
         check_naming_is_ok_regex(name)
-
-        document_path = get_document_path(self.state.data_dir, "classifier", name)
-        document_path.unlink(missing_ok=True)
         self._classifier_store.add_classifier(name, classifier)
 
 
 def _register_routes(app: FastAPI):
-    data_dir: pathlib.Path = app.state.data_dir
+    data_directory: DataDirectory = app.state.data_directory
     lock_directory = app.state.lock_dir
     classifier_store: ClassifierStore = app.state.classifier_store
+    server_metrics: ServerMetrics = app.state.metrics
+    profiler: Optional[RequestProfiler] = app.state.profiler
+    prediction_cache: Optional[PredictionCache] = app.state.prediction_cache
 
     # Scheduling
     # https://stackoverflow.com/questions/63169865/how-to-do-multiprocessing-in-fastapi
@@ -66,20 +150,233 @@ def _register_routes(app: FastAPI):
     async def startup_event():
         app.state.executor = ProcessPoolExecutor()
 
+        idle_timeout = classifier_store.model_cache.idle_timeout
+        if idle_timeout is not None:
+            app.state.idle_eviction_task = asyncio.create_task(evict_idle_models_periodically(idle_timeout))
+
     @app.on_event("shutdown")
     async def on_shutdown():
         app.state.executor.shutdown()
 
+        idle_eviction_task = getattr(app.state, "idle_eviction_task", None)
+        if idle_eviction_task is not None:
+            idle_eviction_task.cancel()
+
+    async def evict_idle_models_periodically(idle_timeout: float):
+        while True:
+            await asyncio.sleep(idle_timeout / 2)
+            classifier_store.evict_idle_models()
+
     async def run_in_different_process(fn: Callable, *args):
         loop = asyncio.get_event_loop()
         return await loop.run_in_executor(app.state.executor, fn, *args)
 
+    # (classifier id, model id) of all training runs that are scheduled or running
+    trainings_in_progress: Set[Tuple[str, str]] = set()
+
+    async def train_in_background(
+        classifier_id: str, classifier: Classifier, dataset_folder: pathlib.Path, model_id: str
+    ):
+        loop = asyncio.get_event_loop()
+        server_metrics.training_queue_depth.inc()
+        try:
+            # Predictions keep using the resident model until the new one is trained and loaded
+            with classifier_store.updating_model(classifier_id, model_id):
+                result = await run_in_different_process(
+                    train_classifier,
+                    classifier,
+                    dataset_folder,
+                    model_id,
+                    lock_directory,
+                    app.state.training_loader_workers,
+                    app.state.training_loader_processes,
+                    data_directory.cache_folder,
+                )
+
+                if result is not None:
+                    await loop.run_in_executor(None, classifier_store.preload_model, classifier_id, model_id)
+
+            # Runs after the new model is served, predictions of the previous model stay in use until it is done.
+            # Inference over the whole dataset is CPU bound, so like training it runs in a different process.
+            if result is not None and prediction_cache is not None:
+                try:
+                    await run_in_different_process(
+                        precompute_predictions,
+                        classifier,
+                        model_id,
+                        dataset_folder,
+                        prediction_cache,
+                        app.state.precompute_batch_size,
+                    )
+                    prediction_cache.reload(classifier_id, model_id)
+                except Exception:
+                    logger.exception(
+                        "Precomputing predictions of [%s] with model id [%s] failed", classifier_id, model_id
+                    )
+        except Exception:
+            # Runs after the response was sent, raising would only abort the connection of the client
+            logger.exception("Training [%s] with model id [%s] failed", classifier_id, model_id)
+            return
+        finally:
+            server_metrics.training_queue_depth.dec()
+            trainings_in_progress.discard((classifier_id, model_id))
+
+        if result is not None:
+            server_metrics.observe_training(classifier_id, result)
+
+    async def parse_document(request: Request) -> Document:
+        body = await request.body()
+
+        # Layers that the classifier does not consume are dropped before they are validated and indexed
+        classifier = classifier_store.get_classifier(request.path_params.get("classifier_id", ""))
+        consumed_layers = classifier.consumes() if classifier is not None else []
+
+        with timed("parse"):
+            # Identifies identical requests, see `predict_document`
+            request.state.body_hash = hashlib.blake2b(body, digest_size=16).digest()
+
+            try:
+                if not consumed_layers:
+                    return Document.parse_raw(body)
+
+                raw_document = json.loads(body)
+                if isinstance(raw_document, dict) and isinstance(raw_document.get("annotations"), dict):
+                    raw_document["annotations"] = select_layers(raw_document["annotations"], consumed_layers)
+                return Document.parse_obj(raw_document)
+            except ValueError as e:
+                # Both invalid JSON and validation errors are reported like other invalid request bodies
+                raise RequestValidationError([ErrorWrapper(e, loc=("body",))], body=body)
+
+    # Predictions that are running, identical concurrent predict requests share one of them
+    predictions_in_flight = SingleFlight()
+
+    def predict_document(
+        classifier_id: str, classifier: Classifier, model_id: str, document: Document, document_hash: bytes
+    ) -> Response:
+        # Precomputed predictions are already serialized and are returned as they are
+        if prediction_cache is not None:
+            with timed("cache"):
+                cached = prediction_cache.get(classifier_id, model_id, document)
+
+            server_metrics.prediction_cache_events.inc(
+                classifier=classifier_id, event="hit" if cached is not None else "miss"
+            )
+            if cached is not None:
+                return Response(content=cached, media_type="application/json")
+
+        # The generation of the resident model is part of the key so that requests which arrive after a retrained
+        # model was swapped in do not get the prediction of the previous one
+        generation = classifier_store.model_cache.get_generation((classifier_id, model_id))
+        content, shared = predictions_in_flight.do(
+            (classifier_id, model_id, generation, document_hash),
+            lambda: predict_and_serialize(classifier, model_id, document),
+        )
+
+        if shared:
+            server_metrics.coalesced_predictions.inc(classifier=classifier_id)
+
+        if content is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Model with id [{model_id}] not found.")
+
+        return Response(content=content, media_type="application/json")
+
+    def predict_and_serialize(classifier: Classifier, model_id: str, document: Document) -> Optional[str]:
+        with timed("inference"):
+            result = classifier.predict(model_id, document)
+
+        if result is None:
+            return None
+
+        with timed("serialize"):
+            return result.json()
+
+    @contextmanager
+    def locking_document(dataset_id: str, document_id: str):
+        # Document ids cannot contain dashes, so the locks never clash with the ones of classifiers
+        lock = get_lock(lock_directory / "document-locks" / dataset_id, document_id)
+        try:
+            lock.acquire()
+        except TimeoutError:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT, detail=f"Document with id [{document_id}] is being updated."
+            )
+
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def write_document(dataset_id: str, document_id: str, content: str):
+        # Written to a temporary file first so that concurrent reads never see a partially written document,
+        # callers hold the document lock so that the temporary file is not written by two requests at once
+        tmp_path = lock_directory / "document-locks" / dataset_id / f"{document_id}.tmp"
+        tmp_path.write_text(content, encoding="utf-8")
+        os.replace(tmp_path, data_directory.get_document_path(dataset_id, document_id))
+
     # Meta
 
     @app.get("/ping")
     def ping():
         return {"ping": "pong"}
 
+    @app.get(
+        "/metrics",
+        response_class=PlainTextResponse,
+        responses={status.HTTP_200_OK: {"description": "Returns server metrics in the Prometheus text format."}},
+        status_code=status.HTTP_200_OK,
+    )
+    def get_metrics():
+        """Returns request, stage, training and model cache metrics in the Prometheus text format."""
+        return PlainTextResponse(server_metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+    # Admin
+
+    def get_profiler() -> RequestProfiler:
+        if profiler is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profiling is not enabled.")
+        return profiler
+
+    @app.get(
+        "/admin/profiles",
+        response_model=ProfileCaptureList,
+        responses={
+            status.HTTP_200_OK: {"description": "Returns the slowest profiled requests."},
+            status.HTTP_404_NOT_FOUND: {"description": "Profiling is not enabled."},
+        },
+        status_code=status.HTTP_200_OK,
+    )
+    def list_profiles():
+        """Lists the slowest profiled requests with their stage breakdown, slowest first."""
+        return ProfileCaptureList(captures=get_profiler().get_captures())
+
+    @app.get(
+        "/admin/profiles/{capture_id}",
+        responses={
+            status.HTTP_200_OK: {"description": "Returns the profile of the requested capture."},
+            status.HTTP_404_NOT_FOUND: {"description": "Profiling is not enabled or capture not found."},
+        },
+        status_code=status.HTTP_200_OK,
+    )
+    def get_profile(
+        capture_id: str = Path(..., title="Identifier of the capture whose profile to get", regex=PATH_REGEX),
+        format: str = Query("pstats", title="Either `pstats` for the binary profile or `text` for a summary"),
+    ):
+        """Gets the profile of a captured request, either as binary `pstats` file or as text summary."""
+        request_profiler = get_profiler()
+        if request_profiler.get_capture(capture_id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=f"Capture with id [{capture_id}] not found."
+            )
+
+        if format == "text":
+            return PlainTextResponse(request_profiler.format_profile(capture_id))
+
+        return FileResponse(
+            request_profiler.get_profile_path(capture_id),
+            media_type="application/octet-stream",
+            filename=f"{capture_id}.prof",
+        )
+
     # Dataset
 
     @app.get(
@@ -92,7 +389,7 @@ def _register_routes(app: FastAPI):
         """Lists dataset names managed by this server."""
         dataset_names = []
 
-        for p in sorted(get_datasets_folder(data_dir).iterdir()):
+        for p in sorted(data_directory.datasets_folder.iterdir()):
             dataset_names.append(p.name)
 
         return DatasetList(names=dataset_names)
@@ -109,7 +406,7 @@ def _register_routes(app: FastAPI):
         dataset_id: str = Path(..., title="Identifier of the dataset that should be created", regex=PATH_REGEX),
     ):
         """Creates a dataset with the given `dataset_id`. Does nothing and returns `409` if it already existed."""
-        dataset_folder = get_dataset_folder(data_dir, dataset_id)
+        dataset_folder = data_directory.get_dataset_folder(dataset_id)
 
         if dataset_folder.exists():
             raise HTTPException(
@@ -130,8 +427,8 @@ def _register_routes(app: FastAPI):
     def delete_dataset(
         dataset_id: str = Path(..., title="Identifier of the dataset that should be deleted", regex=PATH_REGEX),
     ):
-        """Deletes the dataset with the given `dataset_id` and its documents."""
-        dataset_folder = get_dataset_folder(data_dir, dataset_id)
+        """Deletes the dataset with the given `dataset_id`, its documents and data cached for it."""
+        dataset_folder = data_directory.get_dataset_folder(dataset_id)
 
         if not dataset_folder.is_dir():
             raise HTTPException(
@@ -139,6 +436,7 @@ def _register_routes(app: FastAPI):
             )
 
         shutil.rmtree(dataset_folder)
+        shutil.rmtree(data_directory.get_dataset_cache_folder(dataset_id), ignore_errors=True)
 
         return Response(content="", status_code=status.HTTP_204_NO_CONTENT)
 
@@ -157,7 +455,7 @@ def _register_routes(app: FastAPI):
         ),
     ):
         """Lists documents in the dataset with the given `dataset_id`."""
-        dataset_folder = get_dataset_folder(data_dir, dataset_id)
+        dataset_folder = data_directory.get_dataset_folder(dataset_id)
 
         if not dataset_folder.is_dir():
             raise HTTPException(
@@ -167,7 +465,7 @@ def _register_routes(app: FastAPI):
         names = []
         versions = []
 
-        for p in sorted(dataset_folder.iterdir()):
+        for p in data_directory.iter_document_paths(dataset_id):
             document: Document = Document.parse_file(p)
             names.append(p.name)
             versions.append(document.version)
@@ -179,6 +477,7 @@ def _register_routes(app: FastAPI):
         responses={
             status.HTTP_204_NO_CONTENT: {"description": "Document added."},
             status.HTTP_404_NOT_FOUND: {"description": "Dataset not found."},
+            status.HTTP_409_CONFLICT: {"description": "The document is being updated."},
         },
         status_code=status.HTTP_204_NO_CONTENT,
     )
@@ -188,16 +487,126 @@ def _register_routes(app: FastAPI):
         document_id: str = Path(..., title="Identifier of the document to add", regex=PATH_REGEX),
     ):
         """Adds a document to an already existing dataset. Overwrites a document if it already existed."""
-        dataset_folder = get_dataset_folder(data_dir, dataset_id)
+        dataset_folder = data_directory.get_dataset_folder(dataset_id)
+
+        if not dataset_folder.is_dir():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=f"Dataset with id [{dataset_id}] not found."
+            )
+
+        with locking_document(dataset_id, document_id):
+            write_document(dataset_id, document_id, request.json(skip_defaults=True))
+
+        return Response(content="", status_code=status.HTTP_204_NO_CONTENT)
+
+    @app.get(
+        "/dataset/{dataset_id}/{document_id}",
+        response_model=Document,
+        responses={
+            status.HTTP_200_OK: {"description": "Returns the document."},
+            status.HTTP_404_NOT_FOUND: {"description": "Dataset or document not found."},
+        },
+        status_code=status.HTTP_200_OK,
+    )
+    def get_document_in_dataset(
+        dataset_id: str = Path(..., title="Identifier of the dataset to read from", regex=PATH_REGEX),
+        document_id: str = Path(..., title="Identifier of the document to read", regex=PATH_REGEX),
+        layers: List[str] = Query([], title="Type names of the layers to return, all layers if none are given"),
+        begin: Optional[int] = Query(None, ge=0, title="Offset of the first character to return"),
+        end: Optional[int] = Query(None, ge=0, title="Offset after the last character to return"),
+    ):
+        """Reads a document of a dataset, optionally only some of its layers or the part in `[begin, end)`.
+
+        Only annotations that lie completely inside of the requested range are returned, their offsets are relative to
+        the begin of the range. Without projection, the stored document is sent as is.
+        """
+        dataset_folder = data_directory.get_dataset_folder(dataset_id)
+
+        if not dataset_folder.is_dir():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=f"Dataset with id [{dataset_id}] not found."
+            )
+
+        document_path = data_directory.get_document_path(dataset_id, document_id)
+        if not document_path.is_file():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Document with id [{document_id}] not found in dataset [{dataset_id}].",
+            )
+
+        if not layers and begin is None and end is None:
+            return FileResponse(document_path, media_type="application/json")
+
+        # Stored documents were validated when they were added, so they are projected as plain JSON
+        with document_path.open("r", encoding="utf-8") as f:
+            document = json.load(f)
+
+        content = json.dumps(project_document(document, layers, begin, end), ensure_ascii=False)
+        return Response(content=content, media_type="application/json")
+
+    @app.patch(
+        "/dataset/{dataset_id}/{document_id}",
+        responses={
+            status.HTTP_204_NO_CONTENT: {"description": "Patch applied."},
+            status.HTTP_404_NOT_FOUND: {"description": "Dataset or document not found."},
+            status.HTTP_409_CONFLICT: {"description": "The document changed since the patch was computed."},
+        },
+        status_code=status.HTTP_204_NO_CONTENT,
+    )
+    def patch_document_in_dataset(
+        patch: DocumentPatch,
+        dataset_id: str = Path(..., title="Identifier of the dataset that contains the document", regex=PATH_REGEX),
+        document_id: str = Path(..., title="Identifier of the document to patch", regex=PATH_REGEX),
+    ):
+        """Adds and removes annotations of a stored document without uploading it again.
+
+        The patch is only applied if the stored document still has the version `base_version` and contains all
+        annotations to remove, else the client needs to upload the whole document again.
+        """
+        # Otherwise the version of the stored document would not tell patched and unpatched documents apart
+        if patch.version <= patch.base_version:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"The patched version [{patch.version}] needs to be greater than [{patch.base_version}].",
+            )
+
+        dataset_folder = data_directory.get_dataset_folder(dataset_id)
 
         if not dataset_folder.is_dir():
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"Dataset with id [{dataset_id}] not found."
             )
 
-        document_path = get_document_path(data_dir, dataset_id, document_id)
-        with document_path.open("w", encoding="utf-8") as f:
-            f.write(request.json(skip_defaults=True))
+        document_path = data_directory.get_document_path(dataset_id, document_id)
+        if not document_path.is_file():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Document with id [{document_id}] not found in dataset [{dataset_id}].",
+            )
+
+        with locking_document(dataset_id, document_id):
+            with document_path.open("r", encoding="utf-8") as f:
+                document = json.load(f)
+
+            stored_version = document.get("version", 0)
+            if stored_version != patch.base_version:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"Document with id [{document_id}] has version [{stored_version}], "
+                    f"not [{patch.base_version}].",
+                )
+
+            try:
+                apply_document_patch(
+                    document,
+                    add={t: [a.dict(exclude_unset=True) for a in layer] for t, layer in patch.add.items()},
+                    remove={t: [a.dict() for a in layer] for t, layer in patch.remove.items()},
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+            document["version"] = patch.version
+            write_document(dataset_id, document_id, json.dumps(document, ensure_ascii=False))
 
         return Response(content="", status_code=status.HTTP_204_NO_CONTENT)
 
@@ -214,14 +623,14 @@ def _register_routes(app: FastAPI):
         document_id: str = Path(..., title="Identifier of the document to delete", regex=PATH_REGEX),
     ):
         """Deletes a document from a dataset. Does nothing if the document did not exist."""
-        dataset_folder = get_dataset_folder(data_dir, dataset_id)
+        dataset_folder = data_directory.get_dataset_folder(dataset_id)
 
         if not dataset_folder.is_dir():
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"Dataset with id [{dataset_id}] not found."
             )
 
-        document_path = get_document_path(data_dir, dataset_id, document_id)
+        document_path = data_directory.get_document_path(dataset_id, document_id)
         document_path.unlink(missing_ok=True)
 
         return Response(content="", status_code=status.HTTP_204_NO_CONTENT)
@@ -245,14 +654,19 @@ def _register_routes(app: FastAPI):
         response_model=ClassifierInfo,
         responses={
             status.HTTP_200_OK: {"description": "Returns the classifier info of the requested classifier."},
+            status.HTTP_304_NOT_MODIFIED: {"description": "Classifier info did not change since the given ETag."},
             status.HTTP_404_NOT_FOUND: {"description": "Classifier not found."},
         },
         status_code=status.HTTP_200_OK,
     )
     def get_classifier_info(
-        classifier_id: str = Path(..., title="Identifier of the classifier whose info to query", regex=PATH_REGEX)
+        request: Request,
+        classifier_id: str = Path(..., title="Identifier of the classifier whose info to query", regex=PATH_REGEX),
     ):
-        """Gets the classifier info for the requested classifier id if it exists."""
+        """Gets the classifier info for the requested classifier id if it exists, including its trained models.
+
+        Supports conditional requests via `If-None-Match` so that clients can cheaply poll for new models.
+        """
         classifier_info = classifier_store.get_classifier_info(classifier_id)
 
         if classifier_info is None:
@@ -260,7 +674,54 @@ def _register_routes(app: FastAPI):
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"Classifier with id [{classifier_id}] not found."
             )
 
-        return classifier_info
+        return respond_with_etag(request, classifier_info)
+
+    @app.get(
+        "/classifier/{classifier_id}/{model_id}",
+        response_model=ModelInfo,
+        responses={
+            status.HTTP_200_OK: {"description": "Returns the info of the requested model."},
+            status.HTTP_304_NOT_MODIFIED: {"description": "Model info did not change since the given ETag."},
+            status.HTTP_404_NOT_FOUND: {"description": "Classifier or model not found."},
+        },
+        status_code=status.HTTP_200_OK,
+    )
+    def get_model_info(
+        request: Request,
+        classifier_id: str = Path(..., title="Identifier of the classifier whose model to query", regex=PATH_REGEX),
+        model_id: str = Path(..., title="Identifier of the model whose info to query", regex=PATH_REGEX),
+    ):
+        """Gets the generation, training time and size of a trained model.
+
+        Returns `404` as long as the model was not trained yet. Supports conditional requests via `If-None-Match`
+        so that clients can cheaply poll until a new generation of the model is available.
+        """
+        if classifier_store.get_classifier(classifier_id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=f"Classifier with id [{classifier_id}] not found."
+            )
+
+        model_info = classifier_store.get_model_info(classifier_id, model_id)
+        if model_info is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Model with id [{model_id}] of classifier with id [{classifier_id}] not found.",
+            )
+
+        return respond_with_etag(request, model_info)
+
+    @app.get(
+        "/models",
+        response_model=ResidentModelList,
+        responses={
+            status.HTTP_200_OK: {"description": "Returns list of models that are currently loaded in memory."},
+        },
+        status_code=status.HTTP_200_OK,
+    )
+    def list_resident_models():
+        """Lists the models that are currently loaded in memory together with their size."""
+        classifier_store.evict_idle_models()
+        return classifier_store.get_resident_models()
 
     # Train
 
@@ -286,15 +747,21 @@ def _register_routes(app: FastAPI):
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"Classifier with id [{classifier_id}] not found."
             )
 
-        dataset_folder = get_dataset_folder(data_dir, dataset_id)
+        dataset_folder = data_directory.get_dataset_folder(dataset_id)
         if not dataset_folder.is_dir():
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"Dataset with id [{dataset_id}] not found."
             )
 
-        background_tasks.add_task(
-            run_in_different_process, train_classifier, classifier, dataset_folder, model_id, lock_directory
-        )
+        if (classifier_id, model_id) in trainings_in_progress:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"Classifier with id [{classifier_id}] is already training model with id [{model_id}].",
+            )
+
+        set_request_labels(classifier_id, model_id)
+        trainings_in_progress.add((classifier_id, model_id))
+        background_tasks.add_task(train_in_background, classifier_id, classifier, dataset_folder, model_id)
 
         return Response(content="", status_code=status.HTTP_202_ACCEPTED)
 
@@ -307,9 +774,11 @@ def _register_routes(app: FastAPI):
             status.HTTP_200_OK: {"description": "Prediction successful."},
             status.HTTP_404_NOT_FOUND: {"description": "Classifier or model not found."},
         },
+        openapi_extra=DOCUMENT_REQUEST_BODY,
     )
     def predict_for_document(
-        request: Document,
+        raw_request: Request,
+        request: Document = Depends(parse_document),
         classifier_id: str = Path(
             ..., title="Name of the classifier that should be used for prediction", regex=PATH_REGEX
         ),
@@ -321,18 +790,57 @@ def _register_routes(app: FastAPI):
                 status_code=status.HTTP_404_NOT_FOUND, detail=f"Classifier with id [{classifier_id}] not found."
             )
 
-        result = classifier.predict(model_id, request)
-        if result is None:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Model with id [{model_id}] not found.")
+        set_request_labels(classifier_id, model_id)
 
-        return result
+        return predict_document(classifier_id, classifier, model_id, request, raw_request.state.body_hash)
 
-    @app.post("/classifier/{classifier_id}/{model_id}/predict/{dataset_id}/{document_id}")
+    @app.post(
+        "/classifier/{classifier_id}/{model_id}/predict/{dataset_id}/{document_id}",
+        response_model=Document,
+        responses={
+            status.HTTP_200_OK: {"description": "Prediction was successful."},
+            status.HTTP_404_NOT_FOUND: {"description": "Classifier, model, dataset or document not found."},
+        },
+        status_code=status.HTTP_200_OK,
+    )
     def predict_on_dataset(
-        classifier_id: str = Path(..., title="Identifier of the model that should be used for prediction"),
-        dataset_id: str = Path(..., title="Identifier of the dataset that should be used for prediction"),
+        classifier_id: str = Path(
+            ..., title="Name of the classifier that should be used for prediction", regex=PATH_REGEX
+        ),
+        model_id: str = Path(..., title="Identifier of the model that should be used for prediction", regex=PATH_REGEX),
+        dataset_id: str = Path(
+            ..., title="Identifier of the dataset that should be used for prediction", regex=PATH_REGEX
+        ),
         document_id: str = Path(
-            ..., title="Identifier of the document in the given dataset that should be used for prediction"
+            ...,
+            title="Identifier of the document in the given dataset that should be used for prediction",
+            regex=PATH_REGEX,
         ),
     ):
-        return {"classifier_id": classifier_id, "dataset_id": dataset_id, "document_id": document_id}
+        """Predicts a document that is stored in a dataset, served from precomputed predictions if possible."""
+        classifier = classifier_store.get_classifier(classifier_id)
+        if classifier is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=f"Classifier with id [{classifier_id}] not found."
+            )
+
+        if not data_directory.get_dataset_folder(dataset_id).is_dir():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=f"Dataset with id [{dataset_id}] not found."
+            )
+
+        set_request_labels(classifier_id, model_id)
+
+        document_path = data_directory.get_document_path(dataset_id, document_id)
+        with timed("parse"):
+            try:
+                content = document_path.read_bytes()
+            except FileNotFoundError:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND, detail=f"Document with id [{document_id}] not found."
+                )
+
+            document = Document.parse_obj(project_document(json.loads(content), classifier.consumes()))
+
+        document_hash = hashlib.blake2b(content, digest_size=16).digest()
+        return predict_document(classifier_id, classifier, model_id, document, document_hash)
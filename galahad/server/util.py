@@ -1,37 +1,225 @@
+import json
+import re
+import threading
+from collections import Counter
 from pathlib import Path
+from typing import (Any, Callable, Dict, Hashable, Iterable, Iterator, List,
+                    Optional, Tuple, TypeVar)
 
+# This regex forbids two consecutive dots so that ../foo does not work
+# to discovery files outside of the document folder
+PATH_REGEX = r"^[a-zA-Z0-9_]+(?:\.[a-zA-Z0-9_]+)*$"
+_PATH_PATTERN = re.compile(PATH_REGEX)
 
-def get_datasets_folder(data_dir: Path) -> Path:
-    result = data_dir / "datasets"
-    if not path_is_parent(data_dir, result):
-        raise ValueError("Naming is invalid. Please look at the documentation for correct naming.")
-    return result
 
+class DataDirectory:
+    """Locates datasets and documents in the data folder of a server.
 
-def get_dataset_folder(data_dir: Path, dataset_id: str) -> Path:
-    result = get_datasets_folder(data_dir) / dataset_id
-    if not path_is_parent(data_dir, result):
-        raise ValueError(
-            'Naming for the dataset "' + dataset_id + '" is invalid. '
-            "Please look at the documentation for correct naming."
-        )
-    return result
+    The data folder is resolved once when creating this. Identifiers are only checked against `PATH_REGEX`,
+    which rules out path separators and `..`, so the resulting paths stay inside of the data folder without
+    resolving them on every call.
+    """
 
+    def __init__(self, data_dir: Path):
+        self._root = data_dir.resolve()
+        self._datasets_folder = self._root / "datasets"
+        self._cache_folder = self._root / "cache"
 
-def get_document_path(data_dir: Path, dataset_id: str, document_name: str) -> Path:
-    result = get_dataset_folder(data_dir, dataset_id) / document_name
-    if not path_is_parent(data_dir, result):
-        raise ValueError(
-            'Naming for the dataset "' + dataset_id + '" or for the document "' + document_name + '" is invalid. '
-            "Please look at the documentation for correct naming."
-        )
+    def get_dataset_folder(self, dataset_id: str) -> Path:
+        check_id(dataset_id, "dataset")
+        return self._datasets_folder / dataset_id
+
+    def get_dataset_cache_folder(self, dataset_id: str) -> Path:
+        """Returns the folder in which classifiers cache data derived from a dataset."""
+        check_id(dataset_id, "dataset")
+        return self._cache_folder / dataset_id
+
+    def get_document_path(self, dataset_id: str, document_id: str) -> Path:
+        check_id(document_id, "document")
+        return self.get_dataset_folder(dataset_id) / document_id
+
+    def get_document_paths(self, dataset_id: str, document_ids: Iterable[str]) -> List[Path]:
+        """Returns the paths of many documents of a dataset, validating the dataset id only once."""
+        dataset_folder = self.get_dataset_folder(dataset_id)
+
+        result = []
+        for document_id in document_ids:
+            check_id(document_id, "document")
+            result.append(dataset_folder / document_id)
+        return result
+
+    def iter_document_paths(self, dataset_id: str) -> Iterator[Path]:
+        """Yields the paths of all documents in a dataset sorted by name.
+
+        The names come from listing the dataset folder itself and are therefore not validated again.
+        """
+        return iter(sorted(self.get_dataset_folder(dataset_id).iterdir()))
+
+    @property
+    def root(self) -> Path:
+        return self._root
+
+    @property
+    def datasets_folder(self) -> Path:
+        return self._datasets_folder
+
+    @property
+    def cache_folder(self) -> Path:
+        return self._cache_folder
+
+
+L = TypeVar("L")
+
+
+def select_layers(layers: Dict[str, L], type_names: Iterable[str]) -> Dict[str, L]:
+    """Returns the layers whose type name is in `type_names`, or all layers if `type_names` is empty.
+
+    Classifiers that do not declare which layers they consume get all of them.
+    """
+    type_names = set(type_names)
+    if not type_names:
+        return layers
+
+    return {type_name: layer for type_name, layer in layers.items() if type_name in type_names}
+
+
+def project_document(
+    document: Dict[str, Any], layers: Iterable[str] = (), begin: Optional[int] = None, end: Optional[int] = None
+) -> Dict[str, Any]:
+    """Returns the selected layers of a serialized document, restricted to the characters in `[begin, end)`.
+
+    Works on the JSON form of a document so that stored documents can be projected without validating them. Only
+    annotations that lie completely inside of the range are kept, their offsets are moved so that they index into
+    the returned text.
+
+    Args:
+        document: The document as parsed from JSON.
+        layers: The type names of the layers to keep, all layers if empty.
+        begin: The first character to keep, the start of the text if `None`.
+        end: The character after the last one to keep, the end of the text if `None`.
+    """
+    result = dict(document)
+    annotations = select_layers(document.get("annotations", {}), layers)
+
+    if begin is None and end is None:
+        result["annotations"] = annotations
+        return result
+
+    text = document["text"]
+    begin = 0 if begin is None else min(begin, len(text))
+    end = len(text) if end is None else min(max(end, begin), len(text))
+
+    result["text"] = text[begin:end]
+    result["annotations"] = {
+        type_name: [
+            {**annotation, "begin": annotation["begin"] - begin, "end": annotation["end"] - begin}
+            for annotation in layer
+            if annotation["begin"] >= begin and annotation["end"] <= end
+        ]
+        for type_name, layer in annotations.items()
+    }
     return result
 
 
-def path_is_parent(parent: Path, child: Path) -> bool:
+def annotation_key(begin: int, end: int, features: Optional[Dict[str, Any]]) -> Tuple[int, int, Hashable]:
+    """Returns a hashable key under which annotations with the same offsets and features are equal."""
+    return begin, end, json.dumps(features, sort_keys=True) if features else ""
+
+
+def apply_document_patch(
+    document: Dict[str, Any], add: Dict[str, List[Dict[str, Any]]], remove: Dict[str, List[Dict[str, Any]]]
+):
+    """Adds and removes annotations of a serialized document in place.
+
+    Each annotation in `remove` removes one equal annotation from its layer, only layers that are patched are
+    touched. Nothing is changed if the patch does not apply.
+
+    Raises:
+        ValueError: If an annotation to remove is not in the document.
     """
-    Checks whether `parent` is really a parent of `child`.
-    This is mainly used to prevent clients sending path names like ../../bar that can
-    potentially escape the data folder and cause harm.
+    layers = document.setdefault("annotations", {})
+    patched_layers = {}
+
+    for type_name, removed in remove.items():
+        counts = Counter(annotation_key(a["begin"], a["end"], a.get("features")) for a in removed)
+        kept = []
+        for annotation in layers.get(type_name, []):
+            key = annotation_key(annotation["begin"], annotation["end"], annotation.get("features"))
+            if counts[key] > 0:
+                counts[key] -= 1
+            else:
+                kept.append(annotation)
+
+        if sum(counts.values()) > 0:
+            raise ValueError(f"Layer [{type_name}] does not contain all annotations to remove")
+        patched_layers[type_name] = kept
+
+    for type_name, added in add.items():
+        patched_layers[type_name] = patched_layers.get(type_name, layers.get(type_name, [])) + added
+
+    layers.update(patched_layers)
+
+
+T = TypeVar("T")
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key so that only one of them does the work.
+
+    The first caller for a key runs the function, callers that arrive while it is running wait for it and get the
+    same result or exception. Nothing is cached, a call that arrives after the function returned runs it again.
+    Safe to use from several threads.
     """
-    return parent.resolve() in child.resolve().parents
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> Tuple[T, bool]:
+        """Runs `fn` unless a call for `key` is already running, then waits for that call instead.
+
+        Returns:
+            The result of `fn` and whether it was shared with a call that was already running.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.result, False
+
+    def __len__(self) -> int:
+        """Returns the number of calls that are running."""
+        with self._lock:
+            return len(self._flights)
+
+
+def check_id(name: str, kind: str = "name"):
+    if not _PATH_PATTERN.fullmatch(name):
+        raise ValueError(
+            f'Naming for the {kind} "{name}" is invalid. Please look at the documentation for correct naming.'
+        )
@@ -26,6 +26,8 @@ demo_dependencies = ["gradio==2.9.*", "nltk==3.7"]
 
 test_dependencies = ["pytest", "datasets"]
 
+benchmark_dependencies = ["pytest-benchmark"]
+
 dev_dependencies = ["black", "isort"]
 
 doc_dependencies = [
@@ -51,6 +53,7 @@ contrib_dependencies.extend(sklearn_dependencies)
 
 extras = {
     "test": test_dependencies,
+    "benchmark": benchmark_dependencies,
     "dev": dev_dependencies,
     "doc": doc_dependencies,
     "contrib": contrib_dependencies,
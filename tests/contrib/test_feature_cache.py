@@ -0,0 +1,70 @@
+from pathlib import Path
+
+from galahad.formats import build_sentence_classification_document
+from galahad.server.classifier import ClassifierStore, train_classifier
+from galahad.server.contrib.feature_cache import HashedFeatureCache
+from galahad.server.contrib.sentence_classification.sklearn_sentence_classifier import \
+    SklearnSentenceClassifier
+
+
+def test_hashed_feature_cache_only_featurizes_new_texts(tmpdir, monkeypatch):
+    directory = Path(tmpdir)
+    cache = HashedFeatureCache(directory, n_features=64)
+    expected = cache.create_vectorizer().transform(["a b", "b c", "a b", "c d"]).toarray()
+
+    first = cache.transform(["a b", "b c", "a b"])
+    assert (first.toarray() == expected[:3]).all()
+
+    featurized = []
+    vectorizer = cache.create_vectorizer()
+    monkeypatch.setattr(
+        vectorizer, "transform", lambda texts: featurized.extend(texts) or type(vectorizer).transform(vectorizer, texts)
+    )
+    monkeypatch.setattr(cache, "create_vectorizer", lambda: vectorizer)
+
+    second = cache.transform(["c d", "a b"])
+
+    assert featurized == ["c d"]
+    assert (second.toarray() == expected[[3, 0]]).all()
+
+
+def test_hashed_feature_cache_keeps_only_last_texts(tmpdir):
+    directory = Path(tmpdir)
+    cache = HashedFeatureCache(directory, n_features=64)
+
+    cache.transform(["a b", "b c"])
+    cache.transform(["b c"])
+
+    keys, features = cache._load()
+    assert len(keys) == 1
+    assert features.shape == (1, 64)
+
+
+def test_hashed_feature_cache_discards_rows_with_other_number_of_features(tmpdir):
+    directory = Path(tmpdir)
+    HashedFeatureCache(directory, n_features=64).transform(["a b"])
+
+    features = HashedFeatureCache(directory, n_features=32).transform(["a b"])
+
+    assert features.shape == (1, 32)
+
+
+def test_sklearn_sentence_classifier_with_feature_cache(tmpdir):
+    tmpdir = Path(tmpdir)
+    dataset_folder = tmpdir / "datasets" / "dataset"
+    dataset_folder.mkdir(parents=True)
+    sentences = ["I like it.", "It is bad.", "Great, I like it.", "So bad."]
+    document = build_sentence_classification_document(sentences, ["pos", "neg", "pos", "neg"])
+    (dataset_folder / "document").write_text(document.json())
+
+    store = ClassifierStore(tmpdir / "models")
+    store.add_classifier("classifier", SklearnSentenceClassifier(feature_cache=True))
+    classifier = store.get_classifier("classifier")
+
+    train_classifier(classifier, dataset_folder, "model", tmpdir / "locks", cache_directory=tmpdir / "cache")
+    train_classifier(classifier, dataset_folder, "model", tmpdir / "locks", cache_directory=tmpdir / "cache")
+
+    assert (tmpdir / "cache" / "dataset" / "classifier" / HashedFeatureCache.FILE_NAME).is_file()
+
+    result = classifier.predict("model", build_sentence_classification_document(["I like it."], ["?"]))
+    assert result.annotations["t.annotation"][0].features["f.value"] == "pos"
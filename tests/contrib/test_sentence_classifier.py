@@ -40,3 +40,27 @@ def test_sklearn_sentence_classifier_train_predict(tmpdir):
 
     assert len(predicted_labels) == len(test_labels)
     assert mean(int(e1 == e2) for e1, e2 in zip(predicted_labels, test_labels)) > 0.9
+
+
+def test_sklearn_sentence_classifier_predict_batch(tmpdir):
+    model_id = "my_test_model"
+
+    classifier = SklearnSentenceClassifier()
+    classifier._model_directory = Path(tmpdir)
+
+    train_texts = ["buy now", "free offer", "see you later", "call me later"]
+    train_labels = ["spam", "spam", "ham", "ham"]
+    classifier.train(model_id, [build_sentence_classification_document(train_texts, train_labels)])
+
+    documents = [
+        build_sentence_classification_document(["free offer", "see you"], ["", ""]),
+        build_sentence_classification_document([], []),
+        build_sentence_classification_document(["buy now"], [""]),
+    ]
+
+    batch_results = classifier.predict_batch(model_id, documents)
+
+    assert batch_results[0] == classifier.predict(model_id, documents[0])
+    assert batch_results[1].text == ""
+    assert batch_results[2] == classifier.predict(model_id, documents[2])
+    assert classifier.predict_batch("unknown_model", documents) == [None, None, None]
@@ -23,3 +23,47 @@ def test_spacy_ner_predict(tmpdir):
     predicted_labels = [p.features[classifier._target_feature] for p in predictions]
 
     assert len(predicted_labels) > 0
+
+
+def test_spacy_ner_predict_chunked(tmpdir):
+    model_directory = Path(tmpdir)
+
+    dataset = load_dataset("conll2003", split="validation")
+
+    classifier = SpacyNerTagger("en_core_web_sm", chunk_size=32, chunk_overlap=2)
+    classifier._model_directory = model_directory
+    predict_request = build_span_classification_request(dataset["tokens"][:200])
+
+    chunks = list(classifier.predict_chunks("spacy", predict_request))
+    response = classifier.predict("spacy", predict_request)
+
+    predicted_annotations = Annotations.from_dict(response.text, response.annotations)
+    predictions = predicted_annotations.select(AnnotationTypes.ANNOTATION.value)
+
+    assert len(chunks) == 7
+    assert len(predictions) == sum(len(chunk) for chunk in chunks) > 0
+
+
+def test_spacy_ner_predict_incremental(tmpdir):
+    model_directory = Path(tmpdir)
+
+    dataset = load_dataset("conll2003", split="validation")
+    sentences = dataset["tokens"][:200]
+
+    classifier = SpacyNerTagger("en_core_web_sm", incremental=True)
+    classifier._model_directory = model_directory
+    full_classifier = SpacyNerTagger("en_core_web_sm", chunk_size=1)
+    full_classifier._model_directory = model_directory
+
+    classifier.predict("spacy", build_span_classification_request(sentences))
+    assert classifier._sentence_cache.hits == 0
+
+    # Inserting a sentence moves all following sentences, but only the new one needs to be tagged
+    edited_request = build_span_classification_request(
+        sentences[:100] + [["Berlin", "is", "big", "."]] + sentences[100:]
+    )
+    misses = classifier._sentence_cache.misses
+    response = classifier.predict("spacy", edited_request)
+
+    assert classifier._sentence_cache.misses == misses + 1
+    assert response == full_classifier.predict("spacy", edited_request)
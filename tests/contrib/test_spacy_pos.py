@@ -60,3 +60,17 @@ def test_spacy_pos_predict(tmpdir, spacy_pos_tagger: SpacyPosTagger):
     predictions = predicted_annotations.select(AnnotationTypes.ANNOTATION.value)
     predicted_labels = [p.features[spacy_pos_tagger._target_feature] for p in predictions]
     assert len(predicted_labels) == sum(len(sentence) for sentence in dataset["tokens"])
+
+
+def test_spacy_pos_predict_incremental():
+    classifier = SpacyPosTagger("en_core_web_sm", incremental=True)
+    sentences = [["I", "am", "jealous", "."], ["Peter", "received", "a", "gift", "."]]
+
+    first = classifier.predict("spacy", build_span_classification_request(sentences))
+    second = classifier.predict("spacy", build_span_classification_request(sentences[::-1]))
+
+    assert classifier._sentence_cache.misses == 2
+    assert classifier._sentence_cache.hits == 2
+    first_tags = [a.features["f.value"] for a in first.annotations["t.annotation"]]
+    second_tags = [a.features["f.value"] for a in second.annotations["t.annotation"]]
+    assert second_tags == first_tags[4:] + first_tags[:4]
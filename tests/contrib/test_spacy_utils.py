@@ -0,0 +1,115 @@
+from pathlib import Path
+
+from spacy.lang.en import English
+from spacy.vocab import Vocab
+
+from galahad.formats import build_span_classification_request
+from galahad.server.classifier import ClassifierStore
+from galahad.server.contrib.spacy_utils import (SentenceCache, TokenWindow,
+                                                document_to_spacy_doc,
+                                                documents_to_spacy_docs,
+                                                get_prediction_cache_prefix,
+                                                get_window_key,
+                                                iter_sentence_windows)
+from galahad.server.contrib.utils import sort_by_offsets
+from galahad.server.dataclasses import Document
+from tests.fixtures import DummyClassifier
+
+
+def test_document_to_spacy_doc():
+    document = Document.parse_obj(Document.Config.schema_extra["example"])
+
+    doc = document_to_spacy_doc(Vocab(), document)
+
+    assert doc.text == document.text
+    assert [t.text for t in doc] == document.text.split(" ")
+    assert [t.whitespace_ for t in doc] == [" "] * 10 + [""]
+
+
+def test_document_to_spacy_doc_with_adjacent_and_unsorted_tokens():
+    text = "Ohio, the Boston."
+    tokens = [
+        {"begin": 10, "end": 16},
+        {"begin": 0, "end": 4},
+        {"begin": 4, "end": 5},
+        {"begin": 6, "end": 9},
+        {"begin": 16, "end": 17},
+    ]
+    document = Document(text=text, annotations={"t.token": tokens})
+
+    doc = document_to_spacy_doc(Vocab(), document)
+
+    assert doc.text == text
+    assert [t.text for t in doc] == ["Ohio", ",", "the", "Boston", "."]
+
+
+def test_documents_to_spacy_docs():
+    document = Document.parse_obj(Document.Config.schema_extra["example"])
+
+    docs = list(documents_to_spacy_docs(Vocab(), [document, document]))
+
+    assert [doc.text for doc in docs] == [document.text, document.text]
+
+
+def test_iter_sentence_windows():
+    document = build_span_classification_request([["a", "b"], ["c"], ["d", "e", "f"], ["g"]])
+    tokens = sort_by_offsets(document.annotations["t.token"])
+
+    windows = list(iter_sentence_windows(document, tokens, chunk_size=2, chunk_overlap=1))
+
+    assert windows == [TokenWindow(0, 6, 0, 3), TokenWindow(2, 7, 3, 7)]
+
+
+def test_iter_sentence_windows_without_sentences():
+    document = Document.parse_obj(Document.Config.schema_extra["example"])
+    del document.annotations["t.sentence"]
+    tokens = sort_by_offsets(document.annotations["t.token"])
+
+    windows = list(iter_sentence_windows(document, tokens, chunk_size=2))
+
+    assert windows == [TokenWindow(0, len(tokens), 0, len(tokens))]
+
+
+def test_get_window_key_does_not_depend_on_position():
+    document = build_span_classification_request([["a", "b"], ["c"], ["a", "b"], ["a", "bb"]])
+    tokens = sort_by_offsets(document.annotations["t.token"])
+
+    keys = [get_window_key(document.text, tokens, w) for w in iter_sentence_windows(document, tokens, chunk_size=1)]
+
+    assert keys[0] == keys[2]
+    assert len(set(keys)) == 3
+
+
+def test_sentence_cache_evicts_least_recently_used():
+    cache = SentenceCache(max_entries=2)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    assert cache.get("a") == [1]
+
+    cache.put("c", [3])
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ([1], [3])
+    assert (len(cache), cache.hits, cache.misses) == (2, 3, 1)
+
+
+def test_get_prediction_cache_prefix_reads_metadata_once_per_generation(tmpdir, monkeypatch):
+    store = ClassifierStore(Path(tmpdir))
+    store.add_classifier("classifier", DummyClassifier())
+    classifier = store.get_classifier("classifier")
+    nlp = English()
+
+    reads = []
+    get_model_metadata = classifier._get_model_metadata
+    monkeypatch.setattr(classifier, "_get_model_metadata", lambda m: reads.append(m) or get_model_metadata(m))
+
+    assert get_prediction_cache_prefix(classifier, "model", nlp)[2] == 0
+
+    classifier._save_model("model", "model1")
+    reads.clear()
+    prefixes = {get_prediction_cache_prefix(classifier, "model", nlp) for _ in range(3)}
+    assert [prefix[2] for prefix in prefixes] == [1]
+    assert reads == ["model"]
+
+    classifier._save_model("model", "model2")
+    assert get_prediction_cache_prefix(classifier, "model", nlp)[2] == 2
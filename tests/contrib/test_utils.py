@@ -0,0 +1,69 @@
+from galahad.formats import build_sentence_classification_document
+from galahad.server.annotations import Annotations
+from galahad.server.contrib.utils import (extract_covered_labels,
+                                          sort_by_offsets)
+from galahad.server.dataclasses import Annotation, Document
+
+
+def _extract_with_annotations(documents):
+    texts = []
+    labels = []
+    for document in documents:
+        annotations = Annotations.from_dict(document.text, document.annotations)
+        for sentence in annotations.select("t.sentence"):
+            for sentence_label in annotations.select_covered("t.annotation", sentence):
+                label = sentence_label.features.get("f.value")
+                if label is not None:
+                    texts.append(annotations.get_covered_text(sentence_label))
+                    labels.append(label)
+
+    return texts, labels
+
+
+def test_extract_covered_labels():
+    document = build_sentence_classification_document(["I like it.", "It is bad.", "So so."], ["pos", "neg", "neu"])
+
+    texts, labels = extract_covered_labels([document, document])
+
+    assert texts == ["I like it.", "It is bad.", "So so."] * 2
+    assert labels == ["pos", "neg", "neu"] * 2
+
+
+def test_extract_covered_labels_matches_select_covered():
+    text = "Aa bb cc. Dd ee."
+    document = Document(
+        text=text,
+        annotations={
+            "t.sentence": [
+                {"begin": 10, "end": 16},
+                {"begin": 0, "end": 9},
+                {"begin": 0, "end": 16},
+            ],
+            "t.annotation": [
+                {"begin": 13, "end": 15, "features": {"f.value": "e"}},
+                {"begin": 0, "end": 2, "features": {"f.value": "a"}},
+                {"begin": 6, "end": 12, "features": {"f.value": "crossing"}},
+                {"begin": 3, "end": 5, "features": {}},
+                {"begin": 10, "end": 16, "features": {"f.value": "sentence"}},
+                {"begin": 9, "end": 9, "features": {"f.value": "empty"}},
+            ],
+        },
+    )
+
+    texts, labels = extract_covered_labels([document])
+
+    assert (texts, labels) == _extract_with_annotations([document])
+    assert labels == ["a", "empty", "a", "crossing", "empty", "sentence", "e", "sentence", "e"]
+
+
+def test_sort_by_offsets_returns_sorted_layer_as_is():
+    document = Document.parse_obj(Document.Config.schema_extra["example"])
+    tokens = document.annotations["t.token"]
+
+    assert sort_by_offsets(tokens) is tokens
+
+
+def test_sort_by_offsets_sorts_by_begin_and_end():
+    annotations = [Annotation(begin=4, end=6), Annotation(begin=0, end=3), Annotation(begin=0, end=2)]
+
+    assert [(a.begin, a.end) for a in sort_by_offsets(annotations)] == [(0, 2), (0, 3), (4, 6)]
@@ -1,13 +1,18 @@
-from typing import List, Optional
+from typing import Iterable, List, Optional
 
 from galahad.server.classifier import Classifier
 from galahad.server.dataclasses import Document
 
 
 class DummyClassifier(Classifier):
-    def train(self, model_id: str, documents: List[Document]):
+    def train(self, model_id: str, documents: Iterable[Document]):
         self._save_model(model_id, [d.json() for d in documents])
 
     def predict(self, model_id: str, document: Document) -> Optional[Document]:
         model = self._load_model(model_id)
         return document if model else None
+
+
+class TokenDummyClassifier(DummyClassifier):
+    def consumes(self) -> List[str]:
+        return ["t.token", "t.sentence"]
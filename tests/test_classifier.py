@@ -0,0 +1,283 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pytest
+
+from galahad.server.classifier import (ClassifierStore, ModelCache,
+                                       ModelPersistence, get_lock,
+                                       iter_documents, train_classifier)
+from galahad.server.dataclasses import Document
+from tests.fixtures import DummyClassifier
+
+
+def test_model_cache_evicts_least_recently_used_model_over_budget():
+    cache = ModelCache(memory_budget=100)
+
+    cache.put(("classifier", "model1"), "model1", 40, (1, 40))
+    cache.put(("classifier", "model2"), "model2", 40, (1, 40))
+    assert cache.get(("classifier", "model1"), (1, 40)) == "model1"
+
+    cache.put(("classifier", "model3"), "model3", 40, (1, 40))
+
+    resident = [(m.classifier_name, m.model_id) for m in cache.get_resident_models()]
+    assert resident == [("classifier", "model1"), ("classifier", "model3")]
+    assert cache.total_size == 80
+    assert cache.get_statistics()["classifier", "eviction"] == 1
+
+
+def test_model_cache_does_not_cache_models_larger_than_budget():
+    cache = ModelCache(memory_budget=100)
+
+    cache.put(("classifier", "model1"), "model1", 101, (1, 101))
+
+    assert cache.get(("classifier", "model1"), (1, 101)) is None
+    assert cache.total_size == 0
+
+
+def test_model_cache_evicts_idle_models():
+    cache = ModelCache(idle_timeout=0.05)
+
+    cache.put(("classifier", "model1"), "model1", 10, (1, 10))
+    time.sleep(0.1)
+    cache.put(("classifier", "model2"), "model2", 10, (1, 10))
+
+    assert cache.evict_idle() == 1
+    assert [m.model_id for m in cache.get_resident_models()] == ["model2"]
+
+
+def test_model_cache_invalidates_stale_models():
+    cache = ModelCache()
+
+    cache.put(("classifier", "model1"), "model1", 10, (1, 10))
+
+    assert cache.get(("classifier", "model1"), (2, 10)) is None
+    assert cache.get_resident_models() == []
+
+
+def test_model_cache_does_not_count_replaced_models_as_evictions():
+    cache = ModelCache()
+
+    cache.put(("classifier", "model1"), "model1", 10, (1, 10))
+    cache.put(("classifier", "model1"), "model1", 10, (2, 10))
+    assert cache.get(("classifier", "model1"), (3, 10)) is None
+
+    assert ("classifier", "eviction") not in cache.get_statistics()
+
+    cache.put(("classifier", "model1"), "model1", 10, (3, 10))
+    cache.evict(("classifier", "model1"))
+    assert cache.get_statistics()["classifier", "eviction"] == 1
+
+
+def test_classifier_store_reloads_evicted_model(tmpdir):
+    store = ClassifierStore(Path(tmpdir), memory_budget=10_000)
+    classifier = DummyClassifier()
+    store.add_classifier("classifier", classifier)
+
+    document = Document.parse_obj(Document.Config.schema_extra["example"])
+    classifier.train("model", [document])
+
+    assert classifier.predict("model", document) == document
+    assert [m.model_id for m in store.get_resident_models().models] == ["model"]
+
+    store.model_cache.evict(("classifier", "model"))
+    assert store.get_resident_models().models == []
+
+    assert classifier.predict("model", document) == document
+    assert [m.model_id for m in store.get_resident_models().models] == ["model"]
+
+
+def test_classifier_store_loads_model_once_for_concurrent_requests(tmpdir, monkeypatch):
+    store = ClassifierStore(Path(tmpdir))
+    store.add_classifier("classifier", DummyClassifier())
+    classifier = store.get_classifier("classifier")
+    classifier._save_model("model", "model")
+
+    loads = []
+
+    def slow_load(*args, **kwargs):
+        loads.append(args)
+        time.sleep(0.2)
+        return "model"
+
+    monkeypatch.setattr(joblib, "load", slow_load)
+
+    with ThreadPoolExecutor(4) as executor:
+        models = list(executor.map(lambda _: classifier._load_model("model"), range(4)))
+
+    assert models == ["model"] * 4
+    assert len(loads) == 1
+    assert store.model_cache.get_statistics()["classifier", "shared_load"] == 3
+
+
+@pytest.mark.parametrize(
+    "persistence, expect_memmap",
+    [(ModelPersistence.DEFAULT, False), (ModelPersistence.MMAP, True), (ModelPersistence.COMPRESSED, False)],
+)
+def test_model_persistence(tmpdir, persistence: ModelPersistence, expect_memmap: bool):
+    classifier = DummyClassifier(persistence=persistence)
+    classifier._model_directory = Path(tmpdir)
+
+    model = {"coefficients": np.arange(10_000, dtype=np.float64)}
+    classifier._save_model("model", model)
+    loaded_model = classifier._load_model("model")
+
+    assert np.array_equal(loaded_model["coefficients"], model["coefficients"])
+    assert isinstance(loaded_model["coefficients"], np.memmap) == expect_memmap
+
+
+def test_classifier_store_namespaces_models_by_registered_name(tmpdir):
+    store = ClassifierStore(Path(tmpdir))
+    classifier = DummyClassifier()
+
+    store.add_classifier("classifier1", classifier)
+    store.add_classifier("classifier2", classifier)
+
+    classifier1 = store.get_classifier("classifier1")
+    classifier2 = store.get_classifier("classifier2")
+
+    assert classifier1 is classifier
+    assert classifier1.name == "classifier1"
+    assert classifier2.name == "classifier2"
+    assert classifier1._get_model_path("model") != classifier2._get_model_path("model")
+
+    document = Document.parse_obj(Document.Config.schema_extra["example"])
+    classifier1.train("model", [document])
+
+    assert classifier1.predict("model", document) == document
+    assert classifier2.predict("model", document) is None
+
+
+def test_train_classifier_locks_per_classifier_and_model(tmpdir):
+    tmpdir = Path(tmpdir)
+    dataset_folder = tmpdir / "dataset"
+    dataset_folder.mkdir()
+    (dataset_folder / "document").write_text(Document.parse_obj(Document.Config.schema_extra["example"]).json())
+
+    store = ClassifierStore(tmpdir / "models")
+    store.add_classifier("classifier1", DummyClassifier())
+    store.add_classifier("classifier2", DummyClassifier())
+    lock_directory = tmpdir / "locks"
+
+    lock = get_lock(lock_directory / "classifier1", "model")
+    with lock:
+        assert train_classifier(store.get_classifier("classifier1"), dataset_folder, "model", lock_directory) is None
+
+        result = train_classifier(store.get_classifier("classifier2"), dataset_folder, "model", lock_directory)
+        assert result.document_count == 1
+
+
+@pytest.mark.parametrize("workers, processes", [(0, False), (2, False), (2, True)])
+def test_iter_documents_yields_documents_in_order(tmpdir, workers: int, processes: bool):
+    paths = []
+    for i in range(5):
+        path = Path(tmpdir) / f"document{i}"
+        path.write_text(Document(text=str(i), annotations={}).json())
+        paths.append(path)
+
+    documents = iter_documents(paths, workers=workers, processes=processes)
+
+    assert [document.text for document in documents] == ["0", "1", "2", "3", "4"]
+
+
+def test_iter_documents_parses_lazily_up_to_prefetch(tmpdir, monkeypatch):
+    paths = []
+    for i in range(10):
+        path = Path(tmpdir) / f"document{i}"
+        path.write_text(Document(text=str(i), annotations={}).json())
+        paths.append(path)
+
+    parsed = []
+    parse_file = Document.parse_file
+    monkeypatch.setattr(Document, "parse_file", lambda path: parsed.append(path) or parse_file(path))
+
+    documents = iter_documents(paths, workers=2, prefetch=3)
+    first = next(documents)
+    time.sleep(0.1)
+
+    assert first.text == "0"
+    assert len(parsed) == 4
+    documents.close()
+
+
+def test_train_classifier_streams_documents(tmpdir):
+    tmpdir = Path(tmpdir)
+    dataset_folder = tmpdir / "dataset"
+    dataset_folder.mkdir()
+    for i in range(3):
+        (dataset_folder / f"document{i}").write_text(Document(text=str(i), annotations={}).json())
+
+    store = ClassifierStore(tmpdir / "models")
+    store.add_classifier("classifier", DummyClassifier())
+    classifier = store.get_classifier("classifier")
+
+    result = train_classifier(classifier, dataset_folder, "model", tmpdir / "locks", loader_workers=2)
+
+    assert result.document_count == 3
+    assert len(classifier._load_model("model")) == 3
+
+
+def test_save_model_increments_generation(tmpdir):
+    store = ClassifierStore(Path(tmpdir))
+    store.add_classifier("classifier", DummyClassifier())
+    classifier = store.get_classifier("classifier")
+
+    assert classifier._get_model_metadata("model") is None
+
+    classifier._save_model("model", "model1")
+    assert classifier._get_model_metadata("model").generation == 1
+
+    classifier._save_model("model", "model2")
+    assert classifier._get_model_metadata("model").generation == 2
+
+    assert classifier._load_model("model") == "model2"
+    assert store.model_cache.get_generation(("classifier", "model")) == 2
+
+
+def test_store_serves_resident_model_while_updating_it(tmpdir):
+    store = ClassifierStore(Path(tmpdir))
+    store.add_classifier("classifier", DummyClassifier())
+    classifier = store.get_classifier("classifier")
+
+    classifier._save_model("model", "old model")
+    assert classifier._load_model("model") == "old model"
+
+    with store.updating_model("classifier", "model"):
+        classifier._save_model("model", "new model")
+        assert classifier._load_model("model") == "old model"
+
+        assert store.preload_model("classifier", "model")
+        assert classifier._load_model("model") == "new model"
+        assert store.model_cache.get_generation(("classifier", "model")) == 2
+
+    assert store.model_cache.get_statistics()["classifier", "stale_hit"] == 1
+
+
+def test_store_loads_retrained_model_when_not_updating_it(tmpdir):
+    store = ClassifierStore(Path(tmpdir))
+    store.add_classifier("classifier", DummyClassifier())
+    classifier = store.get_classifier("classifier")
+
+    classifier._save_model("model", "old model")
+    assert classifier._load_model("model") == "old model"
+
+    classifier._save_model("model", "new model")
+    assert classifier._load_model("model") == "new model"
+
+
+def test_store_preload_model_without_model(tmpdir):
+    store = ClassifierStore(Path(tmpdir))
+    store.add_classifier("classifier", DummyClassifier())
+
+    assert not store.preload_model("classifier", "model")
+    assert not store.preload_model("unknown", "model")
+
+
+def test_train_classifier_when_dataset_was_deleted(tmpdir):
+    tmpdir = Path(tmpdir)
+    store = ClassifierStore(tmpdir / "models")
+    store.add_classifier("classifier", DummyClassifier())
+
+    assert train_classifier(store.get_classifier("classifier"), tmpdir / "dataset", "model", tmpdir / "locks") is None
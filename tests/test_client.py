@@ -8,10 +8,10 @@ import pytest
 import uvicorn
 from uvicorn import Config
 
-from galahad.client import GalahadClient, HTTPError
+from galahad.client import GalahadClient, HTTPError, compute_document_patch
 from galahad.server import GalahadServer
-from galahad.server.dataclasses import ClassifierInfo, Document
-from tests.fixtures import DummyClassifier
+from galahad.server.dataclasses import Annotation, ClassifierInfo, Document
+from tests.fixtures import DummyClassifier, TokenDummyClassifier
 
 HOST = "127.0.0.1"
 PORT = 8000
@@ -81,6 +81,7 @@ def server():
     galahad.add_classifier("classifier1", classifier)
     galahad.add_classifier("classifier2", classifier)
     galahad.add_classifier("classifier3", classifier)
+    galahad.add_classifier("token_classifier", TokenDummyClassifier())
 
     config = Config(galahad, host=HOST, port=PORT, log_level="debug")
     server = UvicornTestServer(config)
@@ -281,6 +282,78 @@ def test_dataset_contains_document_naming(client: GalahadClient, dataset_id, doc
         client.dataset_contains_document(dataset_id, document_id)
 
 
+def test_get_document_in_dataset(client: GalahadClient):
+    start_capturing_session(client, "test_get_document_in_dataset")
+
+    client.create_dataset("dataset1")
+    client.create_document_in_dataset("dataset1", "doc1", EXAMPLE_DOCUMENT)
+
+    assert client.get_document_in_dataset("dataset1", "doc1") == EXAMPLE_DOCUMENT
+
+    document = client.get_document_in_dataset("dataset1", "doc1", layers=["t.sentence"], begin=27)
+    assert document.text == "The train was late ."
+    assert [(s.begin, s.end) for s in document.annotations["t.sentence"]] == [(0, 20)]
+    assert set(document.annotations) == {"t.sentence"}
+
+
+def test_compute_document_patch():
+    new_document = EXAMPLE_DOCUMENT.copy(deep=True)
+    new_document.version += 1
+    new_document.annotations["t.named_entity"] = [
+        Annotation(begin=19, end=24, features={"f.value": "OBJ"}),
+        *EXAMPLE_DOCUMENT.annotations["t.named_entity"],
+    ]
+    del new_document.annotations["t.sentence"][1]
+
+    patch = compute_document_patch(EXAMPLE_DOCUMENT, new_document)
+
+    assert patch.base_version == EXAMPLE_DOCUMENT.version
+    assert patch.version == new_document.version
+    assert patch.add == {"t.named_entity": [Annotation(begin=19, end=24, features={"f.value": "OBJ"})]}
+    assert patch.remove == {"t.sentence": [EXAMPLE_DOCUMENT.annotations["t.sentence"][1]]}
+    assert compute_document_patch(new_document, new_document.copy(update={"version": 25})).add == {}
+
+    with pytest.raises(ValueError):
+        compute_document_patch(new_document, new_document)
+
+
+def test_update_document_in_dataset(client: GalahadClient):
+    start_capturing_session(client, "test_update_document_in_dataset")
+
+    client.create_dataset("dataset1")
+    client.create_document_in_dataset("dataset1", "doc1", EXAMPLE_DOCUMENT)
+
+    new_document = EXAMPLE_DOCUMENT.copy(deep=True)
+    new_document.version += 1
+    new_document.annotations["t.named_entity"] = []
+
+    client.update_document_in_dataset("dataset1", "doc1", EXAMPLE_DOCUMENT, new_document)
+    assert client.get_document_in_dataset("dataset1", "doc1") == new_document
+
+    # The stored document is not the old one anymore, so the document is uploaded as a whole
+    newer_document = EXAMPLE_DOCUMENT.copy(deep=True)
+    newer_document.version += 2
+    assert not client.patch_document_in_dataset(
+        "dataset1", "doc1", compute_document_patch(EXAMPLE_DOCUMENT, newer_document)
+    )
+
+    client.update_document_in_dataset("dataset1", "doc1", EXAMPLE_DOCUMENT, newer_document)
+    assert client.get_document_in_dataset("dataset1", "doc1") == newer_document
+
+
+def test_update_document_in_dataset_if_document_does_not_exist(client: GalahadClient):
+    start_capturing_session(client, "test_update_document_in_dataset_if_document_does_not_exist")
+
+    client.create_dataset("dataset1")
+
+    new_document = EXAMPLE_DOCUMENT.copy(deep=True)
+    new_document.version += 1
+    new_document.annotations["t.named_entity"] = []
+
+    client.update_document_in_dataset("dataset1", "doc1", EXAMPLE_DOCUMENT, new_document)
+    assert client.get_document_in_dataset("dataset1", "doc1") == new_document
+
+
 def test_delete_document_in_dataset(client: GalahadClient):
     start_capturing_session(client, "test_delete_document_in_dataset")
 
@@ -327,6 +400,7 @@ def test_list_all_classifiers(client: GalahadClient):
         ClassifierInfo.parse_obj({"name": "classifier1"}),
         ClassifierInfo.parse_obj({"name": "classifier2"}),
         ClassifierInfo.parse_obj({"name": "classifier3"}),
+        ClassifierInfo.parse_obj({"name": "token_classifier", "consumes": ["t.token", "t.sentence"]}),
     ]
 
     assert client.list_all_classifiers() == expected_infos
@@ -350,6 +424,35 @@ def test_get_classifier_info_naming(client: GalahadClient):
         client.get_classifier_info("-")
 
 
+def test_get_model_info(client: GalahadClient):
+    start_capturing_session(client, "test_get_model_info")
+
+    assert client.get_model_info("classifier2", "model1") is None
+
+    client.create_document_in_dataset("dataset1", "document1", EXAMPLE_DOCUMENT, True)
+    client.train_on_dataset("classifier2", "model1", "dataset1")
+
+    for _ in range(50):
+        model_info = client.get_model_info("classifier2", "model1")
+        if model_info is not None:
+            break
+        sleep(0.1)
+
+    assert model_info is not None
+    assert model_info.generation == 1
+    assert model_info.document_count == 1
+
+    # Not modified, the previous response is reused
+    assert client.get_model_info("classifier2", "model1") is model_info
+
+
+def test_get_model_info_if_classifier_does_not_exist(client: GalahadClient):
+    start_capturing_session(client, "test_get_model_info_if_classifier_does_not_exist")
+
+    with pytest.raises(HTTPError):
+        client.get_model_info("classifier4", "model1")
+
+
 # TODO: train for long time such that client.train_on_dataset("classifier1", "model1", "dataset1") is false
 def test_train_on_dataset(client: GalahadClient):
     start_capturing_session(client, "test_train_on_dataset")
@@ -397,6 +500,39 @@ def test_predict_on_document(client: GalahadClient):
     assert doc == predicted_doc
 
 
+def test_predict_on_document_with_only_consumed_layers(client: GalahadClient):
+    start_capturing_session(client, "test_predict_on_document_with_only_consumed_layers")
+
+    doc = EXAMPLE_DOCUMENT
+
+    client.create_dataset("dataset1")
+    client.create_document_in_dataset("dataset1", "doc1", doc)
+    client.train_on_dataset("token_classifier", "model1", "dataset1")
+    # Training runs in the background, predicting before it finished would not find the model
+    for _ in range(50):
+        model_info = client.get_model_info("token_classifier", "model1")
+        if model_info is not None:
+            break
+        sleep(0.1)
+
+    assert model_info is not None
+    client.delete_dataset("dataset1")
+
+    sent_layers = []
+
+    def record_sent_layers(response, *args, **kwargs):
+        if response.request.url.endswith("/predict"):
+            sent_layers.append(set(json.loads(response.request.body)["annotations"]))
+
+    client._session.hooks["response"].append(record_sent_layers)
+
+    predicted_doc = client.predict_on_document("token_classifier", "model1", doc, only_consumed_layers=True)
+
+    assert sent_layers == [{"t.token", "t.sentence"}]
+    assert set(predicted_doc["annotations"]) == {"t.token", "t.sentence"}
+    assert "t.named_entity" in doc.annotations
+
+
 def test_predict_on_document_if_classifier_does_not_exist(client: GalahadClient):
     start_capturing_session(client, "test_predict_on_document_if_classifier_does_not_exist")
 
@@ -1,8 +1,11 @@
+import pickle
+
 import pytest
 
-from galahad.server.annotations import Annotations
+from galahad.server.annotations import (EMPTY_FEATURES, AnnotationRecord,
+                                        Annotations)
 from galahad.server.classifier import AnnotationTypes
-from galahad.server.dataclasses import Document
+from galahad.server.dataclasses import Annotation, Document
 
 
 @pytest.fixture
@@ -55,3 +58,190 @@ def test_select_covered(document: Document):
 
     assert actual_tokens_in_first_sentence == tokens_in_first_sentence
     assert actual_tokens_in_second_sentence == tokens_in_second_sentence
+
+
+def _brute_force(annotations, predicate):
+    return [a for a in annotations if predicate(a)]
+
+
+@pytest.fixture
+def nested_annotations() -> Annotations:
+    # Nested, overlapping, duplicate and empty spans
+    spans = [(0, 30), (0, 10), (2, 5), (2, 5), (4, 12), (10, 10), (10, 20), (15, 30), (25, 26), (29, 30)]
+    annotations = Annotations("x" * 30)
+    for begin, end in spans:
+        annotations.create_annotation("span", begin, end)
+
+    return annotations
+
+
+QUERIES = [(0, 30), (3, 4), (2, 5), (10, 10), (10, 12), (12, 16), (26, 29), (30, 30), (0, 0)]
+
+
+@pytest.mark.parametrize("begin, end", QUERIES)
+def test_select_covering(nested_annotations: Annotations, begin: int, end: int):
+    spans = nested_annotations.select("span")
+    query = Annotation(begin=begin, end=end)
+
+    expected = _brute_force(spans, lambda a: a.begin <= begin and a.end >= end)
+    assert nested_annotations.select_covering("span", query) == expected
+
+
+@pytest.mark.parametrize("begin, end", QUERIES)
+def test_select_overlapping(nested_annotations: Annotations, begin: int, end: int):
+    spans = nested_annotations.select("span")
+    query = Annotation(begin=begin, end=end)
+
+    expected = _brute_force(spans, lambda a: a.begin < end and begin < a.end and a.begin < a.end and begin < end)
+    assert nested_annotations.select_overlapping("span", query) == expected
+
+
+def test_interval_queries_with_long_early_annotation():
+    annotations = Annotations("x" * 1000)
+    annotations.create_annotation("span", 0, 1000)
+    for begin in range(0, 998, 2):
+        annotations.create_annotation("span", begin, begin + 3)
+    spans = annotations.select("span")
+
+    for begin, end in [(0, 1), (500, 501), (501, 504), (997, 1000), (1000, 1000)]:
+        query = Annotation(begin=begin, end=end)
+        covering = _brute_force(spans, lambda a: a.begin <= begin and a.end >= end)
+        overlapping = _brute_force(spans, lambda a: a.begin < end and begin < a.end and begin < end)
+
+        assert annotations.select_covering("span", query) == covering
+        assert annotations.select_overlapping("span", query) == overlapping
+
+
+@pytest.mark.parametrize("begin, end", QUERIES)
+def test_select_preceding_and_following(nested_annotations: Annotations, begin: int, end: int):
+    spans = nested_annotations.select("span")
+    query = Annotation(begin=begin, end=end)
+
+    assert nested_annotations.select_preceding("span", query) == _brute_force(spans, lambda a: a.end <= begin)
+    assert nested_annotations.select_following("span", query) == _brute_force(spans, lambda a: a.begin >= end)
+
+
+def test_select_preceding_and_following_with_count(document: Document):
+    annotations = Annotations.from_dict(document.text, document.annotations)
+    tokens = annotations.select(AnnotationTypes.TOKEN.value)
+
+    assert annotations.select_preceding(AnnotationTypes.TOKEN.value, tokens[5], count=2) == tokens[3:5]
+    assert annotations.select_following(AnnotationTypes.TOKEN.value, tokens[5], count=2) == tokens[6:8]
+    assert annotations.select_preceding(AnnotationTypes.TOKEN.value, tokens[0], count=2) == []
+    assert annotations.select_following(AnnotationTypes.TOKEN.value, tokens[-1], count=2) == []
+
+
+def test_select_covering_many(document: Document):
+    annotations = Annotations.from_dict(document.text, document.annotations)
+    tokens = annotations.select(AnnotationTypes.TOKEN.value)
+    first_sentence, second_sentence = annotations.select(AnnotationTypes.SENTENCE.value)
+
+    sentences = annotations.select_covering_many(AnnotationTypes.SENTENCE.value, tokens)
+
+    assert sentences == [[first_sentence]] * 6 + [[second_sentence]] * 5
+
+
+def test_interval_queries_see_created_annotations(document: Document):
+    annotations = Annotations.from_dict(document.text, document.annotations)
+    token = annotations.select(AnnotationTypes.TOKEN.value)[0]
+    assert annotations.select_overlapping_many(AnnotationTypes.ANNOTATION.value, [token]) == [[]]
+
+    entity = annotations.create_annotation(AnnotationTypes.ANNOTATION.value, 0, 3, {"f.value": "PER"})
+
+    assert annotations.select_overlapping_many(AnnotationTypes.ANNOTATION.value, [token]) == [[entity]]
+
+
+def test_select_by_feature(document: Document):
+    annotations = Annotations.from_dict(document.text, document.annotations)
+
+    entities = annotations.select_by_feature("t.named_entity", "f.value", "PER")
+
+    assert [annotations.get_covered_text(e) for e in entities] == ["Joe"]
+    assert annotations.select_by_feature("t.named_entity", "f.value", "LOC") == []
+    assert annotations.select_by_feature("t.unknown", "f.value", "PER") == []
+
+
+def test_feature_index_is_kept_up_to_date(document: Document):
+    annotations = Annotations.from_dict(
+        document.text, document.annotations, indexed_features={"t.named_entity": ["f.value"]}
+    )
+
+    train = annotations.create_annotation("t.named_entity", 19, 24, {"f.value": "OBJ"})
+    other_train = annotations.create_annotation("t.named_entity", 31, 36, {"f.value": "OBJ"})
+    annotations.create_annotation("t.named_entity", 0, 3, {"f.value": ["unhashable"]})
+    annotations.create_annotation("t.named_entity", 0, 3)
+
+    assert annotations.select_by_feature("t.named_entity", "f.value", "OBJ") == [train, other_train]
+    assert annotations.count_feature_values("t.named_entity", "f.value") == {"PER": 1, "OBJ": 2}
+
+
+def test_queries_for_unknown_types_do_not_add_layers(document: Document):
+    annotations = Annotations.from_dict(document.text, document.annotations)
+    token = annotations.select(AnnotationTypes.TOKEN.value)[0]
+
+    assert annotations.select("t.unknown") == []
+    assert annotations.select_by_feature("t.unknown", "f.value", "PER") == []
+    assert annotations.select_covered("t.unknown", token) == []
+    assert annotations.select_covering("t.unknown", token) == []
+    assert annotations.select_overlapping("t.unknown", token) == []
+    assert annotations.select_preceding("t.unknown", token) == []
+
+    assert "t.unknown" not in annotations.get_annotations()
+    assert "t.unknown" not in annotations.to_dict()
+
+
+@pytest.mark.parametrize("presorted", [True, False])
+@pytest.mark.parametrize("num_annotations", [0, 1, 2500])
+def test_from_dict_builds_sorted_index(presorted: bool, num_annotations: int):
+    annotations = [Annotation(begin=i // 2, end=i // 2 + i % 3) for i in range(num_annotations)]
+    expected = sorted(annotations, key=lambda a: (a.begin, a.end))
+    if not presorted:
+        annotations.reverse()
+
+    result = Annotations.from_dict("x" * num_annotations, {"span": annotations})
+
+    result._index["span"]._check()
+    assert result.select("span") == expected
+
+
+def test_from_document_does_not_change_document(document: Document):
+    num_tokens = len(document.annotations["t.token"])
+    annotations = Annotations.from_document(document)
+
+    assert annotations.get_annotations() == document.annotations
+
+    annotations.create_annotation("t.token", 0, 1)
+    annotations._index["t.token"]._check()
+    assert len(annotations.select("t.token")) == num_tokens + 1
+    assert len(document.annotations["t.token"]) == num_tokens
+
+
+def test_created_annotations_share_features(document: Document):
+    annotations = Annotations.from_dict(document.text, document.annotations)
+
+    token = annotations.create_annotation("t.token", 0, 3)
+    first = annotations.create_annotation("t.pos", 0, 3, {"f.value": "NNP"})
+    second = annotations.create_annotation("t.pos", 4, 10, {"f.value": "".join(["NN", "P"])})
+    unhashable = annotations.create_annotation("t.pos", 11, 14, {"f.value": ["NN"]})
+
+    assert isinstance(token, AnnotationRecord)
+    assert token.features is EMPTY_FEATURES
+    assert first.features is second.features
+    assert unhashable.features == {"f.value": ["NN"]}
+
+    with pytest.raises(TypeError):
+        first.features["f.value"] = "VBD"
+    assert pickle.loads(pickle.dumps(first.features)) == {"f.value": "NNP"}
+
+
+def test_get_annotations_returns_models(document: Document):
+    annotations = Annotations.from_dict(document.text, document.annotations)
+    record = annotations.create_annotation("t.pos", 0, 3, {"f.value": "NNP"})
+
+    (pos,) = annotations.get_annotations()["t.pos"]
+
+    assert isinstance(pos, Annotation)
+    assert record == pos
+    assert Document(text=document.text, annotations={"t.pos": [pos]}).dict()["annotations"]["t.pos"] == [
+        {"begin": 0, "end": 3, "features": {"f.value": "NNP"}}
+    ]
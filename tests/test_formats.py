@@ -1,4 +1,7 @@
+import pytest
+
 from galahad.formats import (Span, build_doc_from_tokens_and_text,
+                             build_docs_from_tokens_and_texts,
                              build_sentence_classification_document,
                              build_span_classification_request,
                              build_span_classification_response,
@@ -201,9 +204,12 @@ def test_build_token_labeling_response():
         {"begin": 60, "end": 61, "features": {"f.value": "."}},
     ]
 
+    original_doc = doc.copy(deep=True)
+
     assert build_token_labeling_response(doc, labels, version=0) == Document(
         **{"text": text, "version": 0, "annotations": annotations}
     )
+    assert doc == original_doc
 
 
 def test_span_sentence_classification_response_per_sentence():
@@ -256,3 +262,51 @@ def test_span_sentence_classification_response_per_sentence():
     assert third_ner.features[value_feature] == "TM"
     assert third_ner.begin == 18
     assert third_ner.end == 29
+
+
+def test_build_doc_from_tokens_and_text_with_gaps():
+    text = "  Joe  waited.\n\nThe train was late."
+    sentences = [["Joe", "waited", "."], ["The", "train", "was", "late", "."]]
+
+    doc = build_doc_from_tokens_and_text(text, sentences, version=3)
+
+    tokens = doc.annotations["t.token"]
+    assert [text[t.begin : t.end] for t in tokens] == [t for sentence in sentences for t in sentence]
+    assert [(s.begin, s.end) for s in doc.annotations["t.sentence"]] == [(2, 14), (16, 35)]
+    assert doc.version == 3
+
+
+def test_build_doc_from_tokens_and_text_when_token_is_missing():
+    with pytest.raises(ValueError, match=r"Token \[car\] \(sentence 0, token 2\)"):
+        build_doc_from_tokens_and_text("Joe waited .", [["Joe", "waited", "car"]])
+
+
+def test_build_doc_from_tokens_and_text_without_gaps():
+    text = "Joe -- waited ."
+    sentences = [["Joe", "waited", "."]]
+
+    assert len(build_doc_from_tokens_and_text(text, sentences).annotations["t.token"]) == 3
+
+    with pytest.raises(ValueError, match=r"skipped \[ -- \]"):
+        build_doc_from_tokens_and_text(text, sentences, allow_gaps=False)
+
+
+def test_build_doc_from_tokens_and_text_with_token_normalizer():
+    text = 'He said "hi" .'
+    sentences = [["He", "said", "``", "hi", "''", "."]]
+
+    doc = build_doc_from_tokens_and_text(
+        text, sentences, token_normalizer=lambda token: '"' if token in ("``", "''") else token
+    )
+
+    assert [text[t.begin : t.end] for t in doc.annotations["t.token"]] == ["He", "said", '"', "hi", '"', "."]
+
+
+def test_build_docs_from_tokens_and_texts():
+    texts = ["Joe waited .", "The train was late ."]
+    tokenized_texts = [[["Joe", "waited", "."]], [["The", "train"], ["was", "late", "."]]]
+
+    docs = build_docs_from_tokens_and_texts(texts, tokenized_texts)
+
+    assert docs == [build_doc_from_tokens_and_text(t, s) for t, s in zip(texts, tokenized_texts)]
+    assert len(docs[1].annotations["t.sentence"]) == 2
@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+from galahad.server.metrics import (MetricsMiddleware, MetricsRegistry,
+                                    RequestContext, ServerMetrics,
+                                    _current_request, timed)
+
+
+def test_render_counter_gauge_and_histogram():
+    registry = MetricsRegistry()
+
+    counter = registry.counter("test_events", "Number of events.", ["kind"])
+    gauge = registry.gauge("test_queue_depth", "Queue depth.")
+    histogram = registry.histogram("test_duration_seconds", "Duration.", ["route"], buckets=(0.1, 1.0))
+
+    counter.inc(kind="a")
+    counter.inc(2, kind="a")
+    gauge.set(3)
+    histogram.observe(0.05, route="/ping")
+    histogram.observe(0.5, route="/ping")
+    histogram.observe(5, route="/ping")
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE test_events counter" in lines
+    assert 'test_events_total{kind="a"} 3' in lines
+    assert "test_queue_depth 3" in lines
+    assert "# TYPE test_duration_seconds histogram" in lines
+    assert 'test_duration_seconds_bucket{route="/ping",le="0.1"} 1' in lines
+    assert 'test_duration_seconds_bucket{route="/ping",le="1"} 2' in lines
+    assert 'test_duration_seconds_bucket{route="/ping",le="+Inf"} 3' in lines
+    assert 'test_duration_seconds_sum{route="/ping"} 5.55' in lines
+    assert 'test_duration_seconds_count{route="/ping"} 3' in lines
+
+
+def test_timed_records_exclusive_stage_durations():
+    context = RequestContext()
+    token = _current_request.set(context)
+
+    try:
+        with timed("inference"):
+            with timed("index"):
+                time.sleep(0.05)
+    finally:
+        _current_request.reset(token)
+
+    assert context.stages["index"] >= 0.05
+    assert context.stages["inference"] < 0.05
+
+
+def test_timed_does_nothing_outside_of_request():
+    with timed("index"):
+        pass
+
+
+def test_metrics_middleware_does_not_time_background_work():
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 202, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+        # Like background tasks, which run after the response was sent
+        await asyncio.sleep(0.2)
+
+    async def send(message):
+        pass
+
+    metrics = ServerMetrics()
+    middleware = MetricsMiddleware(app, metrics=metrics, routes=[])
+    asyncio.run(middleware({"type": "http", "method": "POST", "path": "/train"}, None, send))
+
+    lines = metrics.render().splitlines()
+    assert 'galahad_request_duration_seconds_count{route="none",method="POST",status="202"} 1' in lines
+
+    duration_line = next(line for line in lines if line.startswith("galahad_request_duration_seconds_sum"))
+    assert float(duration_line.rsplit(" ", 1)[1]) < 0.2
@@ -0,0 +1,133 @@
+import pickle
+from pathlib import Path
+
+from galahad.server.classifier import ClassifierStore
+from galahad.server.dataclasses import Annotation, Document
+from galahad.server.prediction_cache import (PredictionCache,
+                                             precompute_predictions)
+from galahad.server.util import select_layers
+from tests.fixtures import DummyClassifier, TokenDummyClassifier
+
+
+def _create_dataset(dataset_folder: Path, count: int):
+    dataset_folder.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        (dataset_folder / f"document{i}").write_text(Document(text=str(i), annotations={}, version=i).json())
+
+
+def test_prediction_cache_serves_only_active_generation(tmpdir):
+    cache = PredictionCache(Path(tmpdir))
+    document = Document(text="text", annotations={}, version=1)
+
+    cache.put("classifier", "model", 1, document, "prediction1")
+    assert cache.get("classifier", "model", document) is None
+
+    cache.activate("classifier", "model", 1)
+    assert cache.get("classifier", "model", document) == b"prediction1"
+
+    # Predictions of the next generation are only served once it is activated
+    cache.put("classifier", "model", 2, document, "prediction2")
+    assert cache.get("classifier", "model", document) == b"prediction1"
+
+    cache.activate("classifier", "model", 2)
+    assert cache.get("classifier", "model", document) == b"prediction2"
+    assert not (Path(tmpdir) / "classifier" / "model" / "1").exists()
+
+
+def test_prediction_cache_is_keyed_by_document(tmpdir):
+    cache = PredictionCache(Path(tmpdir))
+    tokens = {"t.token": [Annotation(begin=0, end=4)]}
+    cache.put("classifier", "model", 1, Document(text="text", annotations=tokens, version=1), "prediction")
+    cache.activate("classifier", "model", 1)
+
+    assert cache.get("classifier", "model", Document(text="text", annotations=tokens, version=1)) == b"prediction"
+    assert cache.get("classifier", "model", Document(text="text", annotations=tokens, version=2)) is None
+    assert cache.get("classifier", "model", Document(text="other", annotations=tokens, version=1)) is None
+    assert cache.get("other", "model", Document(text="text", annotations=tokens, version=1)) is None
+
+    # Edited layers invalidate the prediction even if the version stays the same
+    edited_tokens = {"t.token": [Annotation(begin=0, end=2), Annotation(begin=2, end=4)]}
+    assert cache.get("classifier", "model", Document(text="text", annotations=edited_tokens, version=1)) is None
+    assert cache.get("classifier", "model", Document(text="text", annotations={}, version=1)) is None
+
+
+def test_prediction_cache_does_not_activate_older_generation(tmpdir):
+    cache = PredictionCache(Path(tmpdir))
+    document = Document(text="text", annotations={}, version=1)
+
+    cache.put("classifier", "model", 2, document, "prediction2")
+    cache.activate("classifier", "model", 2)
+    cache.activate("classifier", "model", 1)
+
+    assert cache.get_active_generation("classifier", "model") == 2
+    assert PredictionCache(Path(tmpdir)).get("classifier", "model", document) == b"prediction2"
+
+
+def test_precompute_predictions(tmpdir):
+    tmpdir = Path(tmpdir)
+    _create_dataset(tmpdir / "dataset", 5)
+
+    store = ClassifierStore(tmpdir / "models")
+    store.add_classifier("classifier", DummyClassifier())
+    classifier = store.get_classifier("classifier")
+    classifier.train("model", [Document(text="0", annotations={})])
+
+    cache = PredictionCache(tmpdir / "predictions")
+    assert precompute_predictions(classifier, "model", tmpdir / "dataset", cache, batch_size=2) == 5
+
+    for i in range(5):
+        document = Document(text=str(i), annotations={}, version=i)
+        assert Document.parse_raw(cache.get("classifier", "model", document)) == document
+
+
+def test_precompute_predictions_only_keeps_consumed_layers(tmpdir):
+    tmpdir = Path(tmpdir)
+    (tmpdir / "dataset").mkdir()
+    document = Document(**Document.Config.schema_extra["example"])
+    (tmpdir / "dataset" / "document").write_text(document.json())
+
+    store = ClassifierStore(tmpdir / "models")
+    store.add_classifier("classifier", TokenDummyClassifier())
+    classifier = store.get_classifier("classifier")
+    classifier.train("model", [document])
+
+    cache = PredictionCache(tmpdir / "predictions")
+    precompute_predictions(classifier, "model", tmpdir / "dataset", cache)
+
+    # Predictions are looked up by the document with only the consumed layers, like predict requests send it
+    assert cache.get("classifier", "model", document) is None
+    request = document.copy(update={"annotations": select_layers(document.annotations, classifier.consumes())})
+
+    prediction = Document.parse_raw(cache.get("classifier", "model", request))
+    assert set(prediction.annotations) == {"t.token", "t.sentence"}
+
+
+def test_precompute_predictions_without_model_or_dataset(tmpdir):
+    tmpdir = Path(tmpdir)
+    _create_dataset(tmpdir / "dataset", 1)
+
+    store = ClassifierStore(tmpdir / "models")
+    store.add_classifier("classifier", DummyClassifier())
+    classifier = store.get_classifier("classifier")
+    cache = PredictionCache(tmpdir / "predictions")
+
+    assert precompute_predictions(classifier, "model", tmpdir / "dataset", cache) == 0
+
+    classifier.train("model", [Document(text="0", annotations={})])
+    assert precompute_predictions(classifier, "model", tmpdir / "missing", cache) == 0
+    assert cache.get_active_generation("classifier", "model") is None
+
+
+def test_prediction_cache_reloads_generation_activated_by_other_process(tmpdir):
+    cache = PredictionCache(Path(tmpdir))
+    document = Document(text="text", annotations={}, version=1)
+    assert cache.get("classifier", "model", document) is None
+
+    # Like the copy that precomputes predictions in a worker process
+    other_cache = pickle.loads(pickle.dumps(cache))
+    other_cache.put("classifier", "model", 1, document, "prediction")
+    other_cache.activate("classifier", "model", 1)
+
+    assert cache.get("classifier", "model", document) is None
+    cache.reload("classifier", "model")
+    assert cache.get("classifier", "model", document) == b"prediction"
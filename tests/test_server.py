@@ -1,16 +1,23 @@
+import asyncio
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from typing import Optional
 
 import pytest
+from fastapi import BackgroundTasks
 from fastapi.testclient import TestClient
 
 from galahad.server import GalahadServer
-from galahad.server.classifier import Classifier
-from galahad.server.dataclasses import Document, DocumentList
-from galahad.server.util import get_dataset_folder, get_document_path
-from tests.fixtures import DummyClassifier
+from galahad.server.classifier import Classifier, get_lock
+from galahad.server.dataclasses import (Document, DocumentList, DocumentPatch,
+                                        ModelInfo)
+from galahad.server.profiling import RequestProfiler
+from galahad.server.util import DataDirectory
+from tests.fixtures import DummyClassifier, TokenDummyClassifier
 
 tmpdir: Optional[Path] = None
 
@@ -57,7 +64,7 @@ def test_list_datasets(client: TestClient):
         response = client.put(f"/dataset/{name}")
         assert response.status_code == 204
         assert response.text == ""
-        assert get_dataset_folder(tmpdir, name).is_dir()
+        assert DataDirectory(tmpdir).get_dataset_folder(name).is_dir()
 
     response = client.get("/dataset")
     assert response.status_code == 200
@@ -71,14 +78,14 @@ def test_create_dataset_when_dataset_does_not_already_exist(client: TestClient):
     response = client.put("/dataset/test_dataset")
     assert response.status_code == 204
     assert response.text == ""
-    assert get_dataset_folder(tmpdir, "test_dataset").is_dir()
+    assert DataDirectory(tmpdir).get_dataset_folder("test_dataset").is_dir()
 
 
 def test_create_dataset_when_dataset_exist_already(client: TestClient):
     response = client.put("/dataset/test_dataset")
     assert response.status_code == 204
     assert response.text == ""
-    assert get_dataset_folder(tmpdir, "test_dataset").is_dir()
+    assert DataDirectory(tmpdir).get_dataset_folder("test_dataset").is_dir()
 
     response = client.put("/dataset/test_dataset")
     assert response.status_code == 409
@@ -95,7 +102,7 @@ def test_delete_dataset_when_dataset_does_not_already_exist(client: TestClient):
 
 
 def test_delete_dataset_when_dataset_exist_already(client: TestClient):
-    p = get_dataset_folder(tmpdir, "test_dataset")
+    p = DataDirectory(tmpdir).get_dataset_folder("test_dataset")
     client.put("/dataset/test_dataset")
     assert p.is_dir()
 
@@ -110,6 +117,16 @@ def test_delete_dataset_when_dataset_exist_already(client: TestClient):
     assert not p.exists()
 
 
+def test_delete_dataset_deletes_its_cache(server: GalahadServer, client: TestClient):
+    cache_folder = server.state.data_directory.get_dataset_cache_folder("test_dataset") / "test_classifier"
+    client.put("/dataset/test_dataset")
+    cache_folder.mkdir(parents=True)
+
+    response = client.delete("/dataset/test_dataset")
+    assert response.status_code == 204
+    assert not cache_folder.parent.exists()
+
+
 # GET list_documents_in_dataset
 
 
@@ -141,7 +158,7 @@ def test_list_documents_in_dataset(client: TestClient):
         assert response.status_code == 204
         assert response.text == ""
 
-        p = get_document_path(tmpdir, "test_dataset", name)
+        p = DataDirectory(tmpdir).get_document_path("test_dataset", name)
         assert p.is_file()
 
     response = client.get("/dataset/test_dataset")
@@ -171,7 +188,7 @@ def test_add_document_to_dataset_when_document_does_not_already_exist(client: Te
     assert response.status_code == 204
     assert response.text == ""
 
-    p = get_document_path(tmpdir, "test_dataset", "test_document")
+    p = DataDirectory(tmpdir).get_document_path("test_dataset", "test_document")
 
     assert p.is_file()
 
@@ -181,6 +198,126 @@ def test_add_document_to_dataset_when_document_does_not_already_exist(client: Te
     assert document == request
 
 
+# GET get_document_in_dataset
+
+
+def test_get_document_in_dataset(client: TestClient):
+    client.put("/dataset/test_dataset")
+    request = Document.Config.schema_extra["example"]
+    client.put("/dataset/test_dataset/test_document", json=request)
+
+    response = client.get("/dataset/test_dataset/test_document")
+
+    assert response.status_code == 200
+    assert Document.parse_raw(response.content) == Document.parse_obj(request)
+
+
+def test_get_document_in_dataset_with_layers_and_range(client: TestClient):
+    client.put("/dataset/test_dataset")
+    request = Document.Config.schema_extra["example"]
+    client.put("/dataset/test_dataset/test_document", json=request)
+
+    # The second sentence, "The train was late ."
+    params = {"layers": ["t.token", "t.sentence"], "begin": 27, "end": 47}
+    response = client.get("/dataset/test_dataset/test_document", params=params)
+
+    assert response.status_code == 200
+    document = Document.parse_raw(response.content)
+    assert document.text == "The train was late ."
+    assert set(document.annotations) == {"t.token", "t.sentence"}
+    assert [(s.begin, s.end) for s in document.annotations["t.sentence"]] == [(0, 20)]
+    assert [document.text[t.begin : t.end] for t in document.annotations["t.token"]] == document.text.split(" ")
+
+
+@pytest.mark.parametrize(
+    "dataset_id, document_id, expected",
+    [
+        ("test_dataset", "missing", "Document with id [missing] not found in dataset [test_dataset]."),
+        ("missing", "test_document", "Dataset with id [missing] not found."),
+    ],
+)
+def test_get_document_in_dataset_when_it_does_not_exist(client: TestClient, dataset_id, document_id, expected):
+    client.put("/dataset/test_dataset")
+    client.put("/dataset/test_dataset/test_document", json=Document.Config.schema_extra["example"])
+
+    response = client.get(f"/dataset/{dataset_id}/{document_id}")
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": expected}
+
+
+# PATCH patch_document_in_dataset
+
+
+def test_patch_document_in_dataset(client: TestClient):
+    client.put("/dataset/test_dataset")
+    client.put("/dataset/test_dataset/test_document", json={**Document.Config.schema_extra["example"], "version": 23})
+    patch = DocumentPatch.Config.schema_extra["example"]
+
+    response = client.patch("/dataset/test_dataset/test_document", json=patch)
+
+    assert response.status_code == 204
+    document = Document.parse_raw(client.get("/dataset/test_dataset/test_document").content)
+    assert document.version == 24
+    assert document.annotations["t.named_entity"] == [{"begin": 19, "end": 24, "features": {"f.value": "OBJ"}}]
+    assert len(document.annotations["t.token"]) == 11
+
+    # The same patch does not apply to the new version anymore
+    response = client.patch("/dataset/test_dataset/test_document", json=patch)
+
+    assert response.status_code == 409
+    assert response.json() == {"detail": "Document with id [test_document] has version [24], not [23]."}
+
+
+def test_patch_document_in_dataset_when_removed_annotation_is_missing(client: TestClient):
+    client.put("/dataset/test_dataset")
+    client.put("/dataset/test_dataset/test_document", json={**Document.Config.schema_extra["example"], "version": 23})
+    patch = {"base_version": 23, "version": 24, "remove": {"t.token": [{"begin": 0, "end": 1}]}}
+
+    response = client.patch("/dataset/test_dataset/test_document", json=patch)
+
+    assert response.status_code == 409
+    assert Document.parse_raw(client.get("/dataset/test_dataset/test_document").content).version == 23
+
+
+def test_patch_document_in_dataset_when_version_does_not_increase(client: TestClient):
+    client.put("/dataset/test_dataset")
+    client.put("/dataset/test_dataset/test_document", json={**Document.Config.schema_extra["example"], "version": 23})
+    patch = {**DocumentPatch.Config.schema_extra["example"], "version": 23}
+
+    response = client.patch("/dataset/test_dataset/test_document", json=patch)
+
+    assert response.status_code == 422
+    assert Document.parse_raw(client.get("/dataset/test_dataset/test_document").content).version == 23
+
+
+def test_add_and_patch_document_in_dataset_while_it_is_being_updated(client: TestClient):
+    client.put("/dataset/test_dataset")
+    request = {**Document.Config.schema_extra["example"], "version": 23}
+    client.put("/dataset/test_dataset/test_document", json=request)
+
+    lock = get_lock(tmpdir / "locks" / "document-locks" / "test_dataset", "test_document")
+    with lock:
+        response = client.put("/dataset/test_dataset/test_document", json={**request, "version": 25})
+        assert response.status_code == 409
+
+        response = client.patch(
+            "/dataset/test_dataset/test_document", json=DocumentPatch.Config.schema_extra["example"]
+        )
+        assert response.status_code == 409
+
+    assert Document.parse_raw(client.get("/dataset/test_dataset/test_document").content).version == 23
+    assert list((tmpdir / "locks" / "document-locks" / "test_dataset").glob("*.tmp")) == []
+
+
+def test_patch_document_in_dataset_when_document_does_not_exist(client: TestClient):
+    client.put("/dataset/test_dataset")
+
+    response = client.patch("/dataset/test_dataset/test_document", json=DocumentPatch.Config.schema_extra["example"])
+
+    assert response.status_code == 404
+
+
 # DELETE delete_document_from_dataset
 
 
@@ -201,7 +338,7 @@ def test_delete_document_from_dataset_when_document_exists(client: TestClient):
     assert response.status_code == 204
     assert response.text == ""
 
-    p = get_document_path(tmpdir, "test_dataset", "test_document")
+    p = DataDirectory(tmpdir).get_document_path("test_dataset", "test_document")
 
     assert p.is_file()
 
@@ -229,7 +366,7 @@ def test_get_all_classifier_infos(server: GalahadServer, client: TestClient, cla
         name = f"test_classifier_{i}"
         server.add_classifier(name, classifier)
 
-        info = {"name": name}
+        info = {"name": name, "consumes": [], "models": []}
         expected_infos.append(info)
 
     response = client.get("/classifier")
@@ -242,7 +379,7 @@ def test_get_all_classifier_infos(server: GalahadServer, client: TestClient, cla
 
 
 def test_get_classifier(server: GalahadServer, client: TestClient, classifier: Classifier):
-    expected_info = {"name": "test_classifier"}
+    expected_info = {"name": "test_classifier", "consumes": [], "models": []}
     server.add_classifier("test_classifier", classifier)
 
     response = client.get("/classifier/test_classifier")
@@ -251,6 +388,15 @@ def test_get_classifier(server: GalahadServer, client: TestClient, classifier: C
     assert response.json() == expected_info
 
 
+def test_get_classifier_with_consumed_layers(server: GalahadServer, client: TestClient):
+    server.add_classifier("test_classifier", TokenDummyClassifier())
+
+    response = client.get("/classifier/test_classifier")
+
+    assert response.status_code == 200
+    assert response.json()["consumes"] == ["t.token", "t.sentence"]
+
+
 def test_get_classifier_when_classifier_does_not_exist(
     server: GalahadServer, client: TestClient, classifier: Classifier
 ):
@@ -260,7 +406,7 @@ def test_get_classifier_when_classifier_does_not_exist(
         name = f"test_classifier_{i}"
         server.add_classifier(name, classifier)
 
-        info = {"name": name}
+        info = {"name": name, "consumes": [], "models": []}
         expected_infos.append(info)
 
     response = client.get("/classifier/test_classifier")
@@ -269,6 +415,86 @@ def test_get_classifier_when_classifier_does_not_exist(
     assert response.json() == {"detail": "Classifier with id [test_classifier] not found."}
 
 
+def test_get_classifier_after_training(server: GalahadServer, client: TestClient, classifier: Classifier):
+    test_train_on_dataset(server, client, classifier)
+
+    response = client.get("/classifier/test_classifier")
+
+    assert response.status_code == 200
+    models = response.json()["models"]
+    assert [(m["model_id"], m["generation"], m["document_count"]) for m in models] == [("test_model", 1, 1)]
+
+
+# GET get_model_info
+
+
+def test_get_model_info(server: GalahadServer, client: TestClient, classifier: Classifier):
+    test_train_on_dataset(server, client, classifier)
+
+    response = client.get("/classifier/test_classifier/test_model")
+
+    assert response.status_code == 200
+    model_info = ModelInfo.parse_obj(response.json())
+    assert model_info.model_id == "test_model"
+    assert model_info.generation == 1
+    assert model_info.document_count == 1
+    assert model_info.training_duration > 0
+    assert model_info.size == classifier._get_model_path("test_model").stat().st_size
+
+
+def test_get_model_info_is_conditional(server: GalahadServer, client: TestClient, classifier: Classifier):
+    test_train_on_dataset(server, client, classifier)
+
+    response = client.get("/classifier/test_classifier/test_model")
+    etag = response.headers["ETag"]
+
+    response = client.get("/classifier/test_classifier/test_model", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.text == ""
+
+    classifier._save_model("test_model", [])
+
+    response = client.get("/classifier/test_classifier/test_model", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["generation"] == 2
+
+
+def test_get_model_info_when_model_does_not_exist(server: GalahadServer, client: TestClient, classifier: Classifier):
+    server.add_classifier("test_classifier", classifier)
+
+    response = client.get("/classifier/test_classifier/test_model")
+    assert response.status_code == 404
+    assert response.json() == {
+        "detail": "Model with id [test_model] of classifier with id [test_classifier] not found."
+    }
+
+    response = client.get("/classifier/other_classifier/test_model")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Classifier with id [other_classifier] not found."}
+
+
+# GET list_resident_models
+
+
+def test_list_resident_models(server: GalahadServer, client: TestClient, classifier: Classifier):
+    response = client.get("/models")
+    assert response.status_code == 200
+    assert response.json()["models"] == []
+
+    test_predict_on_document(server, client, classifier)
+
+    response = client.get("/models")
+    assert response.status_code == 200
+
+    resident_models = response.json()["models"]
+    assert len(resident_models) == 1
+    assert resident_models[0]["classifier_name"] == classifier.name
+    assert resident_models[0]["model_id"] == "test_model"
+    assert resident_models[0]["generation"] == 1
+    assert resident_models[0]["size"] == classifier._get_model_path("test_model").stat().st_size
+
+
 # POST train_on_dataset
 
 
@@ -294,6 +520,10 @@ def test_train_on_dataset(server: GalahadServer, client: TestClient, classifier:
 
         assert model_path.is_file()
 
+        # The trained model is loaded in the background right after training
+        resident_models = server.state.classifier_store.get_resident_models().models
+        assert [(m.model_id, m.generation) for m in resident_models] == [("test_model", 1)]
+
 
 def test_train_on_dataset_when_classifier_does_not_exist(client: TestClient):
     response = client.post("/classifier/test_classifier/test_model/train/test_dataset")
@@ -326,6 +556,56 @@ def test_predict_on_document(server: GalahadServer, client: TestClient, classifi
     assert response.json() == request.dict()
 
 
+def test_predict_on_document_drops_unconsumed_layers(server: GalahadServer, client: TestClient):
+    test_train_on_dataset(server, client, TokenDummyClassifier())
+
+    request = Document(**Document.Config.schema_extra["example"])
+    response = client.post("/classifier/test_classifier/test_model/predict", json=request.dict())
+
+    assert response.status_code == 200
+    assert set(request.annotations) == {"t.token", "t.sentence", "t.named_entity"}
+    assert set(response.json()["annotations"]) == {"t.token", "t.sentence"}
+    assert response.json()["text"] == request.text
+
+
+def test_metrics_after_predict_on_document(server: GalahadServer, client: TestClient, classifier: Classifier):
+    test_predict_on_document(server, client, classifier)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+    lines = response.text.splitlines()
+    route = "/classifier/{classifier_id}/{model_id}/predict"
+    for stage in ["parse", "inference", "serialize"]:
+        expected_labels = f'route="{route}",classifier="test_classifier",model_id="test_model",stage="{stage}"'
+        assert f"galahad_stage_duration_seconds_count{{{expected_labels}}} 1" in lines
+
+    assert f'galahad_request_duration_seconds_count{{route="{route}",method="POST",status="200"}} 1' in lines
+    assert 'galahad_training_documents_count{classifier="test_classifier",model_id="test_model"} 1' in lines
+    assert 'galahad_model_cache_events_total{classifier="test_classifier",event="hit"} 1' in lines
+    assert "galahad_training_queue_depth 0" in lines
+
+
+def test_predict_on_document_with_invalid_document(server: GalahadServer, client: TestClient, classifier: Classifier):
+    server.add_classifier("test_classifier", classifier)
+
+    response = client.post("/classifier/test_classifier/test_model/predict", json={"text": "No annotations"})
+
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", "annotations"]
+
+
+@pytest.mark.parametrize("body", [b"{", b'{"text": "No annotations"}'])
+def test_predict_on_document_with_invalid_document_and_consumed_layers(server: GalahadServer, client: TestClient, body):
+    server.add_classifier("test_classifier", TokenDummyClassifier())
+
+    response = client.post("/classifier/test_classifier/test_model/predict", data=body)
+
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"][0] == "body"
+
+
 def test_predict_on_document_when_classifier_does_not_exist(client: TestClient):
     request = Document.Config.schema_extra["example"]
     response = client.post("/classifier/test_classifier/test_model/predict", json=request)
@@ -344,3 +624,233 @@ def test_predict_on_document_when_model_does_not_exist(
 
     assert response.status_code == 404
     assert response.json() == {"detail": "Model with id [test_model] not found."}
+
+
+class BlockingDummyClassifier(DummyClassifier):
+    """Blocks predictions until released so that several requests are running at the same time."""
+
+    def __init__(self):
+        super().__init__()
+        self.predict_calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def predict(self, model_id: str, document: Document) -> Optional[Document]:
+        self.predict_calls += 1
+        self.started.set()
+        self.release.wait(timeout=10)
+        return super().predict(model_id, document)
+
+
+def test_predict_on_document_coalesces_identical_requests(server: GalahadServer, client: TestClient):
+    classifier = BlockingDummyClassifier()
+    server.add_classifier("test_classifier", classifier)
+    classifier.train("test_model", [Document(text="text", annotations={})])
+
+    request = Document.Config.schema_extra["example"]
+    other_request = dict(request, text=request["text"] + " Other")
+
+    def predict(body):
+        return client.post("/classifier/test_classifier/test_model/predict", json=body)
+
+    with ThreadPoolExecutor(4) as executor:
+        futures = [executor.submit(predict, request)]
+        classifier.started.wait(timeout=10)
+        futures += [executor.submit(predict, body) for body in [request, request, other_request]]
+
+        # Gives the other requests time to reach the running prediction
+        time.sleep(0.5)
+        classifier.release.set()
+
+    responses = [f.result() for f in futures]
+    assert [r.status_code for r in responses] == [200] * 4
+    assert [r.json()["text"] for r in responses] == [request["text"]] * 3 + [other_request["text"]]
+
+    # The identical requests shared one prediction, the other one was predicted on its own
+    assert classifier.predict_calls == 2
+
+    lines = client.get("/metrics").text.splitlines()
+    assert 'galahad_coalesced_predictions_total{classifier="test_classifier"} 2' in lines
+
+
+# POST predict_on_dataset
+
+
+def test_predict_on_dataset(server: GalahadServer, client: TestClient, classifier: Classifier):
+    test_train_on_dataset(server, client, classifier)
+
+    response = client.post("/classifier/test_classifier/test_model/predict/test_dataset/test_document")
+
+    assert response.status_code == 200
+    assert response.json() == Document(**Document.Config.schema_extra["example"]).dict()
+
+
+@pytest.mark.parametrize(
+    "classifier_id, model_id, dataset_id, document_id, expected",
+    [
+        ("unknown", "test_model", "test_dataset", "test_document", "Classifier with id [unknown] not found."),
+        ("test_classifier", "unknown", "test_dataset", "test_document", "Model with id [unknown] not found."),
+        ("test_classifier", "test_model", "unknown", "test_document", "Dataset with id [unknown] not found."),
+        ("test_classifier", "test_model", "test_dataset", "unknown", "Document with id [unknown] not found."),
+    ],
+)
+def test_predict_on_dataset_when_it_does_not_exist(
+    server: GalahadServer,
+    client: TestClient,
+    classifier: Classifier,
+    classifier_id,
+    model_id,
+    dataset_id,
+    document_id,
+    expected,
+):
+    test_train_on_dataset(server, client, classifier)
+
+    response = client.post(f"/classifier/{classifier_id}/{model_id}/predict/{dataset_id}/{document_id}")
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": expected}
+
+
+# Precomputed predictions
+
+
+@pytest.fixture
+def precomputing_server():
+    tmp = TemporaryDirectory()
+
+    global tmpdir
+    tmpdir = Path(tmp.name)
+
+    server = GalahadServer(data_dir=tmpdir, precompute_predictions=True)
+
+    yield server
+    tmp.cleanup()
+
+
+def test_predict_on_document_with_precomputed_prediction(precomputing_server: GalahadServer, classifier: Classifier):
+    client = TestClient(precomputing_server)
+    test_train_on_dataset(precomputing_server, client, classifier)
+
+    assert (tmpdir / "predictions" / "test_classifier" / "test_model" / "active").read_text() == "1"
+
+    request = Document(**Document.Config.schema_extra["example"])
+    response = client.post("/classifier/test_classifier/test_model/predict", json=request.dict())
+    assert response.status_code == 200
+    assert response.json() == request.dict()
+
+    response = client.post("/classifier/test_classifier/test_model/predict/test_dataset/test_document")
+    assert response.status_code == 200
+    assert response.json() == request.dict()
+
+    # Edited documents have a new version and are predicted by the model
+    edited_request = request.copy(update={"version": request.version + 1})
+    response = client.post("/classifier/test_classifier/test_model/predict", json=edited_request.dict())
+    assert response.status_code == 200
+    assert response.json() == edited_request.dict()
+
+    lines = client.get("/metrics").text.splitlines()
+    assert 'galahad_prediction_cache_events_total{classifier="test_classifier",event="hit"} 2' in lines
+    assert 'galahad_prediction_cache_events_total{classifier="test_classifier",event="miss"} 1' in lines
+
+
+def test_predict_on_document_with_edited_layers_and_precomputed_prediction(precomputing_server: GalahadServer):
+    client = TestClient(precomputing_server)
+    test_train_on_dataset(precomputing_server, client, TokenDummyClassifier())
+
+    # The same text and version, but different tokens than the document the prediction was precomputed for
+    request = Document(**Document.Config.schema_extra["example"])
+    request.annotations["t.token"] = request.annotations["t.token"][1:]
+
+    response = client.post("/classifier/test_classifier/test_model/predict", json=request.dict())
+    assert response.status_code == 200
+    assert response.json()["annotations"]["t.token"] == [a.dict() for a in request.annotations["t.token"]]
+
+    lines = client.get("/metrics").text.splitlines()
+    assert 'galahad_prediction_cache_events_total{classifier="test_classifier",event="miss"} 1' in lines
+
+
+# Profiling
+
+
+@pytest.fixture
+def profiling_server():
+    tmp = TemporaryDirectory()
+
+    global tmpdir
+    tmpdir = Path(tmp.name)
+
+    server = GalahadServer(data_dir=tmpdir, profiling=True, profile_max_captures=2)
+
+    yield server
+    tmp.cleanup()
+
+
+def test_profile_request_with_header(profiling_server: GalahadServer):
+    client = TestClient(profiling_server)
+
+    for _ in range(3):
+        response = client.get("/dataset", headers={"X-Galahad-Profile": "1"})
+        assert response.status_code == 200
+    client.get("/dataset")
+
+    response = client.get("/admin/profiles")
+    assert response.status_code == 200
+
+    captures = response.json()["captures"]
+    assert len(captures) == 2
+    assert all(capture["path"] == "/dataset" for capture in captures)
+    assert captures[0]["duration"] >= captures[1]["duration"]
+    assert len(list((tmpdir / "profiles").glob("*.prof"))) == 2
+
+    response = client.get(f"/admin/profiles/{captures[0]['id']}", params={"format": "text"})
+    assert response.status_code == 200
+    assert "list_datasets" in response.text
+
+    response = client.get(f"/admin/profiles/{captures[0]['id']}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/octet-stream"
+
+
+def test_profile_duration_ends_when_response_was_sent(profiling_server: GalahadServer):
+    @profiling_server.post("/test/background")
+    def add_background_task(background_tasks: BackgroundTasks):
+        background_tasks.add_task(time.sleep, 0.3)
+
+    client = TestClient(profiling_server)
+    response = client.post("/test/background", headers={"X-Galahad-Profile": "1"})
+    assert response.status_code == 200
+
+    captures = client.get("/admin/profiles").json()["captures"]
+    assert [capture["path"] for capture in captures] == ["/test/background"]
+    assert captures[0]["duration"] < 0.3
+
+
+def test_profiles_are_stored_outside_of_the_event_loop(profiling_server: GalahadServer, monkeypatch):
+    add_capture = RequestProfiler.add_capture
+    called_on_event_loop = []
+
+    def checking_add_capture(*args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+            called_on_event_loop.append(True)
+        except RuntimeError:
+            called_on_event_loop.append(False)
+
+        return add_capture(*args, **kwargs)
+
+    monkeypatch.setattr(RequestProfiler, "add_capture", checking_add_capture)
+
+    client = TestClient(profiling_server)
+    response = client.get("/dataset", headers={"X-Galahad-Profile": "1"})
+    assert response.status_code == 200
+
+    assert called_on_event_loop == [False]
+    assert len(client.get("/admin/profiles").json()["captures"]) == 1
+
+
+def test_list_profiles_when_profiling_is_disabled(client: TestClient):
+    response = client.get("/admin/profiles")
+
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Profiling is not enabled."}
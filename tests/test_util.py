@@ -0,0 +1,174 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from galahad.server.util import (DataDirectory, SingleFlight,
+                                 apply_document_patch, project_document)
+
+
+def test_data_directory_paths(tmpdir):
+    data_dir = Path(tmpdir)
+    data_directory = DataDirectory(data_dir)
+
+    assert data_directory.root == data_dir.resolve()
+    assert data_directory.get_dataset_folder("dataset1") == data_dir.resolve() / "datasets" / "dataset1"
+    assert (
+        data_directory.get_document_path("dataset1", "doc.1") == data_dir.resolve() / "datasets" / "dataset1" / "doc.1"
+    )
+
+
+@pytest.mark.parametrize("dataset_id, document_id", [("..", "doc"), ("dataset", ".."), ("a/b", "doc"), ("ds", "")])
+def test_data_directory_rejects_invalid_names(tmpdir, dataset_id: str, document_id: str):
+    data_directory = DataDirectory(Path(tmpdir))
+
+    with pytest.raises(ValueError):
+        data_directory.get_document_path(dataset_id, document_id)
+
+
+def test_data_directory_document_paths(tmpdir):
+    data_directory = DataDirectory(Path(tmpdir))
+    dataset_folder = data_directory.get_dataset_folder("dataset")
+    dataset_folder.mkdir(parents=True)
+
+    for name in ["doc2", "doc1"]:
+        (dataset_folder / name).touch()
+
+    assert list(data_directory.iter_document_paths("dataset")) == [dataset_folder / "doc1", dataset_folder / "doc2"]
+    assert data_directory.get_document_paths("dataset", ["doc2", "doc1"]) == [
+        dataset_folder / "doc2",
+        dataset_folder / "doc1",
+    ]
+
+    with pytest.raises(ValueError):
+        data_directory.get_document_paths("dataset", ["doc1", "../doc2"])
+
+
+@pytest.mark.parametrize(
+    "layers, begin, end, expected_text, expected_annotations",
+    [
+        ([], None, None, "ab cd", {"t.token": [(0, 2), (3, 5)], "t.ne": [(0, 5)]}),
+        (["t.token"], None, None, "ab cd", {"t.token": [(0, 2), (3, 5)]}),
+        ([], 3, None, "cd", {"t.token": [(0, 2)], "t.ne": []}),
+        (["t.token"], 1, 4, "b c", {"t.token": []}),
+        ([], 4, 2, "", {"t.token": [], "t.ne": []}),
+        ([], 0, 100, "ab cd", {"t.token": [(0, 2), (3, 5)], "t.ne": [(0, 5)]}),
+    ],
+)
+def test_project_document(layers, begin, end, expected_text, expected_annotations):
+    document = {
+        "text": "ab cd",
+        "annotations": {
+            "t.token": [{"begin": 0, "end": 2}, {"begin": 3, "end": 5}],
+            "t.ne": [{"begin": 0, "end": 5, "features": {"f.value": "X"}}],
+        },
+        "version": 3,
+    }
+
+    result = project_document(document, layers, begin, end)
+
+    assert result["text"] == expected_text
+    assert result["version"] == 3
+    assert {t: [(a["begin"], a["end"]) for a in layer] for t, layer in result["annotations"].items()} == (
+        expected_annotations
+    )
+    assert document["annotations"]["t.token"][1] == {"begin": 3, "end": 5}
+
+
+def test_apply_document_patch():
+    document = {
+        "text": "ab cd",
+        "annotations": {
+            "t.token": [{"begin": 0, "end": 2}, {"begin": 3, "end": 5}],
+            "t.ne": [{"begin": 0, "end": 2, "features": {"f.value": "X"}}, {"begin": 0, "end": 2}] * 2,
+        },
+    }
+
+    apply_document_patch(
+        document,
+        add={"t.ne": [{"begin": 3, "end": 5, "features": {"f.value": "Y"}}], "t.sentence": [{"begin": 0, "end": 5}]},
+        remove={"t.ne": [{"begin": 0, "end": 2, "features": {"f.value": "X"}}, {"begin": 0, "end": 2, "features": {}}]},
+    )
+
+    assert document["annotations"] == {
+        "t.token": [{"begin": 0, "end": 2}, {"begin": 3, "end": 5}],
+        "t.ne": [
+            {"begin": 0, "end": 2, "features": {"f.value": "X"}},
+            {"begin": 0, "end": 2},
+            {"begin": 3, "end": 5, "features": {"f.value": "Y"}},
+        ],
+        "t.sentence": [{"begin": 0, "end": 5}],
+    }
+
+
+def test_apply_document_patch_when_removed_annotation_is_missing():
+    document = {"text": "ab cd", "annotations": {"t.token": [{"begin": 0, "end": 2}]}}
+
+    with pytest.raises(ValueError):
+        apply_document_patch(
+            document,
+            add={"t.token": [{"begin": 3, "end": 5}]},
+            remove={"t.token": [{"begin": 0, "end": 2}, {"begin": 0, "end": 2}]},
+        )
+
+    assert document["annotations"] == {"t.token": [{"begin": 0, "end": 2}]}
+
+
+def _run_concurrently(flight: SingleFlight, key, fn, count: int):
+    """Calls `fn` via `flight` from `count` threads, the first call is running while the others are made."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_fn():
+        started.set()
+        release.wait()
+        return fn()
+
+    with ThreadPoolExecutor(count) as executor:
+        futures = [executor.submit(flight.do, key, blocking_fn)]
+        started.wait()
+        futures += [executor.submit(flight.do, key, blocking_fn) for _ in range(count - 1)]
+
+        # Gives the other calls time to start waiting for the first one
+        time.sleep(0.2)
+        assert len(flight) == 1
+        release.set()
+
+    return futures
+
+
+def test_single_flight_shares_result_of_running_call():
+    flight = SingleFlight()
+    calls = []
+
+    futures = _run_concurrently(flight, "key", lambda: calls.append(1) or len(calls), 4)
+
+    assert [f.result() for f in futures] == [(1, False), (1, True), (1, True), (1, True)]
+    assert len(calls) == 1
+    assert len(flight) == 0
+
+    # Calls after the running one finished compute the result again
+    assert flight.do("key", lambda: calls.append(1) or len(calls)) == (2, False)
+
+
+def test_single_flight_shares_exception_of_running_call():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("failed")
+
+    futures = _run_concurrently(flight, "key", fail, 3)
+
+    for future in futures:
+        with pytest.raises(ValueError, match="failed"):
+            future.result()
+    assert len(flight) == 0
+
+
+def test_single_flight_does_not_share_between_keys():
+    flight = SingleFlight()
+
+    assert flight.do("a", lambda: 1) == (1, False)
+    assert flight.do("b", lambda: 2) == (2, False)